@@ -268,6 +268,7 @@ man_pages = [
     ('manpages/bob-query-recipe', 'bob-query-recipe', 'Query package sources', ['Jan Klötzke'], 1),
     ('manpages/bob-query-scm', 'bob-query-scm', 'Query SCM information', ['Jan Klötzke'], 1),
     ('manpages/bob-status', 'bob-status', 'Show SCM status', ['Jan Klötzke'], 1),
+    ('manpages/bob-worker', 'bob-worker', 'Execute build steps for remote clients', ['Jan Klötzke'], 1),
 ]
 
 # If true, show URL addresses after external links.
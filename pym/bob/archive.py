@@ -20,32 +20,282 @@ concurrent uploads the artifact must appear atomically for unrelated readers.
 """
 
 from .errors import BuildError
-from .tty import stepAction, SKIPPED, EXECUTED, WARNING, INFO, TRACE, ERROR
-from .utils import asHexStr, removePath, isWindows
+from .state import BobState
+from .tty import stepAction, stepMessage, SKIPPED, EXECUTED, WARNING, INFO, TRACE, ERROR
+from .store import linkTree, writeProtectTree
+from .utils import asHexStr, copyFiles, removePath, isWindows
 from pipes import quote
-from tempfile import mkstemp, NamedTemporaryFile, TemporaryFile
+from tempfile import mkdtemp, mkstemp, NamedTemporaryFile, TemporaryFile
 import argparse
 import asyncio
 import concurrent.futures
 import concurrent.futures.process
+import collections
+import contextlib
+import errno
+import functools
 import gzip
+import hashlib
 import http.client
+import io
+import json
+import lzma
 import os
 import os.path
+import queue
+import re
 import signal
+import select
+import shutil
 import ssl
+import stat
 import subprocess
 import tarfile
 import textwrap
+import threading
+import time
 import urllib.parse
+import uuid
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 ARCHIVE_GENERATION = '-1'
 ARTIFACT_SUFFIX = ".tgz"
 BUILDID_SUFFIX = ".buildid"
+MANIFEST_FILE = "MANIFEST"
+CHUNKS_SUFFIX = ".chunks"
+CHUNK_SUFFIX = ".chunk"
+SOURCES_SUFFIX = ".sources"
+UNPACKED_SUFFIX = ".unpacked"
+
+# Files of chunked artifacts are split at content defined boundaries into
+# chunks of CHUNK_MIN_SIZE to CHUNK_MAX_SIZE bytes. On average a chunk is about
+# CHUNK_AVG_SIZE bytes large. Up to CHUNK_STREAMS chunks are transferred in
+# parallel.
+CHUNK_MIN_SIZE = 2 * 1024 * 1024
+CHUNK_AVG_SIZE = 4 * 1024 * 1024
+CHUNK_MAX_SIZE = 16 * 1024 * 1024
+CHUNK_STREAMS = 4
+
+# Random values of the rolling gear hash for every byte value. Must never change
+# because it defines the chunk boundaries.
+CHUNK_GEAR = tuple(int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], "big")
+                   for i in range(256))
+
+# Number of bytes that are hashed at once when searching for a chunk boundary.
+CHUNK_SCAN_SIZE = 64 * 1024
+
+# The archive cache is walked at least once a day to remove stale files.
+CACHE_WALK_INTERVAL = 24 * 60 * 60
+
+# Weight of a new sample in the moving average of the backend latencies
+LATENCY_WEIGHT = 0.25
+
+# Artifact format versions. Version 1 is always compressed by gzip. Version 2
+# artifacts may use any of the COMPRESSION_METHODS.
+ARCHIVE_VERSIONS = ("1", "2")
+COMPRESSION_METHODS = ("gzip", "xz", "zstd")
+DEFAULT_COMPRESSION_LEVEL = { "gzip" : 6, "xz" : 6, "zstd" : 3 }
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
 
 def buildIdToName(bid):
     return asHexStr(bid) + ARCHIVE_GENERATION
 
+def importZstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise BuildError("zstandard Python3 library not installed!",
+            help="The library is required for zstd compressed binary artifacts.")
+    return zstandard
+
+class PrefixReader:
+    """Put data back in front of a stream."""
+    def __init__(self, prefix, fileobj):
+        self.prefix = prefix
+        self.fileobj = fileobj
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.fileobj.read(size)
+        if size is None or size < 0:
+            ret = self.prefix + self.fileobj.read()
+        elif size <= len(self.prefix):
+            ret = self.prefix[:size]
+            self.prefix = self.prefix[size:]
+            return ret
+        else:
+            ret = self.prefix + self.fileobj.read(size - len(self.prefix))
+        self.prefix = b''
+        return ret
+
+def openArtifactReader(fileobj):
+    """Open the tar stream of an artifact.
+
+    The compression is detected automatically. The artifact format version
+    must be checked by the caller.
+    """
+    magic = b''
+    while len(magic) < len(ZSTD_MAGIC):
+        data = fileobj.read(len(ZSTD_MAGIC) - len(magic))
+        if not data: break
+        magic += data
+    fileobj = PrefixReader(magic, fileobj)
+    if magic == ZSTD_MAGIC:
+        fileobj = importZstandard().ZstdDecompressor().stream_reader(fileobj)
+        return tarfile.open(None, "r|", fileobj=fileobj, errorlevel=1)
+    else:
+        # gzip, xz (and bzip2) are detected by tarfile itself
+        return tarfile.open(None, "r|*", fileobj=fileobj, errorlevel=1)
+
+class ZstdWriter:
+    def __init__(self, fileobj, level, threads):
+        self.fileobj = fileobj
+        self.compressor = importZstandard().ZstdCompressor(level=level,
+            threads=(threads if threads > 1 else 0)).compressobj()
+        self.pos = 0
+    def write(self, data):
+        self.fileobj.write(self.compressor.compress(data))
+        self.pos += len(data)
+        return len(data)
+    def tell(self):
+        return self.pos
+    def close(self):
+        self.fileobj.write(self.compressor.flush())
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None: self.close()
+        return False
+
+def openCompressedWriter(fileobj, method, level, threads):
+    """Open a compressed stream that writes into 'fileobj'.
+
+    Closing the stream does not close 'fileobj'.
+    """
+    if method == "gzip":
+        return gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=level)
+    elif method == "xz":
+        return lzma.LZMAFile(fileobj, "wb", preset=level)
+    elif method == "zstd":
+        return ZstdWriter(fileobj, level, threads)
+    else:
+        raise BuildError("Invalid compression method: " + method)
+
+def isSafeChunkPath(path, links):
+    """Check that a path of a chunked artifact stays inside the workspace.
+
+    The path must be relative, normalized and must not traverse any of the
+    symlinks in 'links'.
+    """
+    if os.path.isabs(path) or (os.path.normpath(path) != path) or \
+       (path == "..") or path.startswith("../"):
+        return False
+    parent = os.path.dirname(path)
+    while parent:
+        if parent in links: return False
+        parent = os.path.dirname(parent)
+    return True
+
+@functools.lru_cache(maxsize=4)
+def _chunkScanner(bits, length):
+    """Get the tables and masks to hash 'length' bytes with 'bits' wide words.
+
+    Every byte is translated into a word of 'width' bytes that holds its gear
+    value. All words are packed into one big integer. See findChunkBoundary().
+    """
+    width = (bits + 7) // 8
+    tables = [ bytes((g & ((1 << bits) - 1)) >> (8*i) & 0xff for g in CHUNK_GEAR)
+               for i in range(width) ]
+    steps = []
+    span = 1
+    while span < bits:
+        # Keep only the bits of every word that do not spill into the next word
+        word = ((1 << bits) - 1) ^ ((1 << span) - 1)
+        mask = int.from_bytes(word.to_bytes(width, "little") * length, "little")
+        steps.append((span * 8 * width + span, mask))
+        span *= 2
+    return (width, tables, steps)
+
+def findChunkBoundary(data):
+    """Get the size of the first chunk of 'data'.
+
+    The boundary is placed after the first byte where the rolling gear hash
+    h = ((h << 1) ^ CHUNK_GEAR[byte]) mod 2**bits is zero. The hash only
+    depends on the last 'bits' bytes. Hence inserted or removed data does not
+    move the boundaries of the following chunks. The first CHUNK_MIN_SIZE bytes
+    are not hashed at all.
+
+    Hashing byte by byte in Python is very slow. Instead, the hash values of
+    CHUNK_SCAN_SIZE bytes are calculated at once. Every byte is expanded into a
+    word holding its gear value. The words are packed into a single integer
+    and shifted into their successors by doubling distances. After log2(bits)
+    steps every word holds the hash at its position.
+    """
+    size = min(len(data), CHUNK_MAX_SIZE)
+    if size <= CHUNK_MIN_SIZE: return size
+    bits = (CHUNK_AVG_SIZE - CHUNK_MIN_SIZE).bit_length() - 1
+    length = CHUNK_SCAN_SIZE + bits
+    (width, tables, steps) = _chunkScanner(bits, length)
+    zero = bytes(width)
+
+    pos = CHUNK_MIN_SIZE
+    while pos < size:
+        # Include the preceding bytes that are still part of the hash
+        start = max(0, pos - bits)
+        end = min(size, pos + CHUNK_SCAN_SIZE)
+        block = bytes(data[start:end]).ljust(length, b'\0')
+        words = bytearray(length * width)
+        for (i, table) in enumerate(tables):
+            words[i::width] = block.translate(table)
+        h = int.from_bytes(words, "little")
+        for (shift, mask) in steps:
+            h ^= (h << shift) & mask
+        words = h.to_bytes(length * width, "little")
+
+        # Search the first zero word, ignoring unaligned matches
+        i = words.find(zero, (pos - start) * width, (end - start) * width)
+        while i >= 0:
+            if i % width == 0: return start + i // width + 1
+            i = words.find(zero, i - i % width + width, (end - start) * width)
+        pos = end
+
+    return size
+
+def iterChunks(fileobj):
+    """Split the content of a file object into content defined chunks."""
+    data = b''
+    eof = False
+    while True:
+        while not eof and (len(data) < CHUNK_MAX_SIZE):
+            buf = fileobj.read(CHUNK_MAX_SIZE - len(data))
+            if buf:
+                data += buf
+            else:
+                eof = True
+        if not data: break
+        size = findChunkBoundary(data)
+        yield data[:size]
+        data = data[size:]
+
+def parseManifest(data):
+    """Parse the manifest of an archive.
+
+    Every line holds the relative path of an artifact and optionally its size,
+    separated by white space. Returns a dict that maps the artifact file names
+    (without the directory separators) to their size or None.
+    """
+    ret = {}
+    for line in data.decode("utf8").splitlines():
+        fields = line.split()
+        if not fields: continue
+        size = fields[1] if len(fields) > 1 else ""
+        ret[fields[0].replace("/", "")] = int(size) if size.isdigit() else None
+    return ret
+
 def readFileOrHandle(name, fileobj):
     if fileobj is not None:
         return fileobj.read()
@@ -60,6 +310,115 @@ def writeFileOrHandle(name, fileobj, content):
         f.write(content)
 
 
+class TransferMeter:
+    """Measure a transfer that is executed by an executor job.
+
+    The file object of the artifact is wrapped by wrap(). This counts the
+    transferred bytes and the time that is spent in reading or writing it.
+    The rest of the job is spent in compression or extraction. Transfers that
+    do not use a wrapped file object are not measured.
+    """
+    def __init__(self):
+        self.bytes = 0
+        self.ioTime = 0.0
+        self.totalTime = 0.0
+        self.measured = False
+        self.__start = time.monotonic()
+
+    def wrap(self, fileobj):
+        self.measured = True
+        return MeteredFile(fileobj, self)
+
+    def stop(self):
+        self.totalTime = time.monotonic() - self.__start
+
+    def codecTime(self):
+        return max(self.totalTime - self.ioTime, 0.0) if self.measured else 0.0
+
+class MeteredFile:
+    def __init__(self, fileobj, meter):
+        self.fileobj = fileobj
+        self.meter = meter
+    def read(self, size=-1):
+        start = time.monotonic()
+        ret = self.fileobj.read(size)
+        self.meter.ioTime += time.monotonic() - start
+        self.meter.bytes += len(ret)
+        return ret
+    def write(self, data):
+        start = time.monotonic()
+        ret = self.fileobj.write(data)
+        self.meter.ioTime += time.monotonic() - start
+        self.meter.bytes += len(data)
+        return ret
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+def percentile(values, p):
+    """Nearest-rank percentile of a list of values."""
+    if not values: return None
+    values = sorted(values)
+    return values[max(0, -(-len(values) * p // 100) - 1)]
+
+class ArchiveStatistic:
+    """Transfer statistics of an archive backend.
+
+    Only artifacts are accounted. Latencies are measured by the main process
+    and include the time waiting for a free executor job.
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.uploads = 0
+        self.uploadsSkipped = 0
+        self.bytesDownloaded = 0
+        self.bytesUploaded = 0
+        self.extractTime = 0.0
+        self.compressTime = 0.0
+        self.downloadLatencies = []
+        self.uploadLatencies = []
+
+    def addDownload(self, latency, meter):
+        self.hits += 1
+        self.downloadLatencies.append(latency)
+        self.bytesDownloaded += meter.bytes
+        self.extractTime += meter.codecTime()
+
+    def addUpload(self, latency, meter):
+        self.uploads += 1
+        self.uploadLatencies.append(latency)
+        self.bytesUploaded += meter.bytes
+        self.compressTime += meter.codecTime()
+
+    def isEmpty(self):
+        return not (self.hits or self.misses or self.errors or self.uploads
+                    or self.uploadsSkipped)
+
+    def dump(self, name):
+        def latencies(values):
+            return { "p50" : percentile(values, 50), "p90" : percentile(values, 90),
+                     "p99" : percentile(values, 99), "max" : max(values, default=None) }
+        def throughput(size, values):
+            total = sum(values)
+            return size / total if total > 0 else None
+        return {
+            "name" : name,
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "errors" : self.errors,
+            "uploads" : self.uploads,
+            "uploadsSkipped" : self.uploadsSkipped,
+            "bytesDownloaded" : self.bytesDownloaded,
+            "bytesUploaded" : self.bytesUploaded,
+            "downloadThroughput" : throughput(self.bytesDownloaded, self.downloadLatencies),
+            "uploadThroughput" : throughput(self.bytesUploaded, self.uploadLatencies),
+            "extractTime" : self.extractTime,
+            "compressTime" : self.compressTime,
+            "downloadLatency" : latencies(self.downloadLatencies),
+            "uploadLatency" : latencies(self.uploadLatencies),
+        }
+
 class DummyArchive:
     """Archive that does nothing"""
 
@@ -87,6 +446,18 @@ class DummyArchive:
     async def downloadPackage(self, step, buildId, audit, content):
         return False
 
+    async def uploadSources(self, step, sourceId, audit, content):
+        pass
+
+    async def downloadSources(self, step, sourceId, audit, content):
+        return False
+
+    async def queryPackage(self, step, buildId):
+        return (False, None)
+
+    async def queryPackages(self, step, buildIds):
+        return { bid : (False, None) for bid in buildIds }
+
     def upload(self, step, buildIdFile, tgzFile):
         return ""
 
@@ -102,6 +473,12 @@ class DummyArchive:
     def uploadJenkinsLiveBuildId(self, step, liveBuildId, buildId):
         return ""
 
+    async def finish(self):
+        pass
+
+    def getStatistics(self):
+        return []
+
 class ArtifactNotFoundError(Exception):
     pass
 
@@ -126,10 +503,52 @@ class BaseArchive:
         self.__useJenkins = "nojenkins" not in flags
         self.__wantDownload = False
         self.__wantUpload = False
+        self.__cache = None
+        self.__useManifest = spec.get("manifest", False)
+        self.__missCacheTTL = spec.get("missCacheTTL", 0)
+        self.__missesPruned = False
+        self.__chunked = spec.get("chunked", False)
+        self.__maxFailures = spec.get("maxFailures", 0)
+        self.__failures = 0
+        self.__disabled = False
+        self.__manifest = None
+        self.__statistic = ArchiveStatistic()
+        compression = spec.get("compression", {})
+        self.__compressMethod = compression.get("method", "gzip")
+        self.__compressLevel = compression.get("level",
+            DEFAULT_COMPRESSION_LEVEL[self.__compressMethod])
+        self.__compressThreads = compression.get("threads", 1)
+        if self.__compressMethod == "zstd": importZstandard()
+
+    def __getstate__(self):
+        # The manifest is only used by the main process. Don't pickle it for
+        # every job that is run by the executor.
+        state = self.__dict__.copy()
+        state["_BaseArchive__manifest"] = None
+        return state
 
     def _ignoreErrors(self):
         return self.__ignoreErrors
 
+    def _archiveName(self):
+        """Name of the backend in the statistics."""
+        return type(self).__name__
+
+    def getStatistics(self):
+        """Get the transfer statistics as list of dicts."""
+        if self.__statistic.isEmpty(): return []
+        return [ self.__statistic.dump(self._archiveName()) ]
+
+    def _runMetered(self, method, *args):
+        """Run a transfer method in an executor job and measure it.
+
+        Returns a tuple of the result of the method and the TransferMeter.
+        """
+        meter = TransferMeter()
+        ret = getattr(self, method)(*args, meter=meter)
+        meter.stop()
+        return (ret, meter)
+
     def wantDownload(self, enable):
         self.__wantDownload = enable
 
@@ -137,10 +556,29 @@ class BaseArchive:
         self.__wantUpload = enable
 
     def canDownloadLocal(self):
-        return self.__wantDownload and self.__useDownload and self.__useLocal
+        return self.__wantDownload and self.__useDownload and self.__useLocal and \
+            not self.__disabled
 
     def canUploadLocal(self):
-        return self.__wantUpload and self.__useUpload and self.__useLocal
+        return self.__wantUpload and self.__useUpload and self.__useLocal and \
+            not self.__disabled
+
+    def __countFailure(self, step, remoteName, failed):
+        """Track consecutive transfer failures of the backend.
+
+        The backend is disabled for the rest of the build once 'maxFailures'
+        transfers failed in a row. Missing artifacts are no failures.
+        """
+        if not failed:
+            self.__failures = 0
+            return
+        self.__failures += 1
+        if self.__maxFailures and (self.__failures >= self.__maxFailures) \
+           and not self.__disabled:
+            self.__disabled = True
+            stepMessage(step, "ARCHIVE", "disabled after {} consecutive failures ({})"
+                            .format(self.__failures, remoteName),
+                        WARNING)
 
     def canDownloadJenkins(self):
         return self.__wantDownload and self.__useDownload and self.__useJenkins
@@ -149,7 +587,7 @@ class BaseArchive:
         return self.__wantUpload and self.__useUpload and self.__useJenkins
 
     def __extractPackage(self, tar, audit, content):
-        if tar.pax_headers.get('bob-archive-vsn', "0") != "1":
+        if tar.pax_headers.get('bob-archive-vsn', "0") not in ARCHIVE_VERSIONS:
             raise BuildError("Unsupported binary artifact")
 
         f = tar.next()
@@ -178,35 +616,181 @@ class BaseArchive:
     def _openDownloadFile(self, buildId, suffix):
         raise ArtifactNotFoundError()
 
+    def _missKeyPrefix(self):
+        """Namespace of the misses of this backend in the project state."""
+        return self._archiveName() + ":"
+
+    def __isMissing(self, buildId, suffix):
+        """Check if the artifact was recently found missing in the archive."""
+        if not self.__missCacheTTL: return False
+        if not self.__missesPruned:
+            # Drop the expired misses of this backend once per invocation.
+            BobState().delArchiveMisses(self._missKeyPrefix(),
+                                        time.time() - self.__missCacheTTL)
+            self.__missesPruned = True
+        missTime = BobState().getArchiveMiss(self._missKeyPrefix() +
+                                             self._remoteName(buildId, suffix))
+        return (missTime is not None) and (time.time() - missTime < self.__missCacheTTL)
+
+    def __setMissing(self, buildId, suffix, missing):
+        """Record or forget a miss of an artifact.
+
+        Misses are stored in the project state. They survive the invocation
+        of Bob and are honoured by all later builds until the TTL expired.
+        """
+        if not self.__missCacheTTL: return
+        key = self._missKeyPrefix() + self._remoteName(buildId, suffix)
+        if missing:
+            BobState().setArchiveMiss(key, time.time())
+        else:
+            BobState().delArchiveMiss(key)
+
     async def downloadPackage(self, step, buildId, audit, content):
         if not self.canDownloadLocal():
             return False
 
+        remoteName = self._remoteName(buildId, ARTIFACT_SUFFIX)
+        if self.__isMissing(buildId, ARTIFACT_SUFFIX):
+            stepMessage(step, "DOWNLOAD", "skipped ({} known to be missing)".format(remoteName),
+                        SKIPPED, INFO)
+            return False
+
         loop = asyncio.get_event_loop()
-        details = " from {}".format(self._remoteName(buildId, ARTIFACT_SUFFIX))
+        details = " from {}".format(remoteName)
         with stepAction(step, "DOWNLOAD", content, details=details) as a:
+            fetched = None
+            start = time.monotonic()
             try:
-                ret, msg, kind = await loop.run_in_executor(None, BaseArchive._downloadPackage,
-                    self, buildId, audit, content)
-                if not ret: a.fail(msg, kind)
+                # Chunked artifacts are fetched piecewise by the executor
+                if not self.__chunked:
+                    fetched = await self._fetchFile(buildId, ARTIFACT_SUFFIX)
+                (ret, msg, kind), meter = await loop.run_in_executor(None,
+                    BaseArchive._runMetered, self, "_downloadPackage", buildId,
+                    audit, content, fetched)
+                self.__countFailure(step, remoteName, not ret)
+                if ret:
+                    self.__statistic.addDownload(time.monotonic() - start, meter)
+                else:
+                    self.__statistic.errors += 1
+                    a.fail(msg, kind)
                 return ret
+            except ArtifactNotFoundError:
+                self.__countFailure(step, remoteName, False)
+                self.__setMissing(buildId, ARTIFACT_SUFFIX, True)
+                self.__statistic.misses += 1
+                a.fail("not found", WARNING)
+                return False
+            except ArtifactDownloadError as e:
+                self.__countFailure(step, remoteName, True)
+                self.__statistic.errors += 1
+                a.fail(e.reason, WARNING)
+                return False
+            except BuildError:
+                self.__countFailure(step, remoteName, True)
+                self.__statistic.errors += 1
+                raise
             except (concurrent.futures.CancelledError, concurrent.futures.process.BrokenProcessPool):
                 raise BuildError("Download of package interrupted.")
+            finally:
+                if fetched is not None: os.unlink(fetched)
+
+    async def _fetchFile(self, buildId, suffix):
+        """Download a file of the archive directly in the event loop.
+
+        Returns the name of a temporary file with the content. The caller
+        removes the file. Backends that do not support asynchronous downloads
+        return None. The file is then opened by _openDownloadFile() in the
+        executor instead. Must raise ArtifactNotFoundError if the file does
+        not exist and ArtifactDownloadError on other errors.
+        """
+        return None
 
-    def _downloadPackage(self, buildId, audit, content):
+    async def _statFilesAsync(self, buildIds, suffix):
+        """Asynchronous variant of _statFiles().
+
+        Returns None if the backend does not support it.
+        """
+        return None
+
+    def _setCache(self, cache):
+        """Fill the given ArchiveCache with all downloaded files."""
+        self.__cache = cache
+
+    def __openCachedDownloadFile(self, buildId, suffix, fetched=None):
+        if fetched is not None:
+            ret = LocalArchiveDownloader(fetched)
+        else:
+            ret = self._openDownloadFile(buildId, suffix)
+        if self.__cache is not None:
+            ret = ArchiveCacheFiller(self.__cache, ret, buildId, suffix)
+        return ret
+
+    def __readChunkFile(self, buildId, suffix):
+        """Read a file of a chunked artifact.
+
+        Files are taken from the archive cache if possible. Unlike regular
+        artifacts the chunks are not looked up in the cache by the
+        MultiArchive.
+        """
+        if (self.__cache is not None) and self.__cache.contains(buildId, suffix):
+            try:
+                with self.__cache._openDownloadFile(buildId, suffix) as (name, fileobj):
+                    return readFileOrHandle(name, fileobj)
+            except (ArtifactNotFoundError, OSError):
+                pass # evicted concurrently
+        with self.__openCachedDownloadFile(buildId, suffix) as (name, fileobj):
+            return readFileOrHandle(name, fileobj)
+
+    def __fetchChunk(self, chunkId):
+        try:
+            data = zlib.decompress(self.__readChunkFile(chunkId, CHUNK_SUFFIX))
+        except ArtifactNotFoundError:
+            raise ArtifactDownloadError("chunk {} missing".format(asHexStr(chunkId)))
+        except zlib.error:
+            data = None
+        if (data is None) or (hashlib.sha1(data).digest() != chunkId):
+            raise ArtifactDownloadError("chunk {} corrupted".format(asHexStr(chunkId)))
+        return data
+
+    def _downloadPackage(self, buildId, audit, content, fetched=None, meter=None,
+                         suffix=ARTIFACT_SUFFIX):
         # restore signals to default so that Ctrl+C kills us
         signal.signal(signal.SIGINT, signal.SIG_DFL)
 
+        # ArtifactNotFoundError is passed to the caller to record the miss
+
         try:
-            with self._openDownloadFile(buildId, ARTIFACT_SUFFIX) as (name, fileobj):
-                with tarfile.open(name, "r|*", fileobj=fileobj, errorlevel=1) as tar:
+            if suffix != ARTIFACT_SUFFIX:
+                # Sources are always plain tarballs and are never cached
+                download = self._openDownloadFile(buildId, suffix)
+            elif self._installUnpackedPackage(buildId, audit, content):
+                return (True, None, None)
+            else:
+                download = None
+
+            if (download is None) and self.__chunked:
+                try:
+                    manifest = self.__readChunkFile(buildId, CHUNKS_SUFFIX)
+                except ArtifactNotFoundError:
+                    manifest = None # try regular artifact
+                if manifest is not None:
+                    self.__extractChunkedPackage(manifest, audit, content)
+                    return (True, None, None)
+
+            if download is None:
+                download = self.__openCachedDownloadFile(buildId, ARTIFACT_SUFFIX, fetched)
+            with contextlib.ExitStack() as stack:
+                (name, fileobj) = stack.enter_context(download)
+                if fileobj is None:
+                    fileobj = stack.enter_context(open(name, "rb"))
+                if meter is not None:
+                    fileobj = meter.wrap(fileobj)
+                with openArtifactReader(fileobj) as tar:
                     removePath(audit)
                     removePath(content)
                     os.makedirs(content)
                     self.__extractPackage(tar, audit, content)
             return (True, None, None)
-        except ArtifactNotFoundError:
-            return (False, "not found", WARNING)
         except ArtifactDownloadError as e:
             return (False, e.reason, WARNING)
         except BuildError as e:
@@ -216,30 +800,331 @@ class BaseArchive:
         except tarfile.TarError as e:
             raise BuildError("Error extracting binary artifact: " + str(e))
 
+    def _installUnpackedPackage(self, buildId, audit, content):
+        """Install a package directly from an unpacked artifact.
+
+        Returns False if the backend holds no unpacked artifact of the
+        package. The regular artifact is downloaded in this case.
+        """
+        return False
+
+    def __extractChunkedPackage(self, data, audit, content):
+        try:
+            manifest = json.loads(gzip.decompress(data).decode("utf8"))
+            if manifest.get("version") != 1:
+                raise BuildError("Unsupported binary artifact")
+            auditChunk = bytes.fromhex(manifest["audit"])
+            entries = manifest["entries"]
+            links = set()
+            for e in entries:
+                if e["type"] not in ("dir", "file", "link") or \
+                   not isSafeChunkPath(e["path"], links):
+                    raise BuildError("Invalid entry in binary artifact: " + str(e["path"]))
+                if e["type"] == "link": links.add(e["path"])
+        except (OSError, EOFError, ValueError, KeyError, TypeError, AttributeError) as e:
+            raise BuildError("Invalid chunked binary artifact: " + str(e))
+
+        # Keep the previous content until the new one is complete. Chunks
+        # that did not change are copied from the old files instead of
+        # downloading them again.
+        removePath(audit)
+        parent = os.path.dirname(os.path.abspath(content))
+        os.makedirs(parent, exist_ok=True)
+        tmp = mkdtemp(dir=parent, prefix="tmp-")
+        oldContent = os.path.join(tmp, "content")
+        try:
+            if os.path.lexists(content): os.rename(content, oldContent)
+            os.makedirs(content)
+            try:
+                auditData = self.__fetchChunk(auditChunk)
+                self.__populateChunked(entries, content, oldContent)
+                with open(audit, "wb") as f:
+                    f.write(auditData)
+            except:
+                removePath(content)
+                if os.path.lexists(oldContent):
+                    os.rename(oldContent, content)
+                else:
+                    os.makedirs(content)
+                raise
+        finally:
+            removePath(tmp)
+
+    def __populateChunked(self, entries, content, oldContent):
+        # Index the chunks of the old files at the same paths. The chunk
+        # boundaries only depend on the content. Hence unchanged parts of the
+        # files are found even if data was inserted or removed before them.
+        local = {}
+        for e in entries:
+            if e["type"] != "file": continue
+            oldFile = os.path.join(oldContent, e["path"])
+            if not os.path.isfile(oldFile) or os.path.islink(oldFile): continue
+            with open(oldFile, "rb") as f:
+                offset = 0
+                for data in iterChunks(f):
+                    local.setdefault(hashlib.sha1(data).digest(), (oldFile, offset, len(data)))
+                    offset += len(data)
+
+        # All other chunks are downloaded in the order of their first use.
+        fetch = []
+        seen = set(local)
+        for e in entries:
+            for c in e.get("chunks", []):
+                c = bytes.fromhex(c)
+                if c in seen: continue
+                seen.add(c)
+                fetch.append(c)
+
+        dirs = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=CHUNK_STREAMS) as executor:
+            pending = collections.deque()
+            todo = iter(fetch)
+            def nextChunk():
+                for c in todo:
+                    pending.append(executor.submit(self.__fetchChunk, c))
+                    if len(pending) >= 2*CHUNK_STREAMS: break
+                return pending.popleft().result()
+
+            try:
+                for e in entries:
+                    path = os.path.join(content, e["path"])
+                    if e["type"] == "dir":
+                        os.makedirs(path, exist_ok=True)
+                        dirs.append((path, e))
+                    elif e["type"] == "link":
+                        os.symlink(e["target"], path)
+                    else:
+                        with open(path, "wb") as f:
+                            offset = 0
+                            for c in e["chunks"]:
+                                c = bytes.fromhex(c)
+                                src = local.get(c)
+                                if src is None:
+                                    data = nextChunk()
+                                    local[c] = (path, offset, len(data))
+                                else:
+                                    if src[0] == path: f.flush()
+                                    with open(src[0], "rb") as old:
+                                        old.seek(src[1])
+                                        data = old.read(src[2])
+                                f.write(data)
+                                offset += len(data)
+                        os.chmod(path, e["mode"])
+                        os.utime(path, (e["mtime"], e["mtime"]))
+            finally:
+                for i in pending: i.cancel()
+
+        for (path, e) in reversed(dirs):
+            os.chmod(path, e["mode"])
+            os.utime(path, (e["mtime"], e["mtime"]))
+
+    def _statFile(self, buildId, suffix):
+        """Get size of an artifact without downloading it.
+
+        Returns the size in bytes or None if the size is unknown. Must raise
+        ArtifactNotFoundError if the artifact does not exist. Raises
+        ArtifactDownloadError if the existence cannot be determined.
+        """
+        raise ArtifactDownloadError("not supported")
+
+    async def queryPackage(self, step, buildId):
+        """Check if a package exists in the archive.
+
+        Returns a tuple (exists, size). 'exists' is None if it cannot be
+        determined without downloading the package. The size is None if it is
+        not known.
+        """
+        if not self.canDownloadLocal():
+            return (False, None)
+
+        loop = asyncio.get_event_loop()
+        with stepAction(step, "LOOKUP", self._remoteName(buildId, ARTIFACT_SUFFIX), (INFO,TRACE)) as a:
+            if self.__isMissing(buildId, ARTIFACT_SUFFIX):
+                a.setResult("not found (cached)", WARNING)
+                return (False, None)
+            try:
+                ret = await self.__statPackagesAsync([buildId])
+                if ret is not None:
+                    ret = ret[0]
+                else:
+                    ret = await loop.run_in_executor(None, BaseArchive._queryPackage,
+                        self, buildId)
+                if ret[0] is None:
+                    a.setResult("unknown", WARNING)
+                elif not ret[0]:
+                    self.__setMissing(buildId, ARTIFACT_SUFFIX, True)
+                    a.setResult("not found", WARNING)
+                return ret
+            except (concurrent.futures.CancelledError, concurrent.futures.process.BrokenProcessPool):
+                raise BuildError("Query of package interrupted.")
+
+    def _queryPackage(self, buildId):
+        # restore signals to default so that Ctrl+C kills us
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        return self.__statPackages([buildId])[0]
+
+    async def __statPackagesAsync(self, buildIds):
+        # Only regular artifacts are looked up in the event loop
+        if self.__chunked: return None
+        return await self._statFilesAsync(buildIds, ARTIFACT_SUFFIX)
+
+    def __statPackages(self, buildIds):
+        if not self.__chunked:
+            return self._statFiles(buildIds, ARTIFACT_SUFFIX)
+
+        # Chunked archives may still hold regular artifacts. The size of
+        # chunked artifacts is not known.
+        ret = [ (exists, None) for (exists, size) in self._statFiles(buildIds, CHUNKS_SUFFIX) ]
+        missing = [ i for (i, (exists, size)) in enumerate(ret) if not exists ]
+        regular = self._statFiles([ buildIds[i] for i in missing ], ARTIFACT_SUFFIX)
+        for (i, (exists, size)) in zip(missing, regular):
+            if exists is not False: ret[i] = (exists, size)
+        return ret
+
+    def _manifestName(self):
+        return MANIFEST_FILE
+
+    def _openManifestFile(self):
+        """Open the manifest of the archive.
+
+        Same protocol as _openDownloadFile(). Only supported by some backends.
+        """
+        raise ArtifactDownloadError("not supported")
+
+    def _statFiles(self, buildIds, suffix):
+        """Get the sizes of multiple artifacts.
+
+        Returns a list of (exists, size) tuples in the order of 'buildIds'.
+        Backends may override this to query the artifacts in parallel.
+        """
+        ret = []
+        for buildId in buildIds:
+            try:
+                ret.append((True, self._statFile(buildId, suffix)))
+            except ArtifactNotFoundError:
+                ret.append((False, None))
+            except (ArtifactDownloadError, OSError):
+                ret.append((None, None))
+        return ret
+
+    async def queryPackages(self, step, buildIds):
+        """Check if multiple packages exist in the archive.
+
+        Returns a dict that maps every build-id to an (exists, size) tuple
+        like queryPackage(). If the archive has a manifest it is downloaded
+        once and all subsequent queries are answered from it. Otherwise the
+        archive is queried by a single job for all packages.
+        """
+        if not self.canDownloadLocal() or not buildIds:
+            return { bid : (False, None) for bid in buildIds }
+
+        loop = asyncio.get_event_loop()
+        try:
+            if self.__useManifest and (self.__manifest is None):
+                with stepAction(step, "MANIFEST", self._manifestName(), (INFO,TRACE)) as a:
+                    ret, msg = await loop.run_in_executor(None,
+                        BaseArchive._downloadManifest, self)
+                    if ret is None: a.fail(msg, WARNING)
+                    self.__manifest = ret if ret is not None else False
+            if isinstance(self.__manifest, dict):
+                ret = {}
+                for bid in buildIds:
+                    name = buildIdToName(bid)
+                    if name + ARTIFACT_SUFFIX in self.__manifest:
+                        ret[bid] = (True, self.__manifest[name + ARTIFACT_SUFFIX])
+                    elif self.__chunked and (name + CHUNKS_SUFFIX in self.__manifest):
+                        ret[bid] = (True, None)
+                    elif name + UNPACKED_SUFFIX in self.__manifest:
+                        ret[bid] = (True, None)
+                    else:
+                        ret[bid] = (False, None)
+                return ret
+
+            ret = { bid : (False, None) for bid in buildIds
+                    if self.__isMissing(bid, ARTIFACT_SUFFIX) }
+            todo = [ bid for bid in buildIds if bid not in ret ]
+            if len(todo) == 1:
+                ret[todo[0]] = await self.queryPackage(step, todo[0])
+            elif todo:
+                with stepAction(step, "LOOKUP", "{} artifacts".format(len(todo)),
+                                (INFO,TRACE)) as a:
+                    results = await self.__statPackagesAsync(todo)
+                    if results is None:
+                        results = await loop.run_in_executor(None, BaseArchive._queryPackages,
+                            self, todo)
+                    for (bid, result) in zip(todo, results):
+                        if result[0] is False: self.__setMissing(bid, ARTIFACT_SUFFIX, True)
+                        ret[bid] = result
+                    missing = sum(1 for (exists, size) in results if not exists)
+                    if missing: a.setResult("{} not found".format(missing), WARNING)
+            return ret
+        except (concurrent.futures.CancelledError, concurrent.futures.process.BrokenProcessPool):
+            raise BuildError("Query of packages interrupted.")
+
+    def _queryPackages(self, buildIds):
+        # restore signals to default so that Ctrl+C kills us
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        return self.__statPackages(buildIds)
+
+    def _downloadManifest(self):
+        # restore signals to default so that Ctrl+C kills us
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+        try:
+            with self._openManifestFile() as (name, fileobj):
+                return (parseManifest(readFileOrHandle(name, fileobj)), None)
+        except ArtifactNotFoundError:
+            return (None, "not found")
+        except ArtifactDownloadError as e:
+            return (None, e.reason)
+        except (OSError, ValueError) as e:
+            return (None, str(e))
+
     async def downloadLocalLiveBuildId(self, step, liveBuildId):
         if not self.canDownloadLocal():
             return None
 
         loop = asyncio.get_event_loop()
-        with stepAction(step, "MAP-SRC", self._remoteName(liveBuildId, BUILDID_SUFFIX), (INFO,TRACE)) as a:
+        remoteName = self._remoteName(liveBuildId, BUILDID_SUFFIX)
+        with stepAction(step, "MAP-SRC", remoteName, (INFO,TRACE)) as a:
+            if self.__isMissing(liveBuildId, BUILDID_SUFFIX):
+                a.fail("not found (cached)", WARNING)
+                return None
+            fetched = None
             try:
+                fetched = await self._fetchFile(liveBuildId, BUILDID_SUFFIX)
                 ret, msg, kind = await loop.run_in_executor(None,
-                    BaseArchive._downloadLocalLiveBuildId, self, liveBuildId)
+                    BaseArchive._downloadLocalLiveBuildId, self, liveBuildId, fetched)
+                self.__countFailure(step, remoteName, not ret)
                 if not ret: a.fail(msg, kind)
                 return ret
+            except ArtifactNotFoundError:
+                self.__countFailure(step, remoteName, False)
+                self.__setMissing(liveBuildId, BUILDID_SUFFIX, True)
+                a.fail("not found", WARNING)
+                return None
+            except ArtifactDownloadError as e:
+                self.__countFailure(step, remoteName, True)
+                a.fail(e.reason, WARNING)
+                return None
+            except BuildError:
+                self.__countFailure(step, remoteName, True)
+                raise
             except (concurrent.futures.CancelledError, concurrent.futures.process.BrokenProcessPool):
                 raise BuildError("Download of build-id interrupted.")
+            finally:
+                if fetched is not None: os.unlink(fetched)
 
-    def _downloadLocalLiveBuildId(self, liveBuildId):
+    def _downloadLocalLiveBuildId(self, liveBuildId, fetched=None):
         # restore signals to default so that Ctrl+C kills us
         signal.signal(signal.SIGINT, signal.SIG_DFL)
 
+        # ArtifactNotFoundError is passed to the caller to record the miss
         try:
-            with self._openDownloadFile(liveBuildId, BUILDID_SUFFIX) as (name, fileobj):
+            with self.__openCachedDownloadFile(liveBuildId, BUILDID_SUFFIX, fetched) \
+                    as (name, fileobj):
                 ret = readFileOrHandle(name, fileobj)
             return (ret, None, None)
-        except ArtifactNotFoundError:
-            return (None, "not found", WARNING)
         except ArtifactDownloadError as e:
             return (None, e.reason, WARNING)
         except BuildError as e:
@@ -255,23 +1140,52 @@ class BaseArchive:
             return
 
         loop = asyncio.get_event_loop()
-        details = " to {}".format(self._remoteName(buildId, ARTIFACT_SUFFIX))
+        remoteName = self._remoteName(buildId, ARTIFACT_SUFFIX)
+        details = " to {}".format(remoteName)
         with stepAction(step, "UPLOAD", content, details=details) as a:
+            start = time.monotonic()
             try:
-                msg, kind = await loop.run_in_executor(None, BaseArchive._uploadPackage, self, buildId, audit, content)
+                (msg, kind), meter = await loop.run_in_executor(None,
+                    BaseArchive._runMetered, self, "_uploadPackage", buildId, audit, content)
+                self.__countFailure(step, remoteName, kind == ERROR)
+                if kind == EXECUTED:
+                    self.__statistic.addUpload(time.monotonic() - start, meter)
+                elif kind == SKIPPED:
+                    self.__statistic.uploadsSkipped += 1
+                else:
+                    self.__statistic.errors += 1
+                if kind in (EXECUTED, SKIPPED):
+                    self.__setMissing(buildId, ARTIFACT_SUFFIX, False)
                 a.setResult(msg, kind)
             except (concurrent.futures.CancelledError, concurrent.futures.process.BrokenProcessPool):
                 raise BuildError("Upload of package interrupted.")
 
-    def _uploadPackage(self, buildId, audit, content):
+    def _uploadPackage(self, buildId, audit, content, meter=None, suffix=ARTIFACT_SUFFIX):
         # restore signals to default so that Ctrl+C kills us
         signal.signal(signal.SIGINT, signal.SIG_DFL)
 
         try:
-            with self._openUploadFile(buildId, ARTIFACT_SUFFIX) as (name, fileobj):
-                pax = { 'bob-archive-vsn' : "1" }
-                with gzip.open(name or fileobj, 'wb', 6) as gzf:
-                    with tarfile.open(name, "w", fileobj=gzf,
+            # Sources are always uploaded as plain tarballs
+            if suffix == ARTIFACT_SUFFIX:
+                if self._storeUnpackedPackage(buildId, audit, content):
+                    return ("ok", EXECUTED)
+
+                if self.__chunked:
+                    num = self.__uploadChunkedPackage(buildId, audit, content)
+                    return ("ok ({} new chunks)".format(num), EXECUTED)
+
+            with contextlib.ExitStack() as stack:
+                (name, fileobj) = stack.enter_context(
+                    self._openUploadFile(buildId, suffix))
+                if fileobj is None:
+                    fileobj = stack.enter_context(open(name, "wb"))
+                if meter is not None:
+                    fileobj = meter.wrap(fileobj)
+                # Keep gzip compressed artifacts readable by older versions.
+                pax = { 'bob-archive-vsn' : "1" if self.__compressMethod == "gzip" else "2" }
+                with openCompressedWriter(fileobj, self.__compressMethod,
+                                          self.__compressLevel, self.__compressThreads) as cf:
+                    with tarfile.open(None, "w", fileobj=cf,
                                       format=tarfile.PAX_FORMAT, pax_headers=pax) as tar:
                         tar.add(audit, "meta/" + os.path.basename(audit))
                         tar.add(content, arcname="content")
@@ -284,14 +1198,163 @@ class BaseArchive:
                 raise BuildError("Cannot upload artifact: " + str(e))
         return ("ok", EXECUTED)
 
+    async def uploadSources(self, step, sourceId, audit, content):
+        """Upload the workspace of a checkout step for a remote build.
+
+        Sources are stored with their own suffix. Hence they are never
+        mistaken for a package. They do not use the archive cache, the miss
+        cache or the archive statistics.
+        """
+        if not self.canUploadLocal():
+            return
+
+        loop = asyncio.get_event_loop()
+        remoteName = self._remoteName(sourceId, SOURCES_SUFFIX)
+        with stepAction(step, "UPLOAD", content, details=" to {}".format(remoteName)) as a:
+            try:
+                msg, kind = await loop.run_in_executor(None, BaseArchive._uploadSources,
+                    self, sourceId, audit, content)
+                self.__countFailure(step, remoteName, kind == ERROR)
+                a.setResult(msg, kind)
+            except (concurrent.futures.CancelledError, concurrent.futures.process.BrokenProcessPool):
+                raise BuildError("Upload of sources interrupted.")
+
+    def _uploadSources(self, sourceId, audit, content):
+        return self._uploadPackage(sourceId, audit, content, suffix=SOURCES_SUFFIX)
+
+    async def downloadSources(self, step, sourceId, audit, content):
+        """Download the workspace of a checkout step of a remote build."""
+        if not self.canDownloadLocal():
+            return False
+
+        loop = asyncio.get_event_loop()
+        remoteName = self._remoteName(sourceId, SOURCES_SUFFIX)
+        with stepAction(step, "DOWNLOAD", content, details=" from {}".format(remoteName)) as a:
+            try:
+                (ret, msg, kind) = await loop.run_in_executor(None, BaseArchive._downloadSources,
+                    self, sourceId, audit, content)
+                self.__countFailure(step, remoteName, not ret)
+                if not ret: a.fail(msg, kind)
+                return ret
+            except ArtifactNotFoundError:
+                self.__countFailure(step, remoteName, False)
+                a.fail("not found", WARNING)
+                return False
+            except BuildError:
+                self.__countFailure(step, remoteName, True)
+                raise
+            except (concurrent.futures.CancelledError, concurrent.futures.process.BrokenProcessPool):
+                raise BuildError("Download of sources interrupted.")
+
+    def _downloadSources(self, sourceId, audit, content):
+        return self._downloadPackage(sourceId, audit, content, suffix=SOURCES_SUFFIX)
+
+    def _storeUnpackedPackage(self, buildId, audit, content):
+        """Store a package as unpacked artifact.
+
+        Returns False if the backend does not store unpacked artifacts. Must
+        raise ArtifactExistsError if the package is already in the archive.
+        """
+        return False
+
+    def __exists(self, buildId, suffix):
+        try:
+            self._statFile(buildId, suffix)
+            return True
+        except (ArtifactNotFoundError, ArtifactDownloadError, OSError):
+            return False
+
+    def __uploadChunk(self, chunkId, data):
+        try:
+            with self._openUploadFile(chunkId, CHUNK_SUFFIX) as (name, fileobj):
+                writeFileOrHandle(name, fileobj, zlib.compress(data))
+            return 1
+        except ArtifactExistsError:
+            return 0
+
+    def __uploadChunkedPackage(self, buildId, audit, content):
+        """Upload a package as chunked artifact.
+
+        The manifest is uploaded last so that it is only visible if all chunks
+        are available. Chunks that are already in the archive are skipped.
+        Returns the number of uploaded chunks.
+        """
+        if self.__exists(buildId, CHUNKS_SUFFIX): raise ArtifactExistsError()
+
+        entries = []
+        known = set()
+        uploaded = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=CHUNK_STREAMS) as executor:
+            pending = collections.deque()
+            def addChunk(data):
+                nonlocal uploaded
+                chunkId = hashlib.sha1(data).digest()
+                if chunkId not in known:
+                    known.add(chunkId)
+                    pending.append(executor.submit(self.__uploadChunk, chunkId, data))
+                    while len(pending) > 2*CHUNK_STREAMS:
+                        uploaded += pending.popleft().result()
+                return asHexStr(chunkId)
+
+            try:
+                for root, dirs, files in os.walk(content):
+                    rel = os.path.relpath(root, content)
+                    if rel == ".": rel = ""
+                    for d in dirs[:]:
+                        if os.path.islink(os.path.join(root, d)):
+                            # symlinks to directories are stored like files
+                            dirs.remove(d)
+                            files.append(d)
+                    dirs.sort()
+                    for d in dirs:
+                        st = os.lstat(os.path.join(root, d))
+                        entries.append({ "type" : "dir", "path" : os.path.join(rel, d),
+                            "mode" : stat.S_IMODE(st.st_mode), "mtime" : st.st_mtime })
+                    for f in sorted(files):
+                        name = os.path.join(root, f)
+                        st = os.lstat(name)
+                        if stat.S_ISLNK(st.st_mode):
+                            entries.append({ "type" : "link", "path" : os.path.join(rel, f),
+                                "target" : os.readlink(name) })
+                        elif stat.S_ISREG(st.st_mode):
+                            chunks = []
+                            with open(name, "rb") as fd:
+                                for data in iterChunks(fd):
+                                    chunks.append(addChunk(data))
+                            entries.append({ "type" : "file", "path" : os.path.join(rel, f),
+                                "mode" : stat.S_IMODE(st.st_mode), "mtime" : st.st_mtime,
+                                "chunks" : chunks })
+                        else:
+                            raise ArtifactUploadError("unsupported file type: " + name)
+                with open(audit, "rb") as fd:
+                    auditChunk = addChunk(fd.read())
+                while pending:
+                    uploaded += pending.popleft().result()
+            finally:
+                for i in pending: i.cancel()
+
+        manifest = {
+            "version" : 1,
+            "audit" : auditChunk,
+            "entries" : entries,
+        }
+        with self._openUploadFile(buildId, CHUNKS_SUFFIX) as (name, fileobj):
+            writeFileOrHandle(name, fileobj, gzip.compress(
+                json.dumps(manifest, sort_keys=True).encode("utf8")))
+        return uploaded
+
     async def uploadLocalLiveBuildId(self, step, liveBuildId, buildId):
         if not self.canUploadLocal():
             return
 
         loop = asyncio.get_event_loop()
-        with stepAction(step, "CACHE-BID", self._remoteName(liveBuildId, BUILDID_SUFFIX), (INFO,TRACE)) as a:
+        remoteName = self._remoteName(liveBuildId, BUILDID_SUFFIX)
+        with stepAction(step, "CACHE-BID", remoteName, (INFO,TRACE)) as a:
             try:
                 msg, kind = await loop.run_in_executor(None, BaseArchive._uploadLocalLiveBuildId, self, liveBuildId, buildId)
+                self.__countFailure(step, remoteName, kind == ERROR)
+                if kind in (EXECUTED, SKIPPED):
+                    self.__setMissing(liveBuildId, BUILDID_SUFFIX, False)
                 a.setResult(msg, kind)
             except (concurrent.futures.CancelledError, concurrent.futures.process.BrokenProcessPool):
                 raise BuildError("Upload of build-id interrupted.")
@@ -312,11 +1375,17 @@ class BaseArchive:
                 raise BuildError("Cannot upload build-id: " + str(e))
         return ("ok", EXECUTED)
 
+    async def finish(self):
+        """Wait for all operations that still run in the background."""
+        pass
+
 
 class LocalArchive(BaseArchive):
     def __init__(self, spec):
         super().__init__(spec)
         self.__basePath = os.path.abspath(spec["path"])
+        self.__unpacked = spec.get("unpacked", False)
+        self.__linkMethod = spec.get("linkMethod", "copy")
 
     def _getPath(self, buildId, suffix):
         packageResultId = buildIdToName(buildId)
@@ -329,6 +1398,9 @@ class LocalArchive(BaseArchive):
     def _remoteName(self, buildId, suffix):
         return self._getPath(buildId, suffix)[1]
 
+    def _archiveName(self):
+        return self.__basePath
+
     def _openDownloadFile(self, buildId, suffix):
         (packageResultPath, packageResultFile) = self._getPath(buildId, suffix)
         if os.path.isfile(packageResultFile):
@@ -336,6 +1408,77 @@ class LocalArchive(BaseArchive):
         else:
             raise ArtifactNotFoundError()
 
+    def _statFile(self, buildId, suffix):
+        if (suffix == ARTIFACT_SUFFIX) and \
+           os.path.isdir(self._getPath(buildId, UNPACKED_SUFFIX)[1]):
+            return None
+        (packageResultPath, packageResultFile) = self._getPath(buildId, suffix)
+        try:
+            return os.stat(packageResultFile).st_size
+        except FileNotFoundError:
+            raise ArtifactNotFoundError()
+
+    def _installUnpackedPackage(self, buildId, audit, content):
+        # Unpacked artifacts are used regardless of the 'unpacked' setting
+        # which only controls the uploads.
+        entry = self._getPath(buildId, UNPACKED_SUFFIX)[1]
+        if not os.path.isdir(entry):
+            return False
+
+        removePath(audit)
+        removePath(content)
+        os.makedirs(content)
+        if self.__linkMethod == "hardlink":
+            linkTree(os.path.join(entry, "content"), content)
+        else:
+            copyFiles(os.path.join(entry, "content"), content)
+        shutil.copyfile(os.path.join(entry, "audit.json.gz"), audit)
+        return True
+
+    def _storeUnpackedPackage(self, buildId, audit, content):
+        """Store the package as write protected directory tree.
+
+        The files are copied (or cloned if supported by the file system) so
+        that the archive is independent of the workspace. The tree is created
+        in a temporary directory and renamed into place at the end.
+        """
+        if not self.__unpacked:
+            return False
+
+        (packageResultPath, entry) = self._getPath(buildId, UNPACKED_SUFFIX)
+        if os.path.isdir(entry) or \
+           os.path.isfile(self._getPath(buildId, ARTIFACT_SUFFIX)[1]):
+            raise ArtifactExistsError()
+
+        os.makedirs(packageResultPath, exist_ok=True)
+        tmp = mkdtemp(dir=packageResultPath, prefix=".tmp-")
+        try:
+            umask = os.umask(0o022)
+            os.umask(umask)
+            os.chmod(tmp, 0o777 & ~umask)
+            os.mkdir(os.path.join(tmp, "content"))
+            copyFiles(content, os.path.join(tmp, "content"))
+            shutil.copyfile(audit, os.path.join(tmp, "audit.json.gz"))
+            writeProtectTree(tmp)
+            try:
+                os.rename(tmp, entry)
+            except OSError:
+                # Somebody else was faster?
+                if not os.path.isdir(entry): raise
+                raise ArtifactExistsError()
+        finally:
+            if os.path.exists(tmp): removePath(tmp)
+        return True
+
+    def _manifestName(self):
+        return os.path.join(self.__basePath, MANIFEST_FILE)
+
+    def _openManifestFile(self):
+        if os.path.isfile(self._manifestName()):
+            return LocalArchiveDownloader(self._manifestName())
+        else:
+            raise ArtifactNotFoundError()
+
     def _openUploadFile(self, buildId, suffix):
         (packageResultPath, packageResultFile) = self._getPath(buildId, suffix)
         if os.path.isfile(packageResultFile):
@@ -442,22 +1585,399 @@ class LocalArchiveUploader:
         return False
 
 
+class HttpConnectionPool:
+    """Thread safe pool of keep-alive connections to a HTTP(S) server.
+
+    Every thread checks out its own connection for the duration of a request.
+    Idle connections are kept for later requests up to the size of the pool.
+    Before an idle connection is reused it is checked that the server did not
+    close it in the meantime.
+    """
+
+    MAX_IDLE_TIME = 60
+
+    def __init__(self, url, sslVerify, size):
+        self.__url = url
+        self.__sslVerify = sslVerify
+        self.__size = size
+        self.__idle = []
+        self.__lock = threading.Lock()
+        self.__pid = os.getpid()
+
+    def __connect(self):
+        url = self.__url
+        if url.scheme == 'http':
+            connection = http.client.HTTPConnection(url.hostname, url.port)
+        elif url.scheme == 'https':
+            ctx = None if self.__sslVerify else ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            connection = http.client.HTTPSConnection(url.hostname, url.port,
+                                                     context=ctx)
+        else:
+            raise BuildError("Unsupported URL scheme: '{}'".format(url.scheme))
+        return connection
+
+    @staticmethod
+    def __isHealthy(connection, lastUse):
+        if connection.sock is None:
+            return False
+        if time.monotonic() - lastUse > HttpConnectionPool.MAX_IDLE_TIME:
+            return False
+        # An idle connection must not be readable. Otherwise the server has
+        # closed it or sent garbage.
+        try:
+            readable, _, _ = select.select([connection.sock], [], [], 0)
+            return not readable
+        except (OSError, ValueError):
+            return False
+
+    def checkout(self):
+        with self.__lock:
+            if self.__pid != os.getpid():
+                # forked: the connections belong to the parent process
+                self.__idle = []
+                self.__pid = os.getpid()
+            while self.__idle:
+                (connection, lastUse) = self.__idle.pop()
+                if self.__isHealthy(connection, lastUse):
+                    return connection
+                connection.close()
+        return self.__connect()
+
+    def checkin(self, connection):
+        with self.__lock:
+            if len(self.__idle) < self.__size and connection.sock is not None:
+                self.__idle.append((connection, time.monotonic()))
+                return
+        connection.close()
+
+_httpPools = {}
+_httpPoolsLock = threading.Lock()
+
+def getHttpConnectionPool(url, sslVerify, size):
+    """Get the connection pool of the current process for a server."""
+    key = (url.scheme, url.hostname, url.port, sslVerify)
+    with _httpPoolsLock:
+        pool = _httpPools.get(key)
+        if pool is None:
+            pool = _httpPools[key] = HttpConnectionPool(url, sslVerify, size)
+    return pool
+
+class AsyncHttpResponse:
+    """Response of an AsyncHttpClient request.
+
+    The body is read incrementally by read(). Data is only taken from the
+    connection when it is requested. The transport stops reading from the
+    socket if the buffer is full, which throttles the server accordingly.
+    """
+
+    def __init__(self, reader, writer, status, reason, headers, hasBody):
+        self.connection = (reader, writer)
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.__reader = reader
+        self.__chunked = False
+        self.__left = 0
+        self.__eof = False
+        self.complete = not hasBody
+        self.willClose = (headers.get("Connection", "").lower() == "close")
+        if not hasBody:
+            pass
+        elif headers.get("Transfer-Encoding", "").lower() == "chunked":
+            self.__chunked = True
+        elif headers.get("Content-Length", "").strip().isdigit():
+            self.__left = int(headers["Content-Length"])
+            self.complete = (self.__left == 0)
+        else:
+            # body is delimited by the end of the connection
+            self.__eof = True
+            self.willClose = True
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    async def __nextChunk(self):
+        line = await self.__reader.readline()
+        try:
+            self.__left = int(line.split(b";", 1)[0], 16)
+        except ValueError:
+            raise http.client.IncompleteRead(line)
+        if self.__left == 0:
+            # skip trailers
+            while line not in (b"\r\n", b"\n", b""):
+                line = await self.__reader.readline()
+            if not line: raise http.client.IncompleteRead(b"")
+            self.complete = True
+
+    async def read(self, size=64*1024):
+        """Read the next part of the body. Returns b'' at the end."""
+        if self.complete: return b""
+        if self.__eof:
+            data = await self.__reader.read(size)
+            if not data: self.complete = True
+            return data
+        if self.__chunked and self.__left == 0:
+            await self.__nextChunk()
+            if self.complete: return b""
+        data = await self.__reader.read(min(size, self.__left))
+        if not data: raise http.client.IncompleteRead(b"", self.__left)
+        self.__left -= len(data)
+        if self.__left == 0:
+            if self.__chunked:
+                await self.__reader.readexactly(2) # CRLF after chunk
+            else:
+                self.complete = True
+        return data
+
+    async def readall(self):
+        ret = []
+        while True:
+            data = await self.read()
+            if not data: break
+            ret.append(data)
+        return b"".join(ret)
+
+class AsyncHttpClient:
+    """HTTP/1.1 client on top of asyncio streams.
+
+    Requests are executed in the event loop of the main process. This allows
+    many concurrent transfers without blocking threads or processes. The
+    number of concurrent connections is limited to MAX_CONNECTIONS. Idle
+    keep-alive connections are kept like in HttpConnectionPool.
+    """
+
+    MAX_CONNECTIONS = 32
+    MAX_IDLE_TIME = 60
+
+    def __init__(self, url, sslVerify, size):
+        self.__url = url
+        self.__sslVerify = sslVerify
+        self.__size = size
+        self.__idle = []
+        self.__loop = None
+        self.__sem = None
+
+    def __bindLoop(self):
+        loop = asyncio.get_event_loop()
+        if self.__loop is not loop:
+            # connections cannot be used across event loops
+            for (reader, writer, lastUse) in self.__idle: writer.close()
+            self.__idle = []
+            self.__loop = loop
+            self.__sem = asyncio.Semaphore(self.MAX_CONNECTIONS)
+
+    async def __connect(self):
+        url = self.__url
+        if url.scheme == 'http':
+            ctx = None
+            port = url.port or http.client.HTTP_PORT
+        elif url.scheme == 'https':
+            ctx = ssl.create_default_context() if self.__sslVerify \
+                    else ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            port = url.port or http.client.HTTPS_PORT
+        else:
+            raise BuildError("Unsupported URL scheme: '{}'".format(url.scheme))
+        return await asyncio.open_connection(url.hostname, port, ssl=ctx)
+
+    def __checkout(self):
+        while self.__idle:
+            (reader, writer, lastUse) = self.__idle.pop()
+            if not reader.at_eof() and \
+               time.monotonic() - lastUse <= self.MAX_IDLE_TIME:
+                return (reader, writer)
+            writer.close()
+        return None
+
+    async def request(self, method, path, headers={}):
+        """Send a request and read the response header.
+
+        The returned response must be passed to release() after its body was
+        read.
+        """
+        self.__bindLoop()
+        await self.__sem.acquire()
+        writer = None
+        try:
+            connection = self.__checkout()
+            if connection is None:
+                connection = await self.__connect()
+            (reader, writer) = connection
+
+            host = self.__url.hostname
+            if self.__url.port is not None: host += ":{}".format(self.__url.port)
+            lines = [ "{} {} HTTP/1.1".format(method, path), "Host: " + host ]
+            lines.extend("{}: {}".format(k, v) for (k, v) in headers.items())
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin1"))
+            await writer.drain()
+
+            statusLine = await reader.readline()
+            if not statusLine:
+                raise http.client.RemoteDisconnected("Remote end closed connection without response")
+            try:
+                (version, status, reason) = (statusLine.decode("latin1").rstrip("\r\n")
+                    .split(None, 2) + [""])[:3]
+                status = int(status)
+            except ValueError:
+                raise http.client.BadStatusLine(statusLine)
+            header = []
+            while True:
+                line = await reader.readline()
+                header.append(line)
+                if line in (b"\r\n", b"\n", b""): break
+            headers = http.client.parse_headers(io.BytesIO(b"".join(header)))
+            hasBody = (method != "HEAD") and (status >= 200) and (status not in (204, 304))
+            return AsyncHttpResponse(reader, writer, status, reason, headers, hasBody)
+        except BaseException:
+            if writer is not None: writer.close()
+            self.__sem.release()
+            raise
+
+    def release(self, response):
+        """Return the connection of a response.
+
+        The connection is kept for further requests if the response was read
+        completely. Otherwise it is closed.
+        """
+        (reader, writer) = response.connection
+        if response.complete and not response.willClose and \
+           len(self.__idle) < self.__size:
+            self.__idle.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+        self.__sem.release()
+
+def parseContentRange(value):
+    """Parse a "Content-Range" header.
+
+    Returns a tuple (first, last, total) or None if the header is invalid. The
+    total is None if the server does not know it.
+    """
+    m = re.fullmatch(r'\s*bytes\s+([0-9]+)-([0-9]+)/([0-9]+|\*)\s*', value or "")
+    if m is None: return None
+    return (int(m.group(1)), int(m.group(2)),
+            int(m.group(3)) if m.group(3) != "*" else None)
+
+class HttpServerError(http.client.HTTPException):
+    """The server answered with a 5xx status. The request may be retried."""
+    pass
+
 class SimpleHttpArchive(BaseArchive):
+    # Size of the segments of parallel downloads
+    SEGMENT_SIZE = 8 * 1024 * 1024
+
     def __init__(self, spec, secureSSL):
         super().__init__(spec)
         self.__url = urllib.parse.urlparse(spec["url"])
-        self.__connection = None
         self.__sslVerify = spec.get("sslVerify", secureSSL)
+        self.__poolSize = spec.get("poolSize", 4)
+        self.__downloadStreams = spec.get("downloadStreams", 4)
+        self.__streamUpload = spec.get("streamUpload", False)
+        self.__retries = spec.get("retries", 1)
+        self.__retryDelay = spec.get("retryDelay", 0)
+        self.__asyncio = spec.get("asyncio", False)
+        self.__asyncClient = None
+
+    def __getstate__(self):
+        # The asynchronous client is bound to the event loop of the main
+        # process.
+        state = super().__getstate__()
+        state["_SimpleHttpArchive__asyncClient"] = None
+        return state
 
     def __retry(self, request):
-        retry = True
+        """Execute a request and retry it on connection and server errors.
+
+        The delay between the attempts is doubled every time, starting with
+        'retryDelay'.
+        """
+        attempt = 0
         while True:
+            connection = self._getConnection()
             try:
-                return (True, request())
+                return (True, request(connection))
             except (http.client.HTTPException, OSError) as e:
-                self._resetConnection()
-                if not retry: return (False, e)
-                retry = False
+                connection.close()
+                if attempt >= self.__retries: return (False, e)
+            if self.__retryDelay:
+                time.sleep(self.__retryDelay * 2 ** attempt)
+            attempt += 1
+
+    async def __retryAsync(self, request):
+        """Asynchronous variant of __retry().
+
+        Returns the result of the request or raises ArtifactDownloadError.
+        """
+        if self.__asyncClient is None:
+            self.__asyncClient = AsyncHttpClient(self.__url, self.__sslVerify,
+                                                 self.__poolSize)
+        attempt = 0
+        while True:
+            try:
+                return await request(self.__asyncClient)
+            except (http.client.HTTPException, OSError, EOFError) as e:
+                if attempt >= self.__retries:
+                    raise ArtifactDownloadError(str(e) or type(e).__name__)
+            if self.__retryDelay:
+                await asyncio.sleep(self.__retryDelay * 2 ** attempt)
+            attempt += 1
+
+    async def _fetchFile(self, buildId, suffix):
+        if not self.__asyncio: return None
+        url = self._makeUrl(buildId, suffix)
+        return await self.__retryAsync(lambda c: self.__fetchFile(c, url))
+
+    async def __fetchFile(self, client, url):
+        response = await client.request("GET", url)
+        try:
+            if response.status != 200:
+                await response.readall()
+                if response.status == 404:
+                    raise ArtifactNotFoundError()
+                elif response.status >= 500:
+                    raise HttpServerError("{} {}".format(response.status, response.reason))
+                else:
+                    raise ArtifactDownloadError("{} {}".format(response.status,
+                                                               response.reason))
+            (fd, name) = mkstemp()
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    while True:
+                        data = await response.read()
+                        if not data: break
+                        f.write(data)
+            except BaseException:
+                os.unlink(name)
+                raise
+            return name
+        finally:
+            client.release(response)
+
+    async def _statFilesAsync(self, buildIds, suffix):
+        if not self.__asyncio: return None
+        return await asyncio.gather(*(self.__statFileAsync(bid, suffix)
+                                      for bid in buildIds))
+
+    async def __statFileAsync(self, buildId, suffix):
+        url = self._makeUrl(buildId, suffix)
+        try:
+            return (True, await self.__retryAsync(lambda c: self.__headAsync(c, url)))
+        except ArtifactNotFoundError:
+            return (False, None)
+        except ArtifactDownloadError:
+            return (None, None)
+
+    async def __headAsync(self, client, url):
+        response = await client.request("HEAD", url)
+        client.release(response)
+        if response.status == 200:
+            length = response.getheader("Content-Length")
+            return int(length) if (length is not None) and length.isdigit() else None
+        elif response.status == 404:
+            raise ArtifactNotFoundError()
+        elif response.status >= 500:
+            raise HttpServerError("HEAD {} {}".format(response.status, response.reason))
+        else:
+            raise ArtifactDownloadError("HEAD {} {}".format(response.status, response.reason))
 
     def _makeUrl(self, buildId, suffix):
         packageResultId = buildIdToName(buildId)
@@ -468,94 +1988,184 @@ class SimpleHttpArchive(BaseArchive):
         url = self.__url
         return urllib.parse.urlunparse((url.scheme, url.netloc, self._makeUrl(buildId, suffix), '', '', ''))
 
-    def _getConnection(self):
-        if self.__connection is not None:
-            return self.__connection
+    def _archiveName(self):
+        return urllib.parse.urlunparse(self.__url)
 
-        url = self.__url
-        if url.scheme == 'http':
-            connection = http.client.HTTPConnection(url.hostname, url.port)
-        elif url.scheme == 'https':
-            ctx = None if self.__sslVerify else ssl.SSLContext(ssl.PROTOCOL_SSLv23)
-            connection = http.client.HTTPSConnection(url.hostname, url.port,
-                                                     context=ctx)
-        else:
-            raise BuildError("Unsupported URL scheme: '{}'".format(url.schema))
+    def __getPool(self):
+        return getHttpConnectionPool(self.__url, self.__sslVerify, self.__poolSize)
 
-        self.__connection = connection
-        return connection
+    def _getConnection(self):
+        """Check out a connection from the pool of the current process.
+
+        The connection must be returned by _releaseConnection() when the
+        response was read completely. Otherwise it must be closed.
+        """
+        return self.__getPool().checkout()
 
-    def _resetConnection(self):
-        if self.__connection is not None:
-            self.__connection.close()
-            self.__connection = None
+    def _releaseConnection(self, connection):
+        self.__getPool().checkin(connection)
 
     def _openDownloadFile(self, buildId, suffix):
-        (ok, result) = self.__retry(lambda: self.__openDownloadFile(buildId, suffix))
+        (ok, result) = self.__retry(lambda c: self.__openDownloadFile(c, buildId, suffix))
         if ok:
             return result
         else:
             raise ArtifactDownloadError(str(result))
 
-    def __openDownloadFile(self, buildId, suffix):
-        connection = self._getConnection()
-        url = self._makeUrl(buildId, suffix)
-        connection.request("GET", url)
+    def _manifestName(self):
+        url = self.__url
+        return urllib.parse.urlunparse((url.scheme, url.netloc,
+            "/".join([url.path, MANIFEST_FILE]), '', '', ''))
+
+    def _openManifestFile(self):
+        url = "/".join([self.__url.path, MANIFEST_FILE])
+        (ok, result) = self.__retry(lambda c: self.__openUrl(c, url))
+        if ok:
+            return result
+        else:
+            raise ArtifactDownloadError(str(result))
+
+    def __openDownloadFile(self, connection, buildId, suffix):
+        return self.__openUrl(connection, self._makeUrl(buildId, suffix))
+
+    def __openUrl(self, connection, url):
+        # Request only the first segment if parallel downloads are enabled.
+        # Servers that do not support ranges will just send the whole file.
+        headers = {}
+        if self.__downloadStreams > 1:
+            headers["Range"] = "bytes=0-{}".format(self.SEGMENT_SIZE-1)
+        connection.request("GET", url, headers=headers)
         response = connection.getresponse()
         if response.status == 200:
-            return SimpleHttpDownloader(self, response)
+            return SimpleHttpDownloader(self, connection, response)
+        elif response.status == 206 and headers:
+            contentRange = parseContentRange(response.getheader("Content-Range"))
+            if contentRange is None or contentRange[0] != 0 or contentRange[2] is None:
+                response.read()
+                self._releaseConnection(connection)
+                raise ArtifactDownloadError("invalid range response")
+            elif contentRange[1]+1 >= contentRange[2]:
+                return SimpleHttpDownloader(self, connection, response)
+            else:
+                return SimpleHttpRangeDownloader(self, connection, response, url,
+                    contentRange[1]+1, contentRange[2], self.__downloadStreams)
         else:
             response.read()
+            self._releaseConnection(connection)
             if response.status == 404:
                 raise ArtifactNotFoundError()
+            elif response.status >= 500:
+                raise HttpServerError("{} {}".format(response.status, response.reason))
             else:
                 raise ArtifactDownloadError("{} {}".format(response.status,
                                                            response.reason))
 
+    def _fetchRange(self, url, first, last, total):
+        """Download the given range of a file into memory."""
+        (ok, result) = self.__retry(lambda c: self.__fetchRange(c, url, first, last, total))
+        if ok:
+            return result
+        else:
+            raise ArtifactDownloadError(str(result))
+
+    def __fetchRange(self, connection, url, first, last, total):
+        connection.request("GET", url, headers={
+            "Range" : "bytes={}-{}".format(first, last) })
+        response = connection.getresponse()
+        data = response.read()
+        self._releaseConnection(connection)
+        if response.status >= 500:
+            raise HttpServerError("{} {}".format(response.status, response.reason))
+        elif response.status != 206:
+            raise ArtifactDownloadError("{} {}".format(response.status, response.reason))
+        if parseContentRange(response.getheader("Content-Range")) != (first, last, total) \
+           or len(data) != last-first+1:
+            raise ArtifactDownloadError("invalid range response")
+        return data
+
+    def _statFile(self, buildId, suffix):
+        (ok, result) = self.__retry(lambda c: self.__statFile(c, buildId, suffix))
+        if ok:
+            return result
+        else:
+            raise ArtifactDownloadError(str(result))
+
+    def _statFiles(self, buildIds, suffix):
+        # Issue the HEAD requests in parallel. Every thread uses its own
+        # connection from the pool.
+        stat = super()._statFiles
+        if len(buildIds) <= 1: return stat(buildIds, suffix)
+        workers = min(len(buildIds), max(self.__poolSize, 1))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(lambda bid: stat([bid], suffix)[0], buildIds))
+
+    def __statFile(self, connection, buildId, suffix):
+        url = self._makeUrl(buildId, suffix)
+        connection.request("HEAD", url)
+        response = connection.getresponse()
+        response.read()
+        self._releaseConnection(connection)
+        if response.status == 200:
+            length = response.getheader("Content-Length")
+            return int(length) if (length is not None) and length.isdigit() else None
+        elif response.status == 404:
+            raise ArtifactNotFoundError()
+        elif response.status >= 500:
+            raise HttpServerError("HEAD {} {}".format(response.status, response.reason))
+        else:
+            raise ArtifactDownloadError("HEAD {} {}".format(response.status, response.reason))
+
     def _openUploadFile(self, buildId, suffix):
-        (ok, result) = self.__retry(lambda: self.__openUploadFile(buildId, suffix))
+        (ok, result) = self.__retry(lambda c: self.__openUploadFile(c, buildId, suffix))
         if ok:
             return result
         else:
             raise ArtifactUploadError(str(result))
 
-    def __openUploadFile(self, buildId, suffix):
-        connection = self._getConnection()
+    def __openUploadFile(self, connection, buildId, suffix):
         url = self._makeUrl(buildId, suffix)
 
         # check if already there
         connection.request("HEAD", url)
         response = connection.getresponse()
         response.read()
+        self._releaseConnection(connection)
         if response.status == 200:
             raise ArtifactExistsError()
+        elif response.status >= 500:
+            raise HttpServerError("HEAD {} {}".format(response.status, response.reason))
         elif response.status != 404:
             raise ArtifactUploadError("HEAD {} {}".format(response.status, response.reason))
 
-        # create temporary file
-        return SimpleHttpUploader(self, url)
+        if self.__streamUpload:
+            return SimpleHttpStreamUploader(self, url)
+        else:
+            # create temporary file
+            return SimpleHttpUploader(self, url)
 
     def _putUploadFile(self, url, tmp):
-        (ok, result) = self.__retry(lambda: self.__putUploadFile(url, tmp))
+        (ok, result) = self.__retry(lambda c: self.__putUploadFile(c, url, tmp))
         if ok:
             return result
         else:
             raise ArtifactUploadError(str(result))
 
-    def __putUploadFile(self, url, tmp):
+    def __putUploadFile(self, connection, url, tmp):
         # Determine file length outself and add a "Content-Length" header. This
         # used to work in Python 3.5 automatically but was removed later.
         tmp.seek(0, os.SEEK_END)
         length = str(tmp.tell())
         tmp.seek(0)
-        connection = self._getConnection()
         connection.request("PUT", url, tmp, headers={ 'Content-Length' : length,
             'If-None-Match' : '*' })
         response = connection.getresponse()
         response.read()
+        self._releaseConnection(connection)
         if response.status == 412:
             # precondition failed -> lost race with other upload
             raise ArtifactExistsError()
+        elif response.status >= 500:
+            raise HttpServerError("PUT {} {}".format(response.status, response.reason))
         elif response.status not in [200, 201, 204]:
             raise ArtifactUploadError("PUT {} {}".format(response.status, response.reason))
 
@@ -620,15 +2230,78 @@ class SimpleHttpArchive(BaseArchive):
                        INSECURE=insecure))
 
 class SimpleHttpDownloader:
-    def __init__(self, archiver, response):
+    def __init__(self, archiver, connection, response):
         self.archiver = archiver
+        self.connection = connection
         self.response = response
     def __enter__(self):
         return (None, self.response)
     def __exit__(self, exc_type, exc_value, traceback):
-        # reset connection on abnormal termination
-        if exc_type is not None:
-            self.archiver._resetConnection()
+        # Only reuse connection if the response was read completely.
+        # Otherwise the connection is in an undefined state. Consumers
+        # usually stop right before the padding at the end of the file.
+        if exc_type is None:
+            try:
+                self.response.read()
+            except (http.client.HTTPException, OSError):
+                pass
+        if exc_type is None and self.response.isclosed():
+            self.archiver._releaseConnection(self.connection)
+        else:
+            self.connection.close()
+        return False
+
+class SimpleHttpRangeDownloader:
+    """Download a file by parallel range requests.
+
+    The first segment is streamed from the initial response. The following
+    segments are fetched in parallel by a thread pool on their own connections
+    and are handed out in order. At most one segment per stream is kept in
+    memory.
+    """
+
+    def __init__(self, archiver, connection, response, url, offset, size, streams):
+        self.archiver = archiver
+        self.connection = connection
+        self.response = response
+        self.url = url
+        self.offset = offset
+        self.size = size
+        self.streams = streams
+        self.current = response
+        self.pending = collections.deque()
+        self.executor = concurrent.futures.ThreadPoolExecutor(streams)
+
+    def __enter__(self):
+        for i in range(self.streams): self.__submit()
+        return (None, self)
+
+    def __submit(self):
+        if self.offset >= self.size: return
+        last = min(self.offset + self.archiver.SEGMENT_SIZE, self.size) - 1
+        self.pending.append(self.executor.submit(self.archiver._fetchRange,
+            self.url, self.offset, last, self.size))
+        self.offset = last + 1
+
+    def read(self, size=None):
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self.read(1024*1024), b""))
+        while True:
+            data = self.current.read(size)
+            if data or not self.pending: return data
+            try:
+                self.current = io.BytesIO(self.pending.popleft().result())
+            except ArtifactDownloadError as e:
+                raise OSError("Segment download failed: " + e.reason)
+            self.__submit()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for i in self.pending: i.cancel()
+        self.executor.shutdown(wait=False)
+        if exc_type is None and self.response.isclosed():
+            self.archiver._releaseConnection(self.connection)
+        else:
+            self.connection.close()
         return False
 
 class SimpleHttpUploader:
@@ -648,6 +2321,94 @@ class SimpleHttpUploader:
         return False
 
 
+class SimpleHttpStreamUploader:
+    """Upload a file by a chunked PUT request while it is written.
+
+    The request is sent by a background thread that takes the data from a
+    bounded queue. If the upload is aborted the request is interrupted before
+    the terminating chunk is sent. The server must discard the incomplete
+    file in this case.
+    """
+
+    BUFFER_SIZE = 64 * 1024
+    ABORT = object()
+
+    def __init__(self, archiver, url):
+        self.archiver = archiver
+        self.url = url
+        self.buf = bytearray()
+        self.queue = queue.Queue(16)
+        self.response = None
+        self.error = None
+
+    def __enter__(self):
+        self.connection = self.archiver._getConnection()
+        self.thread = threading.Thread(target=self.__put)
+        self.thread.start()
+        return (None, self)
+
+    def __body(self):
+        while True:
+            data = self.queue.get()
+            if data is self.ABORT:
+                raise ArtifactUploadError("aborted")
+            yield b"%x\r\n%s\r\n" % (len(data), data)
+            if not data: break
+
+    def __put(self):
+        try:
+            self.connection.request("PUT", self.url, self.__body(), headers={
+                'Transfer-Encoding' : 'chunked', 'If-None-Match' : '*' })
+            self.response = self.connection.getresponse()
+            self.response.read()
+        except (http.client.HTTPException, OSError, ArtifactUploadError) as e:
+            self.error = e
+
+    def __push(self, data):
+        while self.thread.is_alive():
+            try:
+                self.queue.put(data, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise ArtifactUploadError(str(self.error or "upload failed"))
+
+    def write(self, data):
+        self.buf += data
+        if len(self.buf) >= self.BUFFER_SIZE:
+            self.__push(bytes(self.buf))
+            self.buf = bytearray()
+        return len(data)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                if self.buf: self.__push(bytes(self.buf))
+                self.__push(b"")
+            else:
+                try:
+                    self.__push(self.ABORT)
+                except ArtifactUploadError:
+                    pass
+            self.thread.join()
+        finally:
+            if exc_type is None and self.error is None:
+                self.archiver._releaseConnection(self.connection)
+            else:
+                self.connection.close()
+        if exc_type is not None:
+            return False
+        if self.error is not None:
+            raise ArtifactUploadError(str(self.error))
+        if self.response.status == 412:
+            # precondition failed -> lost race with other upload
+            raise ArtifactExistsError()
+        elif self.response.status not in [200, 201, 204]:
+            raise ArtifactUploadError("PUT {} {}".format(self.response.status,
+                                                         self.response.reason))
+        return False
+
+
 class CustomArchive(BaseArchive):
     """Custom command archive"""
 
@@ -655,6 +2416,8 @@ class CustomArchive(BaseArchive):
         super().__init__(spec)
         self.__downloadCmd = spec.get("download")
         self.__uploadCmd = spec.get("upload")
+        self.__streamUpload = spec.get("streamUpload", False)
+        self.__serverCmd = spec.get("server")
         self.__whiteList = whiteList
 
     def _makeUrl(self, buildId, suffix):
@@ -665,11 +2428,21 @@ class CustomArchive(BaseArchive):
     def _remoteName(self, buildId, suffix):
         return self._makeUrl(buildId, suffix)
 
+    def _archiveName(self):
+        return "shell"
+
+    def _missKeyPrefix(self):
+        # All shell backends share the same name. Tell them apart by their
+        # commands.
+        return "shell:{}:{}:".format(self.__serverCmd or "", self.__downloadCmd or "")
+
     def canDownloadLocal(self):
-        return super().canDownloadLocal() and (self.__downloadCmd is not None)
+        return super().canDownloadLocal() and \
+            ((self.__downloadCmd is not None) or (self.__serverCmd is not None))
 
     def canUploadLocal(self):
-        return super().canUploadLocal() and (self.__uploadCmd is not None)
+        return super().canUploadLocal() and \
+            ((self.__uploadCmd is not None) or (self.__serverCmd is not None))
 
     def canDownloadJenkins(self):
         return super().canDownloadJenkins() and (self.__downloadCmd is not None)
@@ -678,26 +2451,58 @@ class CustomArchive(BaseArchive):
         return super().canUploadJenkins() and (self.__uploadCmd is not None)
 
     def _openDownloadFile(self, buildId, suffix):
+        return self.__download(self._makeUrl(buildId, suffix))
+
+    def _openManifestFile(self):
+        return self.__download(MANIFEST_FILE)
+
+    def __getServer(self):
+        return getCustomArchiveServer(self.__serverCmd, self.__whiteList)
+
+    def __download(self, url):
         (tmpFd, tmpName) = mkstemp()
-        url = self._makeUrl(buildId, suffix)
         try:
             os.close(tmpFd)
-            env = { k:v for (k,v) in os.environ.items() if k in self.__whiteList }
-            env["BOB_LOCAL_ARTIFACT"] = tmpName
-            env["BOB_REMOTE_ARTIFACT"] = url
-            ret = subprocess.call(["/bin/bash", "-ec", self.__downloadCmd],
-                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
-                cwd="/tmp", env=env)
-            if ret == 0:
-                ret = tmpName
-                tmpName = None
-                return CustomDownloader(ret)
+            if self.__serverCmd is not None:
+                (status, msg) = self.__getServer().request("download", url, tmpName)
+                if status == "missing":
+                    raise ArtifactNotFoundError()
+                elif status != "ok":
+                    raise ArtifactDownloadError(msg)
             else:
-                raise ArtifactDownloadError("failed (exit {})".format(ret))
+                env = { k:v for (k,v) in os.environ.items() if k in self.__whiteList }
+                env["BOB_LOCAL_ARTIFACT"] = tmpName
+                env["BOB_REMOTE_ARTIFACT"] = url
+                ret = subprocess.call(["/bin/bash", "-ec", self.__downloadCmd],
+                    stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                    cwd="/tmp", env=env)
+                if ret != 0:
+                    raise ArtifactDownloadError("failed (exit {})".format(ret))
+            ret = tmpName
+            tmpName = None
+            return CustomDownloader(ret)
         finally:
             if tmpName is not None: os.unlink(tmpName)
 
+    def _statFile(self, buildId, suffix):
+        if self.__serverCmd is None:
+            return super()._statFile(buildId, suffix)
+        (status, msg) = self.__getServer().request("stat", self._makeUrl(buildId, suffix))
+        if status == "missing":
+            raise ArtifactNotFoundError()
+        elif status != "ok":
+            raise ArtifactDownloadError(msg)
+        return int(msg) if msg.isdigit() else None
+
     def _openUploadFile(self, buildId, suffix):
+        if self.__serverCmd is not None:
+            (tmpFd, tmpName) = mkstemp()
+            os.close(tmpFd)
+            return CustomServerUploader(tmpName, self._makeUrl(buildId, suffix),
+                self.__getServer())
+        if self.__streamUpload:
+            return CustomStreamUploader(self._makeUrl(buildId, suffix),
+                self.__whiteList, self.__uploadCmd)
         (tmpFd, tmpName) = mkstemp()
         os.close(tmpFd)
         return CustomUploader(tmpName, self._makeUrl(buildId, suffix), self.__whiteList,
@@ -777,20 +2582,236 @@ class CustomUploader:
             os.unlink(self.name)
         return False
 
+class CustomServerUploader:
+    def __init__(self, name, remoteName, server):
+        self.name = name
+        self.remoteName = remoteName
+        self.server = server
+
+    def __enter__(self):
+        return (self.name, None)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                (status, msg) = self.server.request("upload", self.remoteName, self.name)
+                if status == "exists":
+                    raise ArtifactExistsError()
+                elif status != "ok":
+                    raise ArtifactUploadError(msg)
+        finally:
+            os.unlink(self.name)
+        return False
+
+class CustomArchiveServer:
+    """Persistent helper process of a custom archive.
+
+    The helper command is started once per process and executes all
+    transfers of the process. This way it can keep connections to the remote
+    archive open. Requests are sent as single lines on the stdin of the
+    helper:
+
+        download <remote> <local>
+        upload <remote> <local>
+        stat <remote>
+
+    The helper must answer every request by a single line on its stdout. This
+    is either "ok", "missing" if a downloaded artifact does not exist,
+    "exists" if an uploaded artifact is already in the archive or
+    "error <message>". The "ok" answer to a stat request may be followed by
+    the size of the artifact. Helpers that do not support stat requests just
+    answer them with an error. The helper should exit when its stdin is closed. If it
+    exits prematurely it is restarted on the next request.
+    """
+
+    def __init__(self, cmd, whiteList):
+        self.__cmd = cmd
+        self.__whiteList = whiteList
+        self.__proc = None
+        self.__lock = threading.Lock()
+        self.__pid = os.getpid()
+
+    def __start(self):
+        env = { k:v for (k,v) in os.environ.items() if k in self.__whiteList }
+        self.__proc = subprocess.Popen(["/bin/bash", "-ec", self.__cmd],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd="/tmp", env=env)
+
+    def __stop(self):
+        try:
+            self.__proc.stdin.close()
+        except OSError:
+            pass
+        self.__proc.stdout.close()
+        self.__proc.wait()
+        self.__proc = None
+
+    def request(self, op, remoteName, localName=""):
+        """Execute a request. Returns the tuple (status, message)."""
+        with self.__lock:
+            if self.__pid != os.getpid():
+                # forked: the helper belongs to the parent process
+                self.__proc = None
+                self.__pid = os.getpid()
+            if (self.__proc is None) or (self.__proc.poll() is not None):
+                if self.__proc is not None: self.__stop()
+                self.__start()
+            try:
+                request = op + " " + remoteName
+                if localName: request += " " + localName
+                self.__proc.stdin.write(os.fsencode(request) + b"\n")
+                self.__proc.stdin.flush()
+                reply = self.__proc.stdout.readline()
+            except OSError:
+                reply = b""
+            if not reply.endswith(b"\n"):
+                self.__stop()
+                return ("error", "helper exited")
+        (status, _, msg) = reply.decode("utf8", errors="replace").rstrip("\n").partition(" ")
+        return (status, msg or status)
+
+_customServers = {}
+_customServersLock = threading.Lock()
+
+def getCustomArchiveServer(cmd, whiteList):
+    """Get the helper process of the current process for a command."""
+    with _customServersLock:
+        server = _customServers.get(cmd)
+        if server is None:
+            server = _customServers[cmd] = CustomArchiveServer(cmd, whiteList)
+    return server
+
+class CustomStreamUploader:
+    """Upload through a named pipe while the file is written.
+
+    The upload command is started right away and reads the file from a FIFO.
+    If the upload is aborted the command is killed before the pipe is closed.
+    This way the command never sees the end of an incomplete file.
+    """
+
+    def __init__(self, remoteName, whiteList, uploadCmd):
+        self.remoteName = remoteName
+        self.whiteList = whiteList
+        self.uploadCmd = uploadCmd
+        self.tmpDir = None
+        self.proc = None
+        self.fifo = None
+
+    def __enter__(self):
+        try:
+            self.tmpDir = mkdtemp()
+            name = os.path.join(self.tmpDir, "artifact")
+            os.mkfifo(name, 0o600)
+            env = { k:v for (k,v) in os.environ.items() if k in self.whiteList }
+            env["BOB_LOCAL_ARTIFACT"] = name
+            env["BOB_REMOTE_ARTIFACT"] = self.remoteName
+            self.proc = subprocess.Popen(["/bin/bash", "-ec", self.uploadCmd],
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                cwd="/tmp", env=env, start_new_session=True)
+
+            # Opening the pipe blocks until the command opens it too. Poll
+            # instead so that we do not hang if the command fails early.
+            while True:
+                try:
+                    fd = os.open(name, os.O_WRONLY | os.O_NONBLOCK)
+                    break
+                except OSError as e:
+                    if e.errno != errno.ENXIO: raise
+                ret = self.proc.poll()
+                if ret is not None:
+                    raise ArtifactUploadError("command return with status {}".format(ret))
+                time.sleep(0.01)
+            os.set_blocking(fd, True)
+            self.fifo = os.fdopen(fd, "wb")
+        except:
+            self.__cleanup(True)
+            raise
+        return (None, self.fifo)
+
+    def __cleanup(self, abort):
+        if self.proc is not None:
+            if abort and self.proc.poll() is None:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            self.proc.wait()
+        if self.fifo is not None:
+            try:
+                self.fifo.close()
+            except OSError:
+                pass
+        if self.tmpDir is not None:
+            removePath(self.tmpDir)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            try:
+                self.fifo.close()
+                complete = True
+            except OSError:
+                complete = False # command exited early
+            self.fifo = None
+            ret = self.proc.wait()
+            self.__cleanup(False)
+            if ret != 0:
+                raise ArtifactUploadError("command return with status {}".format(ret))
+            elif not complete:
+                raise ArtifactUploadError("command did not read whole file")
+        else:
+            self.__cleanup(True)
+        return False
+
 
 class AzureArchive(BaseArchive):
+    # Default of the SDK. The block sizes of the SDK are only overridden if
+    # 'blockSize' is configured.
+    DEFAULT_MAX_CONNECTIONS = 2
+
     def __init__(self, spec):
         super().__init__(spec)
         self.__container = spec['container']
         self.__account = spec['account']
         self.__key = spec.get('key')
         self.__sasToken = spec.get('sasToken')
+        self.__endpoint = spec.get('endpoint')
+        self.__maxConnections = spec.get('maxConnections')
+        self.__blockSize = spec.get('blockSize')
+        self.__service = AzureArchive.__makeService(self.__account, self.__key,
+            self.__sasToken, self.__endpoint, self.__blockSize)
+
+    @staticmethod
+    def __makeService(account, key, sasToken, endpoint, blockSize):
         try:
             from azure.storage.blob import BlockBlobService
         except ImportError:
             raise BuildError("azure-storage-blob Python3 library not installed!")
-        self.__service = BlockBlobService(account_name=self.__account,
-            account_key=self.__key, sas_token=self.__sasToken, socket_timeout=6000)
+
+        service = BlockBlobService(account_name=account, account_key=key,
+            sas_token=sasToken, custom_domain=endpoint, socket_timeout=6000)
+        if blockSize is not None:
+            # Transfer all blobs that are larger than a block in parallel
+            service.MAX_BLOCK_SIZE = blockSize
+            service.MAX_SINGLE_PUT_SIZE = blockSize
+            service.MAX_CHUNK_GET_SIZE = blockSize
+            service.MAX_SINGLE_GET_SIZE = blockSize
+        return service
+
+    def __connections(self):
+        return self.__maxConnections or self.DEFAULT_MAX_CONNECTIONS
+
+    def __baseUrl(self):
+        if self.__endpoint:
+            return self.__endpoint.rstrip("/")
+        else:
+            return "https://{}.blob.core.windows.net".format(self.__account)
+
+    def __scriptArgs(self):
+        args = []
+        if self.__key: args.append("--key=" + self.__key)
+        if self.__sasToken: args.append("--sas-token=" + self.__sasToken)
+        if self.__endpoint: args.append("--endpoint=" + self.__endpoint)
+        if self.__maxConnections is not None:
+            args.append("--max-connections={}".format(self.__maxConnections))
+        if self.__blockSize is not None:
+            args.append("--block-size={}".format(self.__blockSize))
+        return args
 
     @staticmethod
     def __makeBlobName(buildId, suffix):
@@ -799,8 +2820,11 @@ class AzureArchive(BaseArchive):
             packageResultId[4:] + suffix])
 
     def _remoteName(self, buildId, suffix):
-        return "https://{}.blob.core.windows.net/{}/{}".format(self.__account,
-            self.__container, self.__makeBlobName(buildId, suffix))
+        return "{}/{}/{}".format(self.__baseUrl(), self.__container,
+            self.__makeBlobName(buildId, suffix))
+
+    def _archiveName(self):
+        return "{}/{}".format(self.__baseUrl(), self.__container)
 
     def _openDownloadFile(self, buildId, suffix):
         from azure.common import AzureException, AzureMissingResourceHttpError
@@ -808,7 +2832,8 @@ class AzureArchive(BaseArchive):
         try:
             os.close(tmpFd)
             self.__service.get_blob_to_path(self.__container,
-                self.__makeBlobName(buildId, suffix), tmpName)
+                self.__makeBlobName(buildId, suffix), tmpName,
+                max_connections=self.__connections())
             ret = tmpName
             tmpName = None
             return AzureDownloader(ret)
@@ -819,6 +2844,17 @@ class AzureArchive(BaseArchive):
         finally:
             if tmpName is not None: os.unlink(tmpName)
 
+    def _statFile(self, buildId, suffix):
+        from azure.common import AzureException, AzureMissingResourceHttpError
+        try:
+            blob = self.__service.get_blob_properties(self.__container,
+                self.__makeBlobName(buildId, suffix))
+            return blob.properties.content_length
+        except AzureMissingResourceHttpError:
+            raise ArtifactNotFoundError()
+        except AzureException as e:
+            raise ArtifactDownloadError(str(e))
+
     def _openUploadFile(self, buildId, suffix):
         from azure.common import AzureException
 
@@ -830,15 +2866,14 @@ class AzureArchive(BaseArchive):
             raise ArtifactUploadError(str(e))
         (tmpFd, tmpName) = mkstemp()
         os.close(tmpFd)
-        return AzureUploader(self.__service, self.__container, tmpName, blobName)
+        return AzureUploader(self.__service, self.__container, tmpName, blobName,
+                             self.__connections())
 
     def upload(self, step, buildIdFile, tgzFile):
         if not self.canUploadJenkins():
             return ""
 
-        args = []
-        if self.__key: args.append("--key=" + self.__key)
-        if self.__sasToken: args.append("--sas-token=" + self.__sasToken)
+        args = self.__scriptArgs()
 
         return "\n" + textwrap.dedent("""\
             # upload artifact
@@ -854,9 +2889,7 @@ class AzureArchive(BaseArchive):
         if not self.canDownloadJenkins():
             return ""
 
-        args = []
-        if self.__key: args.append("--key=" + self.__key)
-        if self.__sasToken: args.append("--sas-token=" + self.__sasToken)
+        args = self.__scriptArgs()
 
         return "\n" + textwrap.dedent("""\
             if [[ ! -e {RESULT} ]] ; then
@@ -870,9 +2903,7 @@ class AzureArchive(BaseArchive):
         if not self.canUploadJenkins():
             return ""
 
-        args = []
-        if self.__key: args.append("--key=" + self.__key)
-        if self.__sasToken: args.append("--sas-token=" + self.__sasToken)
+        args = self.__scriptArgs()
 
         return "\n" + textwrap.dedent("""\
             # upload live build-id
@@ -886,7 +2917,8 @@ class AzureArchive(BaseArchive):
 
     @staticmethod
     def scriptDownload(args):
-        service, container, remoteBlob, localFile = AzureArchive.scriptGetService(args)
+        service, container, remoteBlob, localFile, maxConnections = \
+            AzureArchive.scriptGetService(args)
         from azure.common import AzureException
 
         # Download into temporary file and rename if downloaded successfully
@@ -894,7 +2926,8 @@ class AzureArchive(BaseArchive):
         try:
             (tmpFd, tmpName) = mkstemp(dir=".")
             os.close(tmpFd)
-            service.get_blob_to_path(container, remoteBlob, tmpName)
+            service.get_blob_to_path(container, remoteBlob, tmpName,
+                                     max_connections=maxConnections)
             os.rename(tmpName, localFile)
             tmpName = None
         except (OSError, AzureException) as e:
@@ -904,13 +2937,14 @@ class AzureArchive(BaseArchive):
 
     @staticmethod
     def scriptUpload(args):
-        service, container, remoteBlob, localFile = AzureArchive.scriptGetService(args)
-        from azure.common import AzureException, AzureConflictHttpError
+        service, container, remoteBlob, localFile, maxConnections = \
+            AzureArchive.scriptGetService(args)
+        from azure.common import AzureException
         try:
-            service.create_blob_from_path(container, remoteBlob, localFile, if_none_match="*")
-            print("OK")
-        except AzureConflictHttpError:
-            print("skipped")
+            if azureUploadBlob(service, container, remoteBlob, localFile, maxConnections):
+                print("OK")
+            else:
+                print("skipped")
         except (OSError, AzureException) as e:
             raise BuildError("Upload failed: " + str(e))
 
@@ -924,15 +2958,14 @@ class AzureArchive(BaseArchive):
         parser.add_argument('file')
         parser.add_argument('--key')
         parser.add_argument('--sas-token')
+        parser.add_argument('--endpoint')
+        parser.add_argument('--max-connections', type=int,
+                            default=AzureArchive.DEFAULT_MAX_CONNECTIONS)
+        parser.add_argument('--block-size', type=int)
         args = parser.parse_args(args)
 
-        try:
-            from azure.storage.blob import BlockBlobService
-        except ImportError:
-            raise BuildError("azure-storage-blob Python3 library not installed!")
-
-        service = BlockBlobService(account_name=args.account, account_key=args.key,
-            sas_token=args.sas_token, socket_timeout=6000)
+        service = AzureArchive.__makeService(args.account, args.key,
+            args.sas_token, args.endpoint, args.block_size)
 
         try:
             with open(args.buildid, 'rb') as f:
@@ -940,7 +2973,48 @@ class AzureArchive(BaseArchive):
         except OSError as e:
             raise BuildError(str(e))
 
-        return (service, args.container, remoteBlob, args.file)
+        return (service, args.container, remoteBlob, args.file, args.max_connections)
+
+def azureUploadBlob(service, container, blobName, fileName, maxConnections):
+    """Upload a file as block blob unless the blob exists already.
+
+    Files up to the single put size of the service are uploaded by one
+    request. Larger files are staged as blocks in parallel and committed by a
+    final put-block-list request. The SDK would derive the block ids from the
+    offsets. Concurrent uploads of the same blob could then overwrite each
+    other's staged blocks. Instead, every upload uses its own block ids so
+    that the blob always consists of the blocks of a single upload and the
+    first commit wins.
+
+    Returns False if the blob already exists.
+    """
+    from azure.common import AzureHttpError
+    from azure.storage.blob.models import BlobBlock
+
+    try:
+        size = os.path.getsize(fileName)
+        if size <= service.MAX_SINGLE_PUT_SIZE:
+            service.create_blob_from_path(container, blobName, fileName,
+                                          if_none_match="*")
+            return True
+
+        blockSize = service.MAX_BLOCK_SIZE
+        prefix = uuid.uuid4().hex
+        def putBlock(index):
+            blockId = "{}{:08d}".format(prefix, index)
+            with open(fileName, "rb") as f:
+                f.seek(index * blockSize)
+                service.put_block(container, blobName, f.read(blockSize), blockId)
+            return BlobBlock(blockId)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=maxConnections) as executor:
+            blocks = list(executor.map(putBlock, range((size + blockSize - 1) // blockSize)))
+        service.put_block_list(container, blobName, blocks, if_none_match="*")
+        return True
+    except AzureHttpError as e:
+        # The blob exists if the precondition failed
+        if e.status_code in (409, 412): return False
+        raise
 
 class AzureDownloader:
     def __init__(self, name):
@@ -952,11 +3026,12 @@ class AzureDownloader:
         return False
 
 class AzureUploader:
-    def __init__(self, service, container, name, remoteName):
+    def __init__(self, service, container, name, remoteName, maxConnections):
         self.__service = service
         self.__container = container
         self.__name = name
         self.__remoteName = remoteName
+        self.__maxConnections = maxConnections
 
     def __enter__(self):
         return (self.__name, None)
@@ -970,22 +3045,204 @@ class AzureUploader:
         return False
 
     def __upload(self):
-        from azure.common import AzureException, AzureConflictHttpError
+        from azure.common import AzureException
         try:
-            self.__service.create_blob_from_path(self.__container,
-                self.__remoteName, self.__name, if_none_match="*")
-        except AzureConflictHttpError:
-            raise ArtifactExistsError()
+            if not azureUploadBlob(self.__service, self.__container,
+                                   self.__remoteName, self.__name, self.__maxConnections):
+                raise ArtifactExistsError()
         except AzureException as e:
             raise ArtifactUploadError(str(e))
 
 
+class ArchiveCache(LocalArchive):
+    """Size-bounded local cache of the artifacts of remote archives.
+
+    The cache uses the same layout as the LocalArchive. It is filled by the
+    ArchiveCacheFiller while the files are downloaded from the remote archives.
+    The modification time of the files is updated on every cache hit. If the
+    cache grows beyond its size limit the least recently used files are
+    evicted.
+
+    The total size of the cache is kept in the ".size" file. It is updated
+    whenever a file is inserted. The cache is only walked if the size file is
+    missing, if the size limit is exceeded or if the last walk is older than
+    CACHE_WALK_INTERVAL seconds. The latter removes stale temporary files and
+    corrects the size if files were deleted by other means.
+
+    Files are inserted atomically by the LocalArchiveUploader. Updates of the
+    size file and evictions are serialized by a lock file. Removing a file that
+    is just read by another process does not disturb the reader. If a file
+    vanishes between the lookup and the download the remote archives are used.
+    """
+
+    def __init__(self, spec):
+        super().__init__({ "path" : spec["path"], "flags" : ["download"] })
+        self.__path = os.path.abspath(spec["path"])
+        self.__maxSize = spec["size"]
+
+    def contains(self, buildId, suffix):
+        return os.path.isfile(self._getPath(buildId, suffix)[1])
+
+    def _archiveName(self):
+        return "cache:" + self.__path
+
+    def _openDownloadFile(self, buildId, suffix):
+        ret = super()._openDownloadFile(buildId, suffix)
+        try:
+            os.utime(self._getPath(buildId, suffix)[1])
+        except OSError:
+            pass
+        return ret
+
+    def _evict(self, added=0):
+        """Account 'added' bytes and evict files if the size limit is exceeded.
+
+        Least recently used files are removed until the size limit is met. Stale
+        temporary files of aborted downloads are removed too.
+        """
+        with open(os.path.join(self.__path, ".lock"), "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+
+            now = time.time()
+            sizeFile = os.path.join(self.__path, ".size")
+            try:
+                with open(sizeFile) as f:
+                    (total, walked) = f.read().split()
+                    total = int(total) + added
+                    walked = float(walked)
+            except (OSError, ValueError):
+                total = None
+            if (total is not None) and (total <= self.__maxSize) and \
+               (now - walked) < CACHE_WALK_INTERVAL:
+                with open(sizeFile, "w") as f:
+                    f.write("{} {}\n".format(total, walked))
+                return
+
+            files = []
+            total = 0
+            for root, dirs, names in os.walk(self.__path):
+                for n in names:
+                    name = os.path.join(root, n)
+                    try:
+                        st = os.lstat(name)
+                        if n.endswith((ARTIFACT_SUFFIX, BUILDID_SUFFIX, CHUNKS_SUFFIX, CHUNK_SUFFIX)):
+                            files.append((st.st_mtime, st.st_size, name))
+                            total += st.st_size
+                        elif n.startswith("tmp") and (now - st.st_mtime) > 24*60*60:
+                            os.unlink(name)
+                    except FileNotFoundError:
+                        pass
+
+            files.sort()
+            for (mtime, size, name) in files:
+                if total <= self.__maxSize: break
+                try:
+                    os.unlink(name)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+            with open(sizeFile, "w") as f:
+                f.write("{} {}\n".format(total, now))
+
+class ArchiveCacheFiller:
+    """Tee a download into the ArchiveCache.
+
+    Wraps the downloader of the remote archive. The data is written to a
+    temporary file of the cache while it is read. Only if the download finished
+    without errors the file is added to the cache. Errors of the cache itself
+    never fail the download.
+    """
+
+    def __init__(self, cache, downloader, buildId, suffix):
+        self.cache = cache
+        self.downloader = downloader
+        self.buildId = buildId
+        self.suffix = suffix
+        self.uploader = None
+        self.tmp = None
+        self.own = None
+
+    def __enter__(self):
+        (name, fileobj) = self.downloader.__enter__()
+        try:
+            self.uploader = self.cache._openUploadFile(self.buildId, self.suffix)
+            self.tmp = self.uploader.__enter__()[1]
+            if fileobj is None:
+                fileobj = self.own = open(name, "rb")
+        except (ArtifactExistsError, OSError):
+            self.__abort()
+            return (name, fileobj)
+        self.fileobj = fileobj
+        return (None, self)
+
+    def read(self, size=None):
+        data = self.fileobj.read() if size is None else self.fileobj.read(size)
+        if self.tmp is not None:
+            try:
+                self.tmp.write(data)
+            except OSError:
+                self.__abort()
+        return data
+
+    def __abort(self):
+        if self.uploader is not None:
+            try:
+                self.uploader.__exit__(OSError, None, None)
+            except OSError:
+                pass
+        self.uploader = None
+        self.tmp = None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None and self.tmp is not None:
+                # The consumer might not have read the trailer of the file.
+                try:
+                    while self.read(64 * 1024): pass
+                except (OSError, http.client.HTTPException):
+                    self.__abort()
+            if exc_type is None and self.tmp is not None:
+                try:
+                    self.uploader.__exit__(None, None, None)
+                    self.cache._evict(os.path.getsize(
+                        self.cache._getPath(self.buildId, self.suffix)[1]))
+                except OSError:
+                    pass
+            else:
+                self.__abort()
+        finally:
+            if self.own is not None: self.own.close()
+        return self.downloader.__exit__(exc_type, exc_value, traceback)
+
+
 class MultiArchive:
-    def __init__(self, archives):
+    """Combine multiple archive backends and the optional ArchiveCache.
+
+    The 'strategy' dict selects how the backends are used. Downloads either
+    try the backends one after another ("sequential") or look up the artifact
+    in all backends concurrently and take the first hit ("race"). Uploads go
+    to the backends one after another ("sequential") or concurrently
+    ("parallel"). With the "latency" order the backends are tried by their
+    measured lookup latency instead of the configured order.
+    """
+
+    def __init__(self, archives, cache=None, strategy={}):
         self.__archives = archives
+        self.__cache = cache
+        self.__downloadStrategy = strategy.get("download", "sequential")
+        self.__uploadStrategy = strategy.get("upload", "sequential")
+        self.__order = strategy.get("order", "config")
+        self.__latency = {}
+        self.__detached = set()
+        if cache is not None:
+            for i in archives:
+                if isinstance(i, BaseArchive): i._setCache(cache)
 
     def wantDownload(self, enable):
         for i in self.__archives: i.wantDownload(enable)
+        if self.__cache is not None: self.__cache.wantDownload(enable)
 
     def wantUpload(self, enable):
         for i in self.__archives: i.wantUpload(enable)
@@ -1002,17 +3259,175 @@ class MultiArchive:
     def canUploadJenkins(self):
         return any(i.canUploadJenkins() for i in self.__archives)
 
+    def getLatencies(self):
+        """Get the average lookup latency of every backend in seconds.
+
+        Returns a list in the configured order of the backends. Backends that
+        were not queried yet have a latency of None.
+        """
+        return [ self.__latency.get(n) for n in range(len(self.__archives)) ]
+
+    def __downloaders(self):
+        """Enabled download backends as (index, archive) in preferred order."""
+        ret = [ (n, i) for (n, i) in enumerate(self.__archives) if i.canDownloadLocal() ]
+        if self.__order == "latency":
+            # Stable sort. Backends without statistics are tried first so that
+            # they are measured too.
+            ret.sort(key=lambda x: self.__latency.get(x[0], 0.0))
+        return ret
+
+    async def __timed(self, index, coro, measure=lambda ret: True):
+        """Run a lookup coroutine and account its duration to the backend."""
+        start = time.monotonic()
+        ret = await coro
+        if measure(ret):
+            elapsed = time.monotonic() - start
+            old = self.__latency.get(index)
+            self.__latency[index] = elapsed if old is None else \
+                (1.0 - LATENCY_WEIGHT) * old + LATENCY_WEIGHT * elapsed
+        return ret
+
+    def __detach(self, tasks):
+        """Let the remaining lookups of a race finish in the background.
+
+        The results are not needed anymore. The tasks are not cancelled
+        because the jobs in the executor cannot be stopped anyway. Their
+        latency is still accounted, though.
+        """
+        def done(task):
+            self.__detached.discard(task)
+            if not task.cancelled(): task.exception()
+        for t in tasks:
+            self.__detached.add(t)
+            t.add_done_callback(done)
+
+    async def __race(self, coros, isHit):
+        """Run the coroutines concurrently until the first hit.
+
+        Returns the index and result of the first coroutine whose result
+        satisfies 'isHit' and a list of the results of all other coroutines
+        that finished until then. The index is None if there was no hit.
+        """
+        pending = { asyncio.ensure_future(c) : n for (n, c) in enumerate(coros) }
+        results = []
+        try:
+            while pending:
+                done, _ = await asyncio.wait(list(pending.keys()),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for t in sorted(done, key=lambda t: pending[t]):
+                    n = pending.pop(t)
+                    ret = t.result()
+                    if isHit(ret): return (n, ret, results)
+                    results.append((n, ret))
+            return (None, None, results)
+        finally:
+            self.__detach(pending.keys())
+
+    async def __gather(self, coros):
+        """Run all coroutines concurrently.
+
+        All coroutines are finished even if some of them fail. The first
+        exception is raised afterwards.
+        """
+        results = await asyncio.gather(*coros, return_exceptions=True)
+        for i in results:
+            if isinstance(i, BaseException): raise i
+        return results
+
     async def uploadPackage(self, step, buildId, audit, content):
+        uploaders = [ i for i in self.__archives if i.canUploadLocal() ]
+        if self.__uploadStrategy == "parallel":
+            await self.__gather(i.uploadPackage(step, buildId, audit, content)
+                                for i in uploaders)
+        else:
+            for i in uploaders:
+                await i.uploadPackage(step, buildId, audit, content)
+
+    async def uploadSources(self, step, sourceId, audit, content):
         for i in self.__archives:
-            if not i.canUploadLocal(): continue
-            await i.uploadPackage(step, buildId, audit, content)
+            if i.canUploadLocal():
+                await i.uploadSources(step, sourceId, audit, content)
+
+    async def downloadSources(self, step, sourceId, audit, content):
+        for (n, i) in self.__downloaders():
+            if await i.downloadSources(step, sourceId, audit, content):
+                return True
+        return False
 
     async def downloadPackage(self, step, buildId, audit, content):
-        for i in self.__archives:
-            if not i.canDownloadLocal(): continue
-            if await i.downloadPackage(step, buildId, audit, content): return True
+        if self.__useCache(buildId, ARTIFACT_SUFFIX):
+            if await self.__cache.downloadPackage(step, buildId, audit, content): return True
+        downloaders = self.__downloaders()
+        if (self.__downloadStrategy == "race") and (len(downloaders) > 1):
+            # Packages can only be downloaded from one backend at a time
+            # because they are extracted into the same workspace. Hence only
+            # the lookups race.
+            (hit, result, others) = await self.__race(
+                [ self.__timed(n, i.queryPackage(step, buildId)) for (n, i) in downloaders ],
+                lambda ret: ret[0])
+            if hit is not None:
+                if await downloaders[hit][1].downloadPackage(step, buildId, audit, content):
+                    return True
+                downloaders = downloaders[:hit] + downloaders[hit+1:]
+            else:
+                # Only try the backends that cannot tell without downloading
+                unknown = set(n for (n, (exists, size)) in others if exists is None)
+                downloaders = [ d for (n, d) in enumerate(downloaders) if n in unknown ]
+        for (n, i) in downloaders:
+            if await self.__timed(n, i.downloadPackage(step, buildId, audit, content),
+                                  lambda ret: not ret):
+                return True
         return False
 
+    def __useCache(self, buildId, suffix):
+        return (self.__cache is not None) and self.canDownloadLocal() and \
+            self.__cache.contains(buildId, suffix)
+
+    async def queryPackages(self, step, buildIds):
+        ret = {}
+        cached = [ bid for bid in buildIds if self.__useCache(bid, ARTIFACT_SUFFIX) ]
+        if cached:
+            ret.update((bid, result) for (bid, result)
+                in (await self.__cache.queryPackages(step, cached)).items()
+                if result[0])
+        downloaders = self.__downloaders()
+        if self.__downloadStrategy == "race":
+            todo = [ bid for bid in buildIds if bid not in ret ]
+            results = await self.__gather(i.queryPackages(step, todo)
+                                          for (n, i) in downloaders) if todo else []
+        else:
+            results = None
+        for (k, (n, i)) in enumerate(downloaders):
+            todo = [ bid for bid in buildIds if not ret.get(bid, (False,))[0] ]
+            if not todo: break
+            result = results[k] if results is not None else await i.queryPackages(step, todo)
+            for bid in todo:
+                (exists, size) = result.get(bid, (False, None))
+                if exists or (exists is None):
+                    ret[bid] = (exists, size)
+        return { bid : ret.get(bid, (False, None)) for bid in buildIds }
+
+    async def queryPackage(self, step, buildId):
+        if self.__useCache(buildId, ARTIFACT_SUFFIX):
+            exists, size = await self.__cache.queryPackage(step, buildId)
+            if exists: return (exists, size)
+        downloaders = self.__downloaders()
+        if self.__downloadStrategy == "race":
+            (hit, result, others) = await self.__race(
+                [ self.__timed(n, i.queryPackage(step, buildId)) for (n, i) in downloaders ],
+                lambda ret: ret[0])
+            if hit is not None: return result
+            results = [ r for (n, r) in others ]
+        else:
+            results = []
+            for (n, i) in downloaders:
+                exists, size = await self.__timed(n, i.queryPackage(step, buildId))
+                if exists: return (exists, size)
+                results.append((exists, size))
+        if any(exists is None for (exists, size) in results):
+            return (None, None)
+        return (False, None)
+
     def upload(self, step, buildIdFile, tgzFile):
         return "\n".join(
             i.upload(step, buildIdFile, tgzFile) for i in self.__archives
@@ -1024,15 +3439,29 @@ class MultiArchive:
             if i.canDownloadJenkins())
 
     async def uploadLocalLiveBuildId(self, step, liveBuildId, buildId):
-        for i in self.__archives:
-            if not i.canUploadLocal(): continue
-            await i.uploadLocalLiveBuildId(step, liveBuildId, buildId)
+        uploaders = [ i for i in self.__archives if i.canUploadLocal() ]
+        if self.__uploadStrategy == "parallel":
+            await self.__gather(i.uploadLocalLiveBuildId(step, liveBuildId, buildId)
+                                for i in uploaders)
+        else:
+            for i in uploaders:
+                await i.uploadLocalLiveBuildId(step, liveBuildId, buildId)
 
     async def downloadLocalLiveBuildId(self, step, liveBuildId):
+        if self.__useCache(liveBuildId, BUILDID_SUFFIX):
+            ret = await self.__cache.downloadLocalLiveBuildId(step, liveBuildId)
+            if ret is not None: return ret
+        downloaders = self.__downloaders()
+        if self.__downloadStrategy == "race":
+            # Build-ids are small. Just download them from all backends.
+            (hit, result, others) = await self.__race(
+                [ self.__timed(n, i.downloadLocalLiveBuildId(step, liveBuildId))
+                  for (n, i) in downloaders ],
+                lambda ret: ret is not None)
+            return result
         ret = None
-        for i in self.__archives:
-            if not i.canDownloadLocal(): continue
-            ret = await i.downloadLocalLiveBuildId(step, liveBuildId)
+        for (n, i) in downloaders:
+            ret = await self.__timed(n, i.downloadLocalLiveBuildId(step, liveBuildId))
             if ret is not None: break
         return ret
 
@@ -1041,6 +3470,17 @@ class MultiArchive:
             i.uploadJenkinsLiveBuildId(step, liveBuildId, buildId)
             for i in self.__archives if i.canUploadJenkins())
 
+    async def finish(self):
+        # Lookups that lost a race must not outlive the build.
+        while self.__detached:
+            await asyncio.wait(list(self.__detached))
+
+    def getStatistics(self):
+        ret = []
+        if self.__cache is not None: ret.extend(self.__cache.getStatistics())
+        for i in self.__archives: ret.extend(i.getStatistics())
+        return ret
+
 
 def getSingleArchiver(recipes, archiveSpec):
     archiveBackend = archiveSpec.get("backend", "none")
@@ -1059,8 +3499,15 @@ def getSingleArchiver(recipes, archiveSpec):
 
 def getArchiver(recipes):
     archiveSpec = recipes.archiveSpec()
-    if isinstance(archiveSpec, list):
-        return MultiArchive([ getSingleArchiver(recipes, i) for i in archiveSpec ])
+    cacheSpec = recipes.archiveCache()
+    strategy = recipes.archiveStrategy()
+    if cacheSpec is not None:
+        if not isinstance(archiveSpec, list): archiveSpec = [archiveSpec]
+        return MultiArchive([ getSingleArchiver(recipes, i) for i in archiveSpec ],
+                            ArchiveCache(cacheSpec), strategy)
+    elif isinstance(archiveSpec, list):
+        return MultiArchive([ getSingleArchiver(recipes, i) for i in archiveSpec ],
+                            None, strategy)
     else:
         return getSingleArchiver(recipes, archiveSpec)
 
@@ -3,10 +3,12 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+from ..archive import openArtifactReader, ARCHIVE_VERSIONS, MANIFEST_FILE
 from ..errors import BobError
-from ..utils import binStat, asHexStr
+from ..utils import binStat, asHexStr, removePath
 from ..audit import Audit
 from functools import lru_cache
+from tempfile import mkstemp
 import argparse
 import os, os.path
 import re
@@ -20,10 +22,52 @@ import pyparsing
 # need to enable this for nested expression parsing performance
 pyparsing.ParserElement.enablePackrat()
 
+DIR_SCHEMA = re.compile(r'[0-9a-zA-Z]{2}')
+ARCHIVE_SCHEMA = re.compile(r'[0-9a-zA-Z]{36}-1\.(tgz|unpacked)')
+MANIFEST_SCHEMA = re.compile(r'[0-9a-zA-Z]{36}-1\.(tgz|chunks|unpacked)')
+
+def listArtifacts(schema=ARCHIVE_SCHEMA):
+    """Yield the relative paths of all artifacts in the current directory."""
+    for l1 in os.listdir("."):
+        if not DIR_SCHEMA.fullmatch(l1): continue
+        for l2 in os.listdir(l1):
+            if not DIR_SCHEMA.fullmatch(l2): continue
+            l2 = os.path.join(l1, l2)
+            for l3 in os.listdir(l2):
+                if not schema.fullmatch(l3): continue
+                yield os.path.join(l2, l3)
+
+def writeManifest():
+    """Write the manifest of all artifacts in the current directory.
+
+    The manifest is replaced atomically so that concurrent readers always see
+    a complete file.
+    """
+    try:
+        # unpacked artifacts are directories and have no meaningful size
+        entries = [ (i, os.stat(i).st_size if os.path.isfile(i) else None)
+                    for i in sorted(listArtifacts(MANIFEST_SCHEMA)) ]
+        (tmpFd, tmpName) = mkstemp(dir=".", prefix=".manifest")
+        try:
+            with os.fdopen(tmpFd, "w") as f:
+                for (name, size) in entries:
+                    if size is None:
+                        f.write("{}\n".format(name))
+                    else:
+                        f.write("{} {}\n".format(name, size))
+            umask = os.umask(0o022)
+            os.umask(umask)
+            os.chmod(tmpName, 0o666 & ~umask)
+            os.replace(tmpName, MANIFEST_FILE)
+        except:
+            os.unlink(tmpName)
+            raise
+    except OSError as e:
+        raise BobError("Cannot write manifest: " + str(e))
+    return len(entries)
+
 class ArchiveScanner:
     def __init__(self):
-        self.__dirSchema = re.compile(r'[0-9a-zA-Z]{2}')
-        self.__archiveSchema = re.compile(r'[0-9a-zA-Z]{36}-1.tgz')
         self.__db = None
 
     def __enter__(self):
@@ -43,14 +87,8 @@ class ArchiveScanner:
 
     def scan(self, verbose):
         try:
-            for l1 in os.listdir("."):
-                if not self.__dirSchema.fullmatch(l1): continue
-                for l2 in os.listdir(l1):
-                    if not self.__dirSchema.fullmatch(l2): continue
-                    l2 = os.path.join(l1, l2)
-                    for l3 in os.listdir(l2):
-                        if not self.__archiveSchema.fullmatch(l3): continue
-                        self.__scan(os.path.join(l2, l3), verbose)
+            for fileName in listArtifacts():
+                self.__scan(fileName, verbose)
         except OSError as e:
             raise BobError("Error scanning archive: " + str(e))
 
@@ -68,24 +106,13 @@ class ArchiveScanner:
 
             # read audit trail
             if verbose: print(fileName)
-            with tarfile.open(fileName, errorlevel=1) as tar:
-                # validate
-                if tar.pax_headers.get('bob-archive-vsn') != "1":
-                    print("Not a Bob archive:", fileName, "Ignored!")
-                    return
-
-                # find audit trail
-                f = tar.next()
-                while f:
-                    if f.name == "meta/audit.json.gz": break
-                    f = tar.next()
-                else:
-                    raise Error("Missing audit trail!")
-
-                # read audit trail
-                auditJsonGz = tar.extractfile(f)
-                auditJson = gzip.GzipFile(fileobj=auditJsonGz)
-                audit = Audit.fromByteStream(auditJson, fileName)
+            if os.path.isdir(fileName):
+                audit = self.__readUnpackedAudit(fileName)
+            else:
+                audit = self.__readAudit(fileName)
+            if audit is None:
+                print("Not a Bob archive:", fileName, "Ignored!")
+                return
 
             # import data
             artifact = audit.getArtifact()
@@ -103,6 +130,35 @@ class ArchiveScanner:
         except OSError as e:
             raise BobError(str(e))
 
+    @staticmethod
+    def __readAudit(fileName):
+        with open(fileName, "rb") as f, openArtifactReader(f) as tar:
+            # validate
+            if tar.pax_headers.get('bob-archive-vsn') not in ARCHIVE_VERSIONS:
+                return None
+
+            # find audit trail
+            f = tar.next()
+            while f:
+                if f.name == "meta/audit.json.gz": break
+                f = tar.next()
+            else:
+                raise Error("Missing audit trail!")
+
+            # read audit trail
+            auditJsonGz = tar.extractfile(f)
+            auditJson = gzip.GzipFile(fileobj=auditJsonGz)
+            return Audit.fromByteStream(auditJson, fileName)
+
+    @staticmethod
+    def __readUnpackedAudit(fileName):
+        auditName = os.path.join(fileName, "audit.json.gz")
+        if not os.path.isfile(auditName):
+            return None
+        with open(auditName, "rb") as auditJsonGz:
+            auditJson = gzip.GzipFile(fileobj=auditJsonGz)
+            return Audit.fromByteStream(auditJson, fileName)
+
     def remove(self, bid):
         try:
             del self.__db[bid]
@@ -310,9 +366,11 @@ def doArchiveClean(argv):
         for bid in scanner.getBuildIds():
             if bid in retained: continue
             victim = asHexStr(bid)
-            victim = os.path.join(victim[0:2], victim[2:4], victim[4:] + "-1.tgz")
+            victim = os.path.join(victim[0:2], victim[2:4], victim[4:] + "-1")
+            unpacked = victim + ".unpacked"
+            victim += ".tgz"
             if args.dry_run:
-                print(victim)
+                print(unpacked if os.path.isdir(unpacked) else victim)
             else:
                 try:
                     os.unlink(victim)
@@ -320,11 +378,27 @@ def doArchiveClean(argv):
                     pass
                 except OSError as e:
                     raise BobError("Cannot remove {}: {}".format(victim, str(e)))
+                removePath(unpacked)
                 scanner.remove(bid)
 
+    # keep an existing manifest up to date
+    if not args.dry_run and os.path.exists(MANIFEST_FILE):
+        writeManifest()
+
+def doArchiveManifest(argv):
+    parser = argparse.ArgumentParser(prog="bob archive manifest")
+    parser.add_argument("-v", "--verbose", action='store_true',
+        help="Verbose operation")
+    args = parser.parse_args(argv)
+
+    num = writeManifest()
+    if args.verbose:
+        print("Listed {} artifacts in {}".format(num, MANIFEST_FILE))
+
 availableArchiveCmds = {
     "scan" : (doArchiveScan, "Scan archive for new artifacts"),
     "clean" : (doArchiveClean, "Clean archive from unneeded artifacts"),
+    "manifest" : (doArchiveManifest, "Write manifest of all artifacts"),
 }
 
 def doArchive(argv, bobRoot):
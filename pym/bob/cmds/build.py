@@ -9,11 +9,16 @@ from ..audit import Audit
 from ..errors import BobError, BuildError, ParseError, MultiBobError
 from ..input import RecipeSet
 from ..state import BobState
-from ..tty import colorize, setVerbosity, setTui, log, stepMessage, stepAction, stepExec, \
-    SKIPPED, EXECUTED, INFO, WARNING, DEFAULT, \
+from ..store import ContentStore, releaseWorkspace
+from ..trace import enableTrace, traceLane, traceSpan, writeTrace
+from ..tty import colorize, setVerbosity, setTui, setShowTail, log, stepMessage, stepAction, stepExec, \
+    SKIPPED, EXECUTED, INFO, WARNING, ERROR, DEFAULT, HEADLINE, \
     ALWAYS, IMPORTANT, NORMAL, INFO, DEBUG, TRACE
 from ..utils import asHexStr, hashDirectory, hashFile, removePath, \
-    emptyDirectory, copyTree, isWindows, processDefines
+    emptyDirectory, copyTree, copyFiles, isWindows, processDefines, OutputTail, \
+    currentTask, allTasks
+from ..worker import WorkerPool, WorkerUnavailableError, WorkerTimeoutError, \
+    readToken, BASE_VAR, PATH_VAR, SANDBOX_VAR, DEFAULT_TIMEOUT
 from datetime import datetime
 from glob import glob
 from pipes import quote
@@ -22,7 +27,10 @@ import argparse
 import asyncio
 import concurrent.futures
 import datetime
+import gzip
+import heapq
 import io
+import json
 import multiprocessing
 import os
 import re
@@ -52,9 +60,26 @@ async def gatherTasks(tasks):
 #    ==  1: package name, package steps, stderr, stdout
 #    ==  2: package name, package steps, stderr, stdout, set -x
 
-def hashWorkspace(step):
-    return hashDirectory(step.getWorkspacePath(),
-        os.path.join(step.getWorkspacePath(), "..", "cache.bin"))
+def hashWorkspace(step, digests=None):
+    with traceSpan(step, "HASH", "hash"):
+        return hashDirectory(step.getWorkspacePath(),
+            os.path.join(step.getWorkspacePath(), "..", "cache.bin"),
+            digests=digests)
+
+def compressLogFile(logFile):
+    """Append log file to its compressed counterpart and remove it."""
+    try:
+        with open(logFile, "rb") as src:
+            with gzip.open(logFile + ".gz", "ab") as dst:
+                shutil.copyfileobj(src, dst, 0x100000)
+        os.unlink(logFile)
+    except FileNotFoundError:
+        pass
+
+def expandShellVariables(text, env):
+    """Expand ``$VAR`` and ``${VAR}`` like the shell. Unset variables are empty."""
+    return re.sub(r'\$(?:\{(\w+)\}|(\w+))',
+                  lambda m: env.get(m.group(1) or m.group(2), ""), text)
 
 def runHook(recipes, hook, args):
     hookCmd = recipes.getBuildHook(hook)
@@ -68,18 +93,83 @@ def runHook(recipes, hook, args):
 
     return ret
 
-class RestartBuildException(Exception):
+class CancelBuildException(Exception):
     pass
 
-class CancelBuildException(Exception):
+class StepFailedException(CancelBuildException):
+    """The build is cancelled because the step of a task failed by itself."""
     pass
 
+class JobRunners:
+    """The numbered job slots of the LocalBuilder.
+
+    A task holds at most one slot at a time. The number of the slot is used as
+    lane of the task in the build trace.
+    """
+
+    def __init__(self, jobs):
+        self.__slots = asyncio.BoundedSemaphore(jobs)
+        self.__free = list(range(jobs))
+        self.__held = {}
+
+    async def acquire(self):
+        await self.__slots.acquire()
+        slot = heapq.heappop(self.__free)
+        self.__held[currentTask()] = slot
+        traceLane(slot)
+
+    def release(self):
+        slot = self.__held.pop(currentTask())
+        heapq.heappush(self.__free, slot)
+        traceLane(None)
+        self.__slots.release()
+
+class JobSlot:
+    """Holds one job slot of the LocalBuilder while being entered."""
+
+    def __init__(self, runners, step):
+        self.__runners = runners
+        self.__step = step
+
+    async def __aenter__(self):
+        with traceSpan(self.__step, "WAIT", "runner"):
+            await self.__runners.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.__runners.release()
+        return False
+
+class CookNode:
+    """Step in the dependency graph of the parallel LocalBuilder executor.
+
+    A node is ready to be dispatched when the number of pending dependencies
+    drops to zero. The future is resolved with True if the step was cooked
+    successfully or with False if it or any of its dependencies failed.
+    """
+
+    __slots__ = ('step', 'checkoutOnly', 'depth', 'seq', 'pending',
+                 'dependents', 'future')
+
+    def __init__(self, step, checkoutOnly, depth):
+        self.step = step
+        self.checkoutOnly = checkoutOnly
+        self.depth = depth
+        self.seq = 0
+        self.pending = 0
+        self.dependents = []
+        self.future = asyncio.get_event_loop().create_future()
+
+    def __lt__(self, other):
+        return self.seq < other.seq
+
 class LocalBuilderStatistic:
     def __init__(self):
         self.__activeOverrides = set()
         self.checkouts = 0
         self.packagesBuilt = 0
         self.packagesDownloaded = 0
+        self.archives = []
 
     def addOverrides(self, overrides):
         self.__activeOverrides.update(overrides)
@@ -87,6 +177,23 @@ class LocalBuilderStatistic:
     def getActiveOverrides(self):
         return self.__activeOverrides
 
+class BuildPlanEntry:
+    """Planned action for a single step.
+
+    The 'decision' is one of "skip", "checkout", "build", "download",
+    "download?" (availability unknown) or "fail". The estimated duration is
+    taken from the last execution and may be None if unknown. The 'changed'
+    flag tells if the result of the step is expected to change.
+    """
+    def __init__(self, step, decision, reason, size=None, estimate=None,
+                 changed=None):
+        self.step = step
+        self.decision = decision
+        self.reason = reason
+        self.size = size
+        self.estimate = estimate
+        self.changed = (decision != "skip") if changed is None else changed
+
 class DevelopDirOracle:
     """
     Calculate directory names for develop mode.
@@ -231,6 +338,9 @@ class DevelopDirOracle:
 
 class LocalBuilder:
 
+    # number of output lines that are shown if a step fails in parallel builds
+    ERROR_TAIL_LINES = 1000
+
     RUN_TEMPLATE = """#!/bin/bash
 
 on_exit()
@@ -442,9 +552,23 @@ esac
         self.__alwaysCheckout = []
         self.__linkDeps = True
         self.__buildIdLocks = {}
+        self.__unpredictableSrcIds = set()
+        self.__plan = []
+        self.__planned = {}
+        self.__planBuildIds = {}
+        self.__planQueries = {}
+        self.__knownSteps = {}
+        self.__invalidated = {}
+        self.__rewalk = False
         self.__jobs = 1
         self.__bufferedStdIO = False
         self.__keepGoing = False
+        self.__prefetch = False
+        self.__workers = WorkerPool([])
+        self.__archived = set()
+        self.__compressLogFiles = False
+        self.__directLaunch = False
+        self.__contentStore = None
 
     def setArchiveHandler(self, archive):
         self.__archive = archive
@@ -494,6 +618,21 @@ esac
     def setKeepGoing(self, keepGoing):
         self.__keepGoing = keepGoing
 
+    def setPrefetch(self, prefetch):
+        self.__prefetch = prefetch
+
+    def setWorkers(self, addresses, token, timeout):
+        self.__workers = WorkerPool(addresses, token, timeout)
+
+    def setCompressLogFiles(self, compress):
+        self.__compressLogFiles = compress
+
+    def setDirectLaunch(self, direct):
+        self.__directLaunch = direct
+
+    def setContentStore(self, store):
+        self.__contentStore = store
+
     def saveBuildState(self):
         state = {}
         # Save 'wasRun' as plain dict. Skipped steps are dropped because they
@@ -535,12 +674,7 @@ esac
         path = step.getWorkspacePath()
         self.__wasRun[path] = (step.getVariantId(), isCheckoutStep)
         self.__wasSkipped[path] = skipped
-
-    def _clearWasRun(self):
-        """Clear "was-run" info for build- and package-steps."""
-        self.__wasRun = { path : (vid, isCheckoutStep)
-            for path, (vid, isCheckoutStep) in self.__wasRun.items()
-            if isCheckoutStep }
+        self.__knownSteps[path] = step
 
     def _constructDir(self, step, label):
         created = False
@@ -551,6 +685,10 @@ esac
         return (workDir, created)
 
     async def _generateAudit(self, step, depth, resultHash, executed=True):
+        with traceSpan(step, "AUDIT", "audit"):
+            return await self.__generateAudit(step, depth, resultHash, executed)
+
+    async def __generateAudit(self, step, depth, resultHash, executed):
         if step.isCheckoutStep():
             buildId = resultHash
         else:
@@ -640,78 +778,119 @@ esac
                                         "{:02}-{}".format(i, a.getPackage().getName())))
                 i += 1
 
-    async def _runShell(self, step, scriptName, cleanWorkspace, logger):
-        workspacePath = step.getWorkspacePath()
-        if cleanWorkspace: emptyDirectory(workspacePath)
-        if not os.path.isdir(workspacePath): os.makedirs(workspacePath)
-        self.__linkDependencies(step)
+    def __getSandboxArgs(self, step):
+        """Get the namespace-sandbox invocation of a step.
+
+        The sandbox directory (``-S``), the mounts and the command are not
+        included.
+        """
+        sandbox = [ os.path.join(self.__bobRoot, "bin", "namespace-sandbox") ]
+        if self.__verbose >= TRACE:
+            sandbox.append('-D')
+        sandbox.extend(["-W", step.getExecPath()])
+        sandbox.extend(["-H", "bob"])
+        sandbox.extend(["-d", "/tmp"])
+        if not step.hasNetAccess(): sandbox.append('-n')
+        return sandbox
+
+    def __getSandboxMounts(self, step):
+        """Get all mounts of the sandbox of a step.
+
+        Every entry is a tuple of the host path, the path in the sandbox, the
+        mount flag ("-m", "-w" or None), whether the paths are subject to shell
+        variable expansion and whether the mount is optional.
+        """
+        mounts = []
+        sandboxRootFs = os.path.abspath(
+            step.getSandbox().getStep().getWorkspacePath())
+        for f in os.listdir(sandboxRootFs):
+            mounts.append((os.path.join(sandboxRootFs, f), "/"+f, "-m", False, False))
+        for (hostPath, sndbxPath, options) in step.getSandbox().getMounts():
+            if "nolocal" in options: continue # skip for local builds?
+            if "rw" in options:
+                flag = "-w"
+            elif hostPath != sndbxPath:
+                flag = "-m"
+            else:
+                flag = None
+            mounts.append((hostPath, sndbxPath, flag, True, "nofail" in options))
+        mounts.append((os.path.abspath(os.path.join(step.getWorkspacePath(), "..")),
+                       os.path.normpath(os.path.join(step.getExecPath(), "..")),
+                       "-w", False, False))
+        addDep = lambda s: (mounts.append((os.path.abspath(s.getWorkspacePath()),
+                s.getExecPath(), "-m", False, False)) if s.isValid() else None)
+        for s in step.getAllDepSteps(): addDep(s)
+        # special handling to mount all previous steps of current package
+        s = step
+        while s.isValid():
+            if len(s.getArguments()) > 0:
+                s = s.getArguments()[0]
+                addDep(s)
+            else:
+                break
+        return mounts
+
+    def _generateScripts(self, step, scriptName, cleanWorkspace, remote=False):
+        """Generate the environment, run file and script of a step.
+
+        Returns a tuple of the step environment and the content of the run
+        file and the script. Nothing is written to the workspace.
+
+        Remote scripts are executed by a worker in a different directory. They
+        refer to the project root, the system PATH and the sandbox helper of
+        the worker by environment variables that are set by the worker.
+        """
+        if remote:
+            systemPath = "${" + PATH_VAR + "}"
+            base = os.getcwd() + os.sep
+            def quotePath(path):
+                if path == systemPath:
+                    return '"' + path + '"'
+                elif path.startswith(base):
+                    return '"${' + BASE_VAR + '}"/' + quote(path[len(base):])
+                else:
+                    return quote(path)
+        else:
+            systemPath = os.environ["PATH"]
+            quotePath = quote
 
         # construct environment
         stepEnv = step.getEnv().copy()
         if step.getSandbox() is None:
-            stepEnv["PATH"] = ":".join(step.getPaths() + [os.environ["PATH"]])
+            paths = step.getPaths() + [systemPath]
         else:
-            stepEnv["PATH"] = ":".join(step.getPaths() + step.getSandbox().getPaths())
+            paths = step.getPaths() + step.getSandbox().getPaths()
+        stepEnv["PATH"] = ":".join(paths)
         stepEnv["LD_LIBRARY_PATH"] = ":".join(step.getLibraryPaths())
         stepEnv["BOB_CWD"] = step.getExecPath()
-
-        # filter runtime environment
-        if self.__preserveEnv:
-            runEnv = os.environ.copy()
-        else:
-            runEnv = { k:v for (k,v) in os.environ.items()
-                                     if k in self.__envWhiteList }
-        runEnv.update(stepEnv)
+        quotedEnv = { k : quote(v) for (k,v) in stepEnv.items() }
+        if remote:
+            quotedEnv["PATH"] = ":".join(quotePath(p) for p in paths)
+            quotedEnv["LD_LIBRARY_PATH"] = ":".join(quotePath(p)
+                for p in step.getLibraryPaths()) or quote("")
+            quotedEnv["BOB_CWD"] = quotePath(stepEnv["BOB_CWD"])
 
         # sandbox
         if step.getSandbox() is not None:
             sandboxSetup = "\"$(mktemp -d)\""
             sandboxMounts = [ "declare -a mounts=( )" ]
-            sandbox = [ quote(os.path.join(self.__bobRoot, "bin", "namespace-sandbox")) ]
-            if self.__verbose >= TRACE:
-                sandbox.append('-D')
+            sandbox = [ quote(a) for a in self.__getSandboxArgs(step) ]
+            if remote: sandbox[0] = '"${' + SANDBOX_VAR + '}"'
             sandbox.extend(["-S", "\"$_sandbox\""])
-            sandbox.extend(["-W", quote(step.getExecPath())])
-            sandbox.extend(["-H", "bob"])
-            sandbox.extend(["-d", "/tmp"])
-            if not step.hasNetAccess(): sandbox.append('-n')
-            sandboxRootFs = os.path.abspath(
-                step.getSandbox().getStep().getWorkspacePath())
-            for f in os.listdir(sandboxRootFs):
-                sandboxMounts.append("mounts+=( -M {} -m /{} )".format(
-                    quote(os.path.join(sandboxRootFs, f)), quote(f)))
-            for (hostPath, sndbxPath, options) in step.getSandbox().getMounts():
-                if "nolocal" in options: continue # skip for local builds?
-                line = "-M " + hostPath
-                if "rw" in options:
-                    line += " -w " + sndbxPath
-                elif hostPath != sndbxPath:
-                    line += " -m " + sndbxPath
+            for (hostPath, sndbxPath, flag, expand, optional) in self.__getSandboxMounts(step):
+                q = (lambda x: x) if expand else quote
+                qHost = q if expand else quotePath
+                line = "-M " + qHost(hostPath)
+                if flag is not None:
+                    line += " " + flag + " " + q(sndbxPath)
                 line = "mounts+=( " + line + " )"
-                if "nofail" in options:
+                if optional:
                     sandboxMounts.append(
                         """if [[ -e {HOST} ]] ; then {MOUNT} ; fi"""
-                            .format(HOST=hostPath, MOUNT=line)
+                            .format(HOST=qHost(hostPath), MOUNT=line)
                         )
                 else:
                     sandboxMounts.append(line)
-            sandboxMounts.append("mounts+=( -M {} -w {} )".format(
-                quote(os.path.abspath(os.path.join(
-                    step.getWorkspacePath(), ".."))),
-                quote(os.path.normpath(os.path.join(
-                    step.getExecPath(), ".."))) ))
-            addDep = lambda s: (sandboxMounts.append("mounts+=( -M {} -m {} )".format(
-                    quote(os.path.abspath(s.getWorkspacePath())),
-                    quote(s.getExecPath()) )) if s.isValid() else None)
-            for s in step.getAllDepSteps(): addDep(s)
-            # special handling to mount all previous steps of current package
-            s = step
-            while s.isValid():
-                if len(s.getArguments()) > 0:
-                    s = s.getArguments()[0]
-                    addDep(s)
-                else:
-                    break
             sandbox.append('"${mounts[@]}"')
             sandbox.append("--")
         else:
@@ -719,27 +898,24 @@ esac
             sandboxMounts = []
             sandboxSetup = ""
 
-        # write scripts
-        runFile = os.path.join("..", scriptName+".sh")
-        absRunFile = os.path.normpath(os.path.join(workspacePath, runFile))
-        absRunFile = os.path.join(".", absRunFile)
-        with open(absRunFile, "w") as f:
+        # generate scripts
+        with io.StringIO() as f:
             print(LocalBuilder.RUN_TEMPLATE.format(
                     ENV=" ".join(sorted([
-                        "{}={}".format(key, quote(value))
-                        for (key, value) in stepEnv.items() ])),
+                        "{}={}".format(key, value)
+                        for (key, value) in quotedEnv.items() ])),
                     WHITELIST=" ".join(sorted([
                         '${'+key+'+'+key+'="$'+key+'"}'
                         for key in self.__envWhiteList ])),
                     ARGS=" ".join([
-                        quote(a.getExecPath())
+                        quotePath(a.getExecPath())
                         for a in step.getArguments() ]),
                     SANDBOX_CMD="\n    ".join(sandboxMounts + [" ".join(sandbox)]),
                     SANDBOX_SETUP=sandboxSetup,
                     CLEAN="1" if cleanWorkspace else "0",
                 ), file=f)
-        scriptFile = os.path.join(workspacePath, "..", "script")
-        with open(scriptFile, "w") as f:
+            runScript = f.getvalue()
+        with io.StringIO() as f:
             f.write(dedent("""\
                 # Error handling
                 bob_handle_error()
@@ -768,26 +944,73 @@ esac
                 """))
             print("declare -A BOB_ALL_PATHS=( {} )".format(" ".join(sorted(
                 [ "[{}]={}".format(quote(a.getPackage().getName()),
-                                   quote(a.getExecPath()))
+                                   quotePath(a.getExecPath()))
                     for a in step.getAllDepSteps() ] ))), file=f)
             print("declare -A BOB_DEP_PATHS=( {} )".format(" ".join(sorted(
                 [ "[{}]={}".format(quote(a.getPackage().getName()),
-                                   quote(a.getExecPath()))
+                                   quotePath(a.getExecPath()))
                     for a in step.getArguments() if a.isValid() ] ))), file=f)
             print("declare -A BOB_TOOL_PATHS=( {} )".format(" ".join(sorted(
-                [ "[{}]={}".format(quote(n), quote(os.path.join(t.getStep().getExecPath(), t.getPath())))
+                [ "[{}]={}".format(quote(n), quotePath(os.path.join(t.getStep().getExecPath(), t.getPath())))
                     for (n,t) in step.getTools().items()] ))), file=f)
             print("", file=f)
             print("# Environment:", file=f)
-            for (k,v) in sorted(stepEnv.items()):
-                print("export {}={}".format(k, quote(v)), file=f)
+            for (k,v) in sorted(quotedEnv.items()):
+                print("export {}={}".format(k, v), file=f)
+            if remote:
+                print("unset {} {} {}".format(BASE_VAR, PATH_VAR, SANDBOX_VAR), file=f)
             print("declare -p > ../env", file=f)
             print("", file=f)
             print("# BEGIN BUILD SCRIPT", file=f)
             print(step.getScript(), file=f)
             print("# END BUILD SCRIPT", file=f)
+            script = f.getvalue()
+
+        return (stepEnv, runScript, script)
+
+    def __prepareWorkspace(self, step, scriptName, cleanWorkspace):
+        """Prepare the workspace of a step and write the run file and script.
+
+        Returns the step environment and the path of the run file.
+        """
+        workspacePath = step.getWorkspacePath()
+        if cleanWorkspace:
+            emptyDirectory(workspacePath)
+            releaseWorkspace(workspacePath)
+        if not os.path.isdir(workspacePath): os.makedirs(workspacePath)
+        self.__linkDependencies(step)
+
+        stepEnv, runScript, script = self._generateScripts(step, scriptName,
+            cleanWorkspace)
+
+        # write scripts
+        runFile = os.path.join("..", scriptName+".sh")
+        absRunFile = os.path.normpath(os.path.join(workspacePath, runFile))
+        absRunFile = os.path.join(".", absRunFile)
+        with open(absRunFile, "w") as f:
+            f.write(runScript)
+        scriptFile = os.path.join(workspacePath, "..", "script")
+        with open(scriptFile, "w") as f:
+            f.write(script)
         os.chmod(absRunFile, stat.S_IRWXU | stat.S_IRGRP | stat.S_IWGRP |
             stat.S_IROTH | stat.S_IWOTH)
+
+        return (stepEnv, absRunFile)
+
+    async def _runShell(self, step, scriptName, cleanWorkspace, logger):
+        workspacePath = step.getWorkspacePath()
+        stepEnv, absRunFile = self.__prepareWorkspace(step, scriptName, cleanWorkspace)
+
+        # filter runtime environment
+        if self.__preserveEnv:
+            shellEnv = os.environ.copy()
+        else:
+            shellEnv = { k:v for (k,v) in os.environ.items()
+                                     if k in self.__envWhiteList }
+        runEnv = shellEnv.copy()
+        runEnv.update(stepEnv)
+
+        runFile = os.path.join("..", scriptName+".sh")
         cmdLine = ["/bin/bash", runFile, "__run"]
         if self.__verbose < NORMAL:
             cmdLine.append('-q')
@@ -798,13 +1021,20 @@ esac
         if self.__noLogFile:
             cmdLine.append('-n')
 
+        startTime = time.monotonic()
         try:
-            if self.__bufferedStdIO:
+            if self.__directLaunch:
+                ret = await self.__runDirect(step, runEnv, shellEnv, logger)
+            elif self.__bufferedStdIO:
                 ret = await self.__runShellBuffered(cmdLine, step.getWorkspacePath(), runEnv, logger)
             else:
                 ret = await self.__runShellRegular(cmdLine, step.getWorkspacePath(), runEnv)
         except OSError as e:
             raise BuildError("Cannot execute build script {}: {}".format(absRunFile, str(e)))
+        finally:
+            if self.__compressLogFiles and not self.__noLogFile:
+                await asyncio.get_event_loop().run_in_executor(None, compressLogFile,
+                    os.path.join(workspacePath, "..", "log.txt"))
 
         if ret == -int(signal.SIGINT):
             raise BuildError("User aborted while running {}".format(absRunFile),
@@ -814,6 +1044,9 @@ esac
                                 .format(absRunFile, ret),
                              help="You may resume at this point with '--resume' after fixing the error.")
 
+        # remember how long it took for the build planner
+        BobState().setStepDuration(workspacePath, scriptName, time.monotonic() - startTime)
+
     async def __runShellRegular(self, cmdLine, cwd, env):
         proc = await asyncio.create_subprocess_exec(*cmdLine, cwd=cwd, env=env)
         ret = None
@@ -825,22 +1058,184 @@ esac
         return ret
 
     async def __runShellBuffered(self, cmdLine, cwd, env, logger):
-        with tempfile.TemporaryFile() as tmp:
+        proc = await asyncio.create_subprocess_exec(*cmdLine, cwd=cwd, env=env,
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        tail = OutputTail(LocalBuilder.ERROR_TAIL_LINES)
+        capture = asyncio.ensure_future(self.__pumpOutput(proc.stdout, None,
+            self.__feedTail(tail, logger)))
+        ret = None
+        while ret is None:
+            try:
+                ret = await proc.wait()
+            except concurrent.futures.CancelledError:
+                pass
+
+        # Background processes of the step might still hold the pipe open.
+        # Don't wait for them indefinitely.
+        done, pending = await asyncio.wait([capture], timeout=1)
+        if pending: capture.cancel()
+
+        if ret != 0 and ret != -int(signal.SIGINT):
+            self.__setErrorTail(logger, tail, cwd)
+
+        return ret
+
+    def __setErrorTail(self, logger, tail, cwd):
+        """Show the tail of the output of a failed step.
+
+        Only the last lines of the output are kept. Point to the log file for
+        the complete output. It is compressed after the step has finished.
+        """
+        lines = [ tail.getText() ]
+        if not self.__noLogFile:
+            logFile = os.path.normpath(os.path.join(cwd, "..", "log.txt"))
+            if self.__compressLogFiles: logFile += ".gz"
+            lines.append("Complete log: " + logFile)
+        logger.setError("\n".join(l for l in lines if l))
+
+    async def _runCopy(self, step):
+        """Execute the declarative packageCopy of a package step natively.
+
+        The scripts are still written to allow manual invocations. Returns the
+        digests of the copied files to seed the hash index of the workspace.
+        """
+        workspacePath = step.getWorkspacePath()
+        stepEnv, absRunFile = self.__prepareWorkspace(step, "package", True)
+
+        # The script would have dumped its environment for the audit trail.
+        with open(os.path.join(workspacePath, "..", "env"), "w") as f:
+            for (k,v) in sorted(stepEnv.items()):
+                f.write("declare -x {}={}\n".format(k, quote(v)))
+
+        spec = step.getCopySpec()
+        src = os.path.join(step.getArguments()[0].getWorkspacePath(), spec["from"])
+        startTime = time.monotonic()
+        digests = await asyncio.get_event_loop().run_in_executor(None, copyFiles,
+            src, workspacePath, spec["include"], spec["exclude"])
+        BobState().setStepDuration(workspacePath, "package", time.monotonic() - startTime)
+        return digests
+
+    async def __runDirect(self, step, env, shellEnv, logger):
+        """Execute the script of a step without the run file.
+
+        Only a single shell is spawned for the script. The log file, the
+        redirection of the output and the sandbox are handled here the same
+        way as the ``__run`` mode of the run file does.
+        """
+        cwd = step.getWorkspacePath()
+        if self.__verbose < NORMAL:
+            verbose = 0
+        elif self.__verbose == NORMAL:
+            verbose = 1
+        elif self.__verbose == INFO:
+            verbose = 2
+        else:
+            verbose = 3
+        cmdLine = ["/bin/bash"]
+        if verbose >= 3: cmdLine.append("-x")
+        cmdLine.extend(["--", "../script"])
+        cmdLine.extend(a.getExecPath() for a in step.getArguments())
+
+        sandboxDir = None
+        if step.getSandbox() is not None:
+            sandboxDir = tempfile.mkdtemp()
+            sandbox = self.__getSandboxArgs(step) + ["-S", sandboxDir]
+            for (hostPath, sndbxPath, flag, expand, optional) in self.__getSandboxMounts(step):
+                if expand:
+                    hostPath = expandShellVariables(hostPath, shellEnv)
+                    sndbxPath = expandShellVariables(sndbxPath, shellEnv)
+                if optional and not (hostPath and os.path.exists(os.path.join(cwd, hostPath))):
+                    continue
+                sandbox.extend(["-M", hostPath])
+                if flag is not None: sandbox.extend([flag, sndbxPath])
+            cmdLine = sandbox + ["--"] + cmdLine
+
+        # Where does the output go? Stdout is only shown from verbosity 2 on.
+        # Stderr is shown always except if it is recorded in the log file in
+        # quiet mode.
+        showOut = verbose >= 2
+        showErr = verbose >= 1 or self.__noLogFile
+        log = None
+        tail = None
+        if self.__bufferedStdIO:
+            tail = OutputTail(LocalBuilder.ERROR_TAIL_LINES)
+            feed = self.__feedTail(tail, logger)
+            writeOut = feed if showOut else None
+            writeErr = feed if showErr else None
+        else:
+            def write(stream):
+                def writer(data):
+                    stream.buffer.write(data)
+                    stream.flush()
+                return writer
+            writeOut = write(sys.stdout) if showOut else None
+            writeErr = write(sys.stderr) if showErr else None
+
+        def marker(text):
+            line = "### {}: {}\n".format(text, time.strftime("%a %b %e %H:%M:%S %Z %Y")).encode()
+            if log is not None: log.write(line)
+            if writeOut is not None: writeOut(line)
+
+        try:
+            if not self.__noLogFile:
+                log = open(os.path.join(cwd, "..", "log.txt"), "ab")
+            if log is None and tail is None:
+                # Nothing to intercept. Let the script write to our stdout/stderr.
+                stdout = None if showOut else subprocess.DEVNULL
+                stderr = None if verbose >= 1 else sys.stdout.fileno()
+            else:
+                stdout = stderr = subprocess.PIPE
+            marker("START")
             proc = await asyncio.create_subprocess_exec(*cmdLine, cwd=cwd, env=env,
-                stdin=subprocess.DEVNULL, stdout=tmp, stderr=subprocess.STDOUT)
+                stdin=subprocess.DEVNULL if self.__bufferedStdIO else None,
+                stdout=stdout, stderr=stderr)
+            pumps = []
+            if stdout == subprocess.PIPE:
+                pumps.append(asyncio.ensure_future(self.__pumpOutput(proc.stdout, log, writeOut)))
+                pumps.append(asyncio.ensure_future(self.__pumpOutput(proc.stderr, log, writeErr)))
             ret = None
             while ret is None:
                 try:
                     ret = await proc.wait()
                 except concurrent.futures.CancelledError:
                     pass
-            if ret != 0 and ret != -int(signal.SIGINT):
-                tmp.seek(0)
-                logger.setError(io.TextIOWrapper(tmp).read().strip())
+
+            # Background processes of the step might still hold the pipes open.
+            # Don't wait for them indefinitely.
+            if pumps:
+                done, pending = await asyncio.wait(pumps, timeout=1)
+                for p in pending: p.cancel()
+            marker("END({})".format(ret))
+        finally:
+            if log is not None: log.close()
+            if sandboxDir is not None: shutil.rmtree(sandboxDir, ignore_errors=True)
+
+        if tail is not None and ret != 0 and ret != -int(signal.SIGINT):
+            self.__setErrorTail(logger, tail, cwd)
 
         return ret
 
+    async def __pumpOutput(self, stream, log, write):
+        while True:
+            data = await stream.read(0x10000)
+            if not data: break
+            if log is not None: log.write(data)
+            if write is not None: write(data)
+
+    def __feedTail(self, tail, logger):
+        lastUpdate = 0
+        tailLines = logger.getTailLines()
+        def feed(data):
+            nonlocal lastUpdate
+            tail.feed(data)
+            now = time.monotonic()
+            if tailLines and (now - lastUpdate >= 0.2):
+                logger.setTail(tail.getLines(tailLines))
+                lastUpdate = now
+        return feed
+
     def getStatistic(self):
+        self.__statistic.archives = self.__archive.getStatistics()
         return self.__statistic
 
     def __createTask(self, coro, step=None, tracker=None):
@@ -849,11 +1244,12 @@ esac
         async def wrapTask():
             try:
                 ret = await coro()
-                if tracked:
+                if tracked and (tracker.get(path) is task):
                     # Only remove us from the task list if we finished successfully.
                     # Other concurrent tasks might want to cook the same step again.
-                    # They have to get the same exception again.
-                    del tracker[step.getWorkspacePath()]
+                    # They have to get the same exception again. The entry
+                    # might have been replaced already if we were invalidated.
+                    del tracker[path]
                 return ret
             except BuildError as e:
                 if not self.__keepGoing:
@@ -861,25 +1257,21 @@ esac
                 if step:
                     e.setStack(step.getPackage().getStack())
                 self.__buildErrors.append(e)
-                raise CancelBuildException
-            except RestartBuildException:
-                if self.__running:
-                    log("Restart build due to wrongly predicted sources.", WARNING)
-                    self.__restart = True
-                    self.__running = False
-                raise CancelBuildException
+                raise StepFailedException
             except CancelBuildException:
                 raise
             except concurrent.futures.CancelledError:
                 pass
             except Exception as e:
                 self.__buildErrors.append(e)
-                raise CancelBuildException
+                raise StepFailedException
 
         if tracked:
             path = step.getWorkspacePath()
             task = tracker.get(path)
             if task is not None: return task
+        else:
+            path = None
 
         task = asyncio.get_event_loop().create_task(wrapTask())
         if tracked:
@@ -892,57 +1284,393 @@ esac
             if self.__jobs > 1:
                 log("Cancel all running jobs...", WARNING)
             self.__running = False
-            self.__restart = False
-            for i in asyncio.Task.all_tasks(): i.cancel()
+            for i in allTasks(asyncio.get_event_loop()): i.cancel()
 
         async def dispatcher():
-            if self.__jobs > 1:
-                packageJobs = [
-                    self.__createTask(lambda s=step: self._cookTask(s, checkoutOnly, depth), step)
-                    for step in steps ]
-                await gatherTasks(packageJobs)
-            else:
+            if self.__prefetch and not (checkoutOnly or self.__force):
                 for step in steps:
-                    await self._cookTask(step, checkoutOnly, depth)
+                    if step.isPackageStep(): self.__spawnPrefetch(step, depth)
+            # Walk the tree again as long as some steps were invalidated
+            # because of wrongly predicted sources. Steps that are still
+            # valid are skipped quickly.
+            failed = False
+            self.__rewalk = True
+            while self.__rewalk:
+                self.__rewalk = False
+                if self.__jobs > 1:
+                    nodes = self.__addCookNodes([ s for s in steps
+                        if s.isValid() and not self._wasAlreadyRun(s, checkoutOnly) ],
+                        checkoutOnly, depth)
+                    try:
+                        await self.__waitCookNodes(nodes)
+                    except CancelBuildException:
+                        # Let the other jobs finish. Independent steps are
+                        # still dispatched in case of '--keep-going'. This
+                        # includes invalidated steps that must be walked
+                        # again.
+                        while self.__cookNodeTasks:
+                            await asyncio.wait(list(self.__cookNodeTasks))
+                        if not (self.__running and self.__rewalk): raise
+                        failed = True
+                else:
+                    for step in steps:
+                        await self._cookTask(step, checkoutOnly, depth)
+            if failed: raise CancelBuildException
+            # Prefetches that were not consumed must not outlive the build.
+            await gatherTasks(list(self.__prefetchTasks.values()))
+            await self.__archive.finish()
 
         loop = asyncio.get_event_loop()
-        self.__restart = True
-        while self.__restart:
-            self.__running = True
-            self.__restart = False
-            self.__cookTasks = {}
-            self.__buildIdTasks = {}
-            self.__buildErrors = []
-            self.__runners = asyncio.BoundedSemaphore(self.__jobs)
-
-            j = self.__createTask(dispatcher)
+        self.__running = True
+        self.__cookNodes = {}
+        self.__cookNodeTasks = set()
+        self.__cookNodeSeq = 0
+        self.__readyNodes = []
+        self.__activeNodes = 0
+        self.__buildIdTasks = {}
+        self.__prefetchTasks = {}
+        self.__prefetchVisited = set()
+        self.__prefetchMisses = set()
+        self.__buildErrors = []
+        self.__runners = JobRunners(self.__jobs)
+
+        j = self.__createTask(dispatcher)
+        try:
+            loop.add_signal_handler(signal.SIGINT, cancelJobs)
+        except NotImplementedError:
+            pass # not implemented on windows
+        try:
+            loop.run_until_complete(j)
+        except CancelBuildException:
+            pass
+        except concurrent.futures.CancelledError:
+            pass
+        finally:
             try:
-                loop.add_signal_handler(signal.SIGINT, cancelJobs)
+                loop.remove_signal_handler(signal.SIGINT)
             except NotImplementedError:
                 pass # not implemented on windows
-            try:
-                loop.run_until_complete(j)
-            except CancelBuildException:
-                pass
-            except concurrent.futures.CancelledError:
-                pass
-            finally:
-                try:
-                    loop.remove_signal_handler(signal.SIGINT)
-                except NotImplementedError:
-                    pass # not implemented on windows
 
-            if len(self.__buildErrors) > 1:
-                raise MultiBobError(self.__buildErrors)
-            elif self.__buildErrors:
-                raise self.__buildErrors[0]
+        if len(self.__buildErrors) > 1:
+            raise MultiBobError(self.__buildErrors)
+        elif self.__buildErrors:
+            raise self.__buildErrors[0]
 
         if not self.__running:
             raise BuildError("Canceled by user!",
                              help = "Run again with '--resume' to skip already built packages.")
 
+    def plan(self, steps, checkoutOnly, depth=0):
+        """Determine what cook() would do without actually doing it.
+
+        The decision logic of the regular build is evaluated against the
+        current workspace state and the binary archive. Only the existence of
+        artifacts is checked. Nothing is checked out, built or downloaded.
+        Returns the list of BuildPlanEntry objects in the order of execution.
+        Steps that were already planned by previous invocations are not
+        considered again.
+        """
+        ret = len(self.__plan)
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(self.__planList(steps, None, checkoutOnly, depth))
+        loop.run_until_complete(self.__archive.finish())
+        return self.__plan[ret:]
+
+    async def __planList(self, steps, parentPackage, checkoutOnly, depth):
+        """Plan list of steps.
+
+        Returns True if the result of any step will change.
+        """
+        if self.__skipDeps and (parentPackage is not None):
+            steps = [ s for s in steps if s.getPackage() == parentPackage ]
+        await self.__planQueryPackages(steps, checkoutOnly, depth)
+        changed = False
+        for step in steps:
+            if not step.isValid(): continue
+            path = step.getWorkspacePath()
+            entry = self.__planned.get(path)
+            if entry is None:
+                if step.isCheckoutStep():
+                    entry = await self.__planCheckoutStep(step, depth)
+                elif step.isBuildStep():
+                    entry = await self.__planBuildStep(step, checkoutOnly, depth)
+                else:
+                    entry = await self.__planPackageStep(step, checkoutOnly, depth)
+                self.__planned[path] = entry
+                self.__plan.append(entry)
+            changed = changed or entry.changed
+        return changed
+
+    # The following predicates are shared by the planner and the _cook*Step()
+    # methods. They must take the same decisions.
+
+    @staticmethod
+    def __canDownload(packageStep):
+        """Check if the result of a package step may be up- or downloaded.
+
+        This requires a relocatable package or that we're building in a
+        sandbox with stable paths.
+        """
+        return packageStep.isRelocatable() or (packageStep.getSandbox() is not None)
+
+    @staticmethod
+    def __getDepInputHashes(step):
+        return [ BobState().getResultHash(i.getWorkspacePath())
+            for i in step.getAllDepSteps() if i.isValid() ]
+
+    @staticmethod
+    def __getCheckoutState(checkoutStep):
+        checkoutState = checkoutStep.getScmDirectories().copy()
+        checkoutState[None] = checkoutStep.getVariantId()
+        return checkoutState
+
+    def __checkoutNeedsRun(self, checkoutStep, path, checkoutState, oldCheckoutState,
+                           inputHashes):
+        return (self.__force or (not checkoutStep.isDeterministic()) or
+                (BobState().getResultHash(path) is None) or
+                (checkoutState != oldCheckoutState) or
+                (inputHashes != BobState().getInputHashes(path)))
+
+    def __getBuildDigest(self, buildStep):
+        # Add the execution path of the build step to the buildDigest to
+        # detect changes between sandbox and non-sandbox builds. This is
+        # necessary in any build mode. Include the actual directories of
+        # dependencies in buildDigest too. Directories are reused in
+        # develop build mode and thus might change even though the variant
+        # id of this step is stable. As most tools rely on stable input
+        # directories we have to make a clean build if any of the
+        # dependency directories change.
+        return [self.__getIncrementalVariantId(buildStep), buildStep.getExecPath()] + \
+            [ i.getExecPath() for i in buildStep.getArguments() if i.isValid() ]
+
+    @staticmethod
+    def __getPackageInputHashes(packageStep):
+        # Take checkout step into account because it is guaranteed to be
+        # available and the build step might reference it (think of "make
+        # -C" or cross-workspace symlinks.
+        packageInputs = [ packageStep.getPackage().getCheckoutStep() ]
+        packageInputs.extend(packageStep.getAllDepSteps())
+        return [ BobState().getResultHash(i.getWorkspacePath())
+            for i in packageInputs if i.isValid() ]
+
+    @staticmethod
+    def __getOldPackageInputs(path):
+        """Get the recorded inputs of a package workspace.
+
+        If we download the package in the last run the Build-Id is stored as
+        input hash. Otherwise the input hashes of the package step is a list
+        with the buildId as first element. Returns a tuple (oldInputBuildId,
+        oldInputHashes, oldWasDownloaded).
+        """
+        oldInputBuildId = BobState().getInputHashes(path)
+        if (isinstance(oldInputBuildId, list) and (len(oldInputBuildId) >= 1)):
+            return (oldInputBuildId[0], oldInputBuildId[1:], False)
+        elif isinstance(oldInputBuildId, bytes):
+            return (oldInputBuildId, None, True)
+        else:
+            # created by old Bob version or new workspace
+            return (None, oldInputBuildId, False)
+
+    def __packageNeedsPrune(self, oldInputBuildId, packageBuildId):
+        """Check if a previously built or downloaded package must be pruned."""
+        return ((oldInputBuildId is not None) and (oldInputBuildId != packageBuildId)) \
+            or self.__force
+
+    def __planDepsChanged(self, step):
+        return self.__getDepInputHashes(step) != \
+            BobState().getInputHashes(step.getWorkspacePath())
+
+    def __planCheckoutUnchanged(self, checkoutStep):
+        """Check if checkout step is skipped based on the workspace state.
+
+        Does not take into account the dependencies of the checkout step.
+        """
+        path = checkoutStep.getWorkspacePath()
+        if BobState().getResultHash(path) is None: return False
+        if self.__buildOnly: return True
+        return not self.__checkoutNeedsRun(checkoutStep, path,
+            self.__getCheckoutState(checkoutStep), BobState().getDirectoryState(path, {}),
+            BobState().getInputHashes(path))
+
+    async def __planCheckoutStep(self, checkoutStep, depth):
+        depsChanged = await self.__planList(checkoutStep.getAllDepSteps(),
+            checkoutStep.getPackage(), False, depth+1)
+        path = checkoutStep.getWorkspacePath()
+        estimate = BobState().getStepDuration(path, "checkout")
+        if not os.path.isdir(path) or (BobState().getResultHash(path) is None):
+            return BuildPlanEntry(checkoutStep, "checkout", "new", estimate=estimate)
+        elif self.__buildOnly:
+            return BuildPlanEntry(checkoutStep, "skip", "--build-only")
+        elif self.__force:
+            return BuildPlanEntry(checkoutStep, "checkout", "forced", estimate=estimate)
+        elif not self.__planCheckoutUnchanged(checkoutStep) and checkoutStep.isDeterministic():
+            return BuildPlanEntry(checkoutStep, "checkout", "recipe changed", estimate=estimate)
+        elif depsChanged or self.__planDepsChanged(checkoutStep):
+            return BuildPlanEntry(checkoutStep, "checkout", "input changed", estimate=estimate)
+        elif not checkoutStep.isDeterministic():
+            # The sources are updated but will probably not change.
+            return BuildPlanEntry(checkoutStep, "checkout", "update", estimate=estimate,
+                                  changed=False)
+        else:
+            return BuildPlanEntry(checkoutStep, "skip", "unchanged")
+
+    async def __planBuildStep(self, buildStep, checkoutOnly, depth):
+        depsChanged = await self.__planList(buildStep.getAllDepSteps(),
+            buildStep.getPackage(), checkoutOnly, depth+1)
+        path = buildStep.getWorkspacePath()
+        estimate = BobState().getStepDuration(path, "build")
+        buildDigest = self.__getBuildDigest(buildStep)
+        if checkoutOnly:
+            return BuildPlanEntry(buildStep, "skip", "--checkout-only")
+        elif not os.path.isdir(path) or (buildDigest != BobState().getDirectoryState(path)):
+            return BuildPlanEntry(buildStep, "build", "new", estimate=estimate)
+        elif self.__force:
+            return BuildPlanEntry(buildStep, "build", "forced", estimate=estimate)
+        elif depsChanged or self.__planDepsChanged(buildStep):
+            return BuildPlanEntry(buildStep, "build", "input changed", estimate=estimate)
+        else:
+            return BuildPlanEntry(buildStep, "skip", "unchanged")
+
+    async def __planQueryPackages(self, steps, checkoutOnly, depth):
+        """Look up the artifacts of all package steps of a list at once.
+
+        Only the package steps that will query the archive in
+        __planPackageStep() are considered. The results are kept in
+        self.__planQueries.
+        """
+        if checkoutOnly or (depth < self.__downloadDepth) or \
+           not self.__archive.canDownloadLocal():
+            return
+
+        candidates = {}
+        for step in steps:
+            if not step.isValid() or not step.isPackageStep(): continue
+            if step.getWorkspacePath() in self.__planned: continue
+            if not self.__canDownload(step): continue
+            packageBuildId = await self.__getPlanBuildId(step)
+            if (packageBuildId is None) or (packageBuildId in self.__planQueries): continue
+            if (self.__contentStore is not None) and \
+               self.__contentStore.contains(packageBuildId):
+                continue
+            if (packageBuildId not in candidates) and \
+               self.__planNeedsLookup(step, packageBuildId):
+                candidates[packageBuildId] = step
+
+        if candidates:
+            self.__planQueries.update(await self.__archive.queryPackages(
+                next(iter(candidates.values())), list(candidates.keys())))
+
+    @classmethod
+    def __planOldState(cls, packageStep):
+        """Get the previous state of a package workspace.
+
+        Returns a tuple (isNew, oldInputBuildId, oldInputHashes,
+        oldWasDownloaded).
+        """
+        path = packageStep.getWorkspacePath()
+        isNew = not os.path.isdir(path) or \
+            (BobState().getDirectoryState(path) != packageStep.getVariantId())
+        if isNew:
+            return (True, None, None, False)
+        else:
+            return (False,) + cls.__getOldPackageInputs(path)
+
+    def __planNeedsLookup(self, packageStep, packageBuildId):
+        isNew, oldInputBuildId, _, _ = self.__planOldState(packageStep)
+        return self.__packageNeedsPrune(oldInputBuildId, packageBuildId) or isNew \
+            or (BobState().getResultHash(packageStep.getWorkspacePath()) is None)
+
+    async def __planPackageStep(self, packageStep, checkoutOnly, depth):
+        path = packageStep.getWorkspacePath()
+        if self.__canDownload(packageStep):
+            packageBuildId = await self.__getPlanBuildId(packageStep)
+        else:
+            packageBuildId = None
+
+        isNew, oldInputBuildId, oldInputHashes, oldWasDownloaded = \
+            self.__planOldState(packageStep)
+
+        # Mirror the download logic of _cookPackageStep(). A previously built
+        # or downloaded package with a different build-id is pruned.
+        reason = None
+        if (not checkoutOnly) and (depth >= self.__downloadDepth):
+            if packageBuildId is None:
+                if self.__canDownload(packageStep):
+                    reason = "build-id needs checkout"
+            else:
+                if self.__packageNeedsPrune(oldInputBuildId, packageBuildId):
+                    isNew = True
+                    reason = "build-id changed"
+                if isNew or (BobState().getResultHash(path) is None):
+                    if (self.__contentStore is not None) and \
+                       self.__contentStore.contains(packageBuildId):
+                        return BuildPlanEntry(packageStep, "download", "found in content store")
+                    query = self.__planQueries.get(packageBuildId)
+                    if query is None:
+                        query = await self.__archive.queryPackage(packageStep, packageBuildId)
+                    exists, size = query
+                    estimate = BobState().getStepDuration(path, "download")
+                    if exists:
+                        return BuildPlanEntry(packageStep, "download", "found in archive",
+                                              size, estimate)
+                    elif exists is None:
+                        return BuildPlanEntry(packageStep, "download?", "availability unknown",
+                                              size, estimate)
+                    elif depth >= self.__downloadDepthForce:
+                        await self.__planList(packageStep.getAllDepSteps(),
+                            packageStep.getPackage(), checkoutOnly, depth+1)
+                        return BuildPlanEntry(packageStep, "fail", "artifact not found")
+                    reason = "not in archive"
+                elif oldWasDownloaded:
+                    return BuildPlanEntry(packageStep, "skip", "already downloaded")
+
+        depsChanged = await self.__planList(packageStep.getAllDepSteps(),
+            packageStep.getPackage(), checkoutOnly, depth+1)
+        estimate = BobState().getStepDuration(path, "package")
+        if checkoutOnly:
+            return BuildPlanEntry(packageStep, "skip", "--checkout-only")
+        elif isNew:
+            return BuildPlanEntry(packageStep, "build", reason or "new", estimate=estimate)
+        elif self.__force:
+            return BuildPlanEntry(packageStep, "build", "forced", estimate=estimate)
+        elif depsChanged:
+            return BuildPlanEntry(packageStep, "build", reason or "input changed",
+                                  estimate=estimate)
+        else:
+            if oldInputHashes != self.__getPackageInputHashes(packageStep):
+                return BuildPlanEntry(packageStep, "build", reason or "input changed",
+                                      estimate=estimate)
+            else:
+                return BuildPlanEntry(packageStep, "skip", "unchanged")
+
+    async def __getPlanBuildIdList(self, steps):
+        return [ (await self.__getPlanBuildId(s)) for s in steps ]
+
+    async def __getPlanBuildId(self, step):
+        """Calculate build-id for the planner.
+
+        Existing checkouts that will not be updated are taken as they are.
+        Other checkout steps require a live-build-id prediction. Returns None
+        if the build-id cannot be determined without a checkout.
+        """
+        path = step.getWorkspacePath()
+        if path in self.__planBuildIds:
+            return self.__planBuildIds[path]
+
+        if step.isCheckoutStep():
+            if os.path.isdir(path):
+                ret = BobState().getResultHash(path) \
+                    if self.__planCheckoutUnchanged(step) else None
+            else:
+                ret = await self.__predictCheckoutStepBuildId(step)
+        else:
+            ret = await step.getDigestCoro(self.__getPlanBuildIdList, True)
+
+        self.__planBuildIds[path] = ret
+        return ret
+
     async def _cookTask(self, step, checkoutOnly, depth):
-        async with self.__runners:
+        async with self.__acquireJob(step):
             if not self.__running: raise CancelBuildException
             await self._cook([step], step.getPackage(), checkoutOnly, depth)
 
@@ -957,21 +1685,149 @@ esac
         if not steps: return
 
         if self.__jobs > 1:
-            # spawn the child tasks
-            tasks = [
-                self.__createTask(lambda s=step: self._cookStep(s, checkoutOnly, depth), step, self.__cookTasks)
-                for step in steps
-            ]
-
-            # wait for all tasks to finish
-            await self.__yieldJobWhile(gatherTasks(tasks))
+            # hand the steps over to the executor and wait for them
+            nodes = self.__addCookNodes(steps, checkoutOnly, depth)
+            await self.__yieldJobWhile(self.__waitCookNodes(nodes))
         else:
             for step in steps:
                 await self.__yieldJobWhile(self._cookStep(step, checkoutOnly, depth))
 
+    def __getCookNodeDeps(self, step, checkoutOnly, depth):
+        """Get the dependencies that are cooked before a step is dispatched.
+
+        These are exactly the steps that the _cook*Step() methods would cook
+        first. Package steps that might be downloaded are dispatched without
+        their dependencies. They are added on demand if the download fails.
+        """
+        if step.isCheckoutStep():
+            checkoutOnly = False
+        elif step.isPackageStep() and (not checkoutOnly) and \
+             (depth >= self.__downloadDepth) and \
+             (step.isRelocatable() or (step.getSandbox() is not None)):
+            return []
+
+        deps = step.getAllDepSteps()
+        if self.__skipDeps:
+            deps = [ s for s in deps if s.getPackage() == step.getPackage() ]
+        return [ (s, checkoutOnly, depth+1) for s in deps
+                 if s.isValid() and not self._wasAlreadyRun(s, checkoutOnly) ]
+
+    def __addCookNodes(self, steps, checkoutOnly, depth):
+        """Add steps to the dependency graph of the executor.
+
+        All dependencies of the steps are added too. The graph is traversed
+        iteratively. Nodes are numbered in post-order so that the executor
+        prefers to finish already started sub-trees. Steps that are already
+        in the graph are taken as they are. Returns the nodes of the steps.
+        """
+        ret = []
+        for root in steps:
+            node = self.__cookNodes.get(root.getWorkspacePath())
+            if node is None:
+                node = CookNode(root, checkoutOnly, depth)
+                self.__cookNodes[root.getWorkspacePath()] = node
+                stack = [ (node, iter(self.__getCookNodeDeps(root, checkoutOnly, depth)), False) ]
+                while stack:
+                    (current, deps, _) = stack[-1]
+                    for (dep, depCheckoutOnly, depDepth) in deps:
+                        depNode = self.__cookNodes.get(dep.getWorkspacePath())
+                        if depNode is None:
+                            depNode = CookNode(dep, depCheckoutOnly, depDepth)
+                            self.__cookNodes[dep.getWorkspacePath()] = depNode
+                            stack.append((depNode, iter(self.__getCookNodeDeps(
+                                dep, depCheckoutOnly, depDepth)), False))
+                        elif depNode.future.done():
+                            # Successful nodes are removed from the graph.
+                            # This one must have failed.
+                            stack[-1] = (current, deps, True)
+                            continue
+                        current.pending += 1
+                        depNode.dependents.append(current)
+                        if stack[-1][0] is not current: break
+                    else:
+                        (current, deps, failed) = stack.pop()
+                        current.seq = self.__cookNodeSeq
+                        self.__cookNodeSeq += 1
+                        if failed:
+                            self.__finishCookNode(current, False)
+                        elif current.pending == 0:
+                            heapq.heappush(self.__readyNodes, current)
+            ret.append(node)
+
+        self.__dispatchCookNodes()
+        return ret
+
+    async def __waitCookNodes(self, nodes):
+        pending = [ n.future for n in nodes if not n.future.done() ]
+        if pending:
+            await asyncio.wait(pending)
+        if not all(n.future.result() for n in nodes):
+            raise CancelBuildException
+
+    def __dispatchCookNodes(self):
+        """Start ready steps as long as there are free job slots.
+
+        Once the build is stopped the remaining ready nodes are failed so that
+        everybody waiting for them is released.
+        """
+        while self.__readyNodes and ((self.__activeNodes < self.__jobs) or
+                                     not self.__running):
+            node = heapq.heappop(self.__readyNodes)
+            if node.future.done():
+                continue
+            elif not self.__running:
+                self.__finishCookNode(node, False)
+                continue
+            self.__activeNodes += 1
+            task = self.__createTask(lambda n=node: self._cookStep(n.step,
+                n.checkoutOnly, n.depth), node.step)
+            self.__cookNodeTasks.add(task)
+            task.add_done_callback(lambda t, n=node: self.__cookNodeDone(n, t))
+
+    def __cookNodeDone(self, node, task):
+        self.__cookNodeTasks.discard(task)
+        self.__activeNodes -= 1
+        error = None if task.cancelled() else task.exception()
+        self.__finishCookNode(node, not task.cancelled() and (error is None),
+                              isinstance(error, StepFailedException))
+        self.__dispatchCookNodes()
+
+    def __finishCookNode(self, node, success, stepFailed=False):
+        """Resolve node and update its dependents.
+
+        Successful nodes are removed from the graph so that the step is
+        evaluated again by _wasAlreadyRun() on the next request. Nodes whose
+        step failed by itself are kept. Every later request will fail
+        immediately then. All dependents of a failed node fail too. Like nodes
+        that failed because of their dependencies they are removed from the
+        graph. When the tree is walked again their other dependencies are
+        still dispatched in case of '--keep-going'.
+        """
+        keep = node if stepFailed else None
+        todo = [ node ]
+        while todo:
+            node = todo.pop()
+            if node.future.done(): continue
+            node.future.set_result(success)
+            dependents, node.dependents = node.dependents, []
+            path = node.step.getWorkspacePath()
+            if (node is not keep) and (self.__cookNodes.get(path) is node):
+                del self.__cookNodes[path]
+            if success:
+                for d in dependents:
+                    d.pending -= 1
+                    if (d.pending == 0) and not d.future.done():
+                        heapq.heappush(self.__readyNodes, d)
+            else:
+                todo.extend(dependents)
+
     async def _cookStep(self, step, checkoutOnly, depth):
-        await self.__runners.acquire()
+        with traceSpan(step, "WAIT", "runner"):
+            await self.__runners.acquire()
         try:
+            # Steps that were invalidated while being cooked must not be
+            # marked as run. They are picked up again by the next walk.
+            generation = self.__getGeneration(step)
             if not self.__running:
                 raise CancelBuildException
             elif self._wasAlreadyRun(step, checkoutOnly):
@@ -982,11 +1838,13 @@ esac
             elif step.isBuildStep():
                 if step.isValid():
                     await self._cookBuildStep(step, checkoutOnly, depth)
-                    self._setAlreadyRun(step, False, checkoutOnly)
+                    if generation == self.__getGeneration(step):
+                        self._setAlreadyRun(step, False, checkoutOnly)
             else:
                 assert step.isPackageStep() and step.isValid()
                 await self._cookPackageStep(step, checkoutOnly, depth)
-                self._setAlreadyRun(step, False, checkoutOnly)
+                if generation == self.__getGeneration(step):
+                    self._setAlreadyRun(step, False, checkoutOnly)
         except BuildError as e:
             e.setStack(step.getPackage().getStack())
             raise
@@ -1016,8 +1874,8 @@ esac
             BobState().resetWorkspaceState(prettySrcPath, oldCheckoutState)
 
         checkoutExecuted = False
-        checkoutState = checkoutStep.getScmDirectories().copy()
-        checkoutState[None] = checkoutDigest = checkoutStep.getVariantId()
+        checkoutState = self.__getCheckoutState(checkoutStep)
+        checkoutDigest = checkoutStep.getVariantId()
         if self.__buildOnly and (BobState().getResultHash(prettySrcPath) is not None):
             if checkoutState != oldCheckoutState:
                 stepMessage(checkoutStep, "CHECKOUT", "WARNING: recipe changed but skipped due to --build-only ({})"
@@ -1038,12 +1896,9 @@ esac
                     if (status == 'dirty') or (status == 'error'):
                         oldCheckoutState[scmDir] = None
 
-            checkoutInputHashes = [ BobState().getResultHash(i.getWorkspacePath())
-                for i in checkoutStep.getAllDepSteps() if i.isValid() ]
-            if (self.__force or (not checkoutStep.isDeterministic()) or
-                (BobState().getResultHash(prettySrcPath) is None) or
-                (checkoutState != oldCheckoutState) or
-                (checkoutInputHashes != BobState().getInputHashes(prettySrcPath))):
+            checkoutInputHashes = self.__getDepInputHashes(checkoutStep)
+            if self.__checkoutNeedsRun(checkoutStep, prettySrcPath, checkoutState,
+                                       oldCheckoutState, checkoutInputHashes):
                 # move away old or changed source directories
                 for (scmDir, scmDigest) in oldCheckoutState.copy().items():
                     if (scmDir is not None) and (scmDigest != checkoutState.get(scmDir)):
@@ -1129,20 +1984,18 @@ esac
             self.__handleChangedBuildId(checkoutStep, checkoutHash)
 
     async def _cookBuildStep(self, buildStep, checkoutOnly, depth):
+        generation = self.__getGeneration(buildStep)
+
         # depth first
         await self._cook(buildStep.getAllDepSteps(), buildStep.getPackage(),
                    checkoutOnly, depth+1)
 
-        # Add the execution path of the build step to the buildDigest to
-        # detect changes between sandbox and non-sandbox builds. This is
-        # necessary in any build mode. Include the actual directories of
-        # dependencies in buildDigest too. Directories are reused in
-        # develop build mode and thus might change even though the variant
-        # id of this step is stable. As most tools rely on stable input
-        # directories we have to make a clean build if any of the
-        # dependency directories change.
-        buildDigest = [self.__getIncrementalVariantId(buildStep), buildStep.getExecPath()] + \
-            [ i.getExecPath() for i in buildStep.getArguments() if i.isValid() ]
+        # Bail out if we were invalidated by a changed build-id of our
+        # dependencies. The step will be cooked again by the next walk.
+        if generation != self.__getGeneration(buildStep):
+            return
+
+        buildDigest = self.__getBuildDigest(buildStep)
 
         # get directory into shape
         (prettyBuildPath, created) = self._constructDir(buildStep, "build")
@@ -1157,8 +2010,7 @@ esac
             BobState().resetWorkspaceState(prettyBuildPath, buildDigest)
 
         # run build if input has changed
-        buildInputHashes = [ BobState().getResultHash(i.getWorkspacePath())
-            for i in buildStep.getAllDepSteps() if i.isValid() ]
+        buildInputHashes = self.__getDepInputHashes(buildStep)
         if checkoutOnly:
             stepMessage(buildStep, "BUILD", "skipped due to --checkout-only ({})".format(prettyBuildPath),
                     SKIPPED, IMPORTANT)
@@ -1185,6 +2037,17 @@ esac
             BobState().setInputHashes(prettyBuildPath, buildInputHashes)
 
     async def _cookPackageStep(self, packageStep, checkoutOnly, depth):
+        generation = self.__getGeneration(packageStep)
+
+        # Wait for a pending prefetch of the package. Its outcome is recorded
+        # in the workspace state and will be picked up below. Make sure that
+        # no prefetch is started anymore once we're handling the step here.
+        path = packageStep.getWorkspacePath()
+        self.__prefetchVisited.add(path)
+        prefetch = self.__prefetchTasks.get(path)
+        if prefetch is not None:
+            await self.__yieldJobWhile(gatherTasks([prefetch]))
+
         # get directory into shape
         (prettyPackagePath, created) = self._constructDir(packageStep, "dist")
         packageDigest = packageStep.getVariantId()
@@ -1198,30 +2061,15 @@ esac
             # invalidate result if folder was created
             BobState().resetWorkspaceState(prettyPackagePath, packageDigest)
 
-        # Can we theoretically download the result? This requires a
-        # relocatable package or that we're building in a sandbox with
-        # stable paths. Try to determine a build-id for these artifacts.
-        if packageStep.isRelocatable() or (packageStep.getSandbox() is not None):
+        # Can we theoretically download the result? Try to determine a
+        # build-id for these artifacts.
+        if self.__canDownload(packageStep):
             packageBuildId = await self._getBuildId(packageStep, depth)
         else:
             packageBuildId = None
 
-        # If we download the package in the last run the Build-Id is stored
-        # as input hash. Otherwise the input hashes of the package step is
-        # a list with the buildId as first element. Split that off for the
-        # logic below...
-        oldInputBuildId = BobState().getInputHashes(prettyPackagePath)
-        if (isinstance(oldInputBuildId, list) and (len(oldInputBuildId) >= 1)):
-            oldInputHashes = oldInputBuildId[1:]
-            oldInputBuildId = oldInputBuildId[0]
-            oldWasDownloaded = False
-        elif isinstance(oldInputBuildId, bytes):
-            oldWasDownloaded = True
-            oldInputHashes = None
-        else:
-            # created by old Bob version or new workspace
-            oldInputHashes = oldInputBuildId
-            oldWasDownloaded = False
+        oldInputBuildId, oldInputHashes, oldWasDownloaded = \
+            self.__getOldPackageInputs(prettyPackagePath)
 
         # If possible try to download the package. If we downloaded the
         # package in the last run we have to make sure that the Build-Id is
@@ -1238,7 +2086,7 @@ esac
         wasDownloaded = False
         if ( (not checkoutOnly) and packageBuildId and (depth >= self.__downloadDepth) ):
             # prune directory if we previously downloaded/built something different
-            if ((oldInputBuildId is not None) and (oldInputBuildId != packageBuildId)) or self.__force:
+            if self.__packageNeedsPrune(oldInputBuildId, packageBuildId):
                 stepMessage(packageStep, "PRUNE", "{} ({})".format(prettyPackagePath,
                         "build forced" if self.__force else "build-id changed"),
                     WARNING)
@@ -1252,16 +2100,25 @@ esac
             # we're done.
             if BobState().getResultHash(prettyPackagePath) is None:
                 audit = os.path.join(prettyPackagePath, "..", "audit.json.gz")
-                wasDownloaded = await self.__archive.downloadPackage(packageStep,
-                    packageBuildId, audit, prettyPackagePath)
+                if (prettyPackagePath, packageBuildId) in self.__prefetchMisses:
+                    wasDownloaded = False
+                else:
+                    wasDownloaded = await self.__downloadPackage(packageStep,
+                        packageBuildId, audit, prettyPackagePath)
                 if wasDownloaded:
                     self.__statistic.packagesDownloaded += 1
-                    BobState().setInputHashes(prettyPackagePath, packageBuildId)
-                    packageHash = hashWorkspace(packageStep)
-                    workspaceChanged = True
+                    self.__archived.add((prettyPackagePath, packageBuildId))
+                elif await self.__cookRemote(packageStep, packageBuildId, depth):
+                    self.__statistic.packagesBuilt += 1
                     wasDownloaded = True
+                elif generation != self.__getGeneration(packageStep):
+                    return
                 elif depth >= self.__downloadDepthForce:
                     raise BuildError("Downloading artifact failed")
+                if wasDownloaded:
+                    BobState().setInputHashes(prettyPackagePath, packageBuildId)
+                    packageHash = hashWorkspace(packageStep)
+                    workspaceChanged = True
             elif oldWasDownloaded:
                 stepMessage(packageStep, "PACKAGE", "skipped (already downloaded in {})".format(prettyPackagePath),
                     SKIPPED, IMPORTANT)
@@ -1276,13 +2133,13 @@ esac
             await self._cook(packageStep.getAllDepSteps(), packageStep.getPackage(),
                        checkoutOnly, depth+1)
 
-            # Take checkout step into account because it is guaranteed to
-            # be available and the build step might reference it (think of
-            # "make -C" or cross-workspace symlinks.
-            packageInputs = [ packageStep.getPackage().getCheckoutStep() ]
-            packageInputs.extend(packageStep.getAllDepSteps())
-            packageInputHashes = [ BobState().getResultHash(i.getWorkspacePath())
-                for i in packageInputs if i.isValid() ]
+            # The build-id might have been calculated from wrongly predicted
+            # sources. Do not build and upload anything in this case. The
+            # step will be cooked again by the next walk.
+            if generation != self.__getGeneration(packageStep):
+                return
+
+            packageInputHashes = self.__getPackageInputHashes(packageStep)
             if checkoutOnly:
                 stepMessage(packageStep, "PACKAGE", "skipped due to --checkout-only ({})".format(prettyPackagePath),
                     SKIPPED, IMPORTANT)
@@ -1294,14 +2151,22 @@ esac
                     # invalidate result because folder will be cleared
                     BobState().delInputHashes(prettyPackagePath)
                     BobState().setResultHash(prettyPackagePath, datetime.datetime.utcnow())
-                    await self._runShell(packageStep, "package", True, a)
-                    packageHash = hashWorkspace(packageStep)
+                    if packageStep.getCopySpec() is None:
+                        await self._runShell(packageStep, "package", True, a)
+                        packageHash = hashWorkspace(packageStep)
+                    else:
+                        digests = await self._runCopy(packageStep)
+                        packageHash = hashWorkspace(packageStep, digests)
                     packageDigest = self.__getIncrementalVariantId(packageStep)
                     workspaceChanged = True
                     self.__statistic.packagesBuilt += 1
                 audit = await self._generateAudit(packageStep, depth, packageHash)
                 if packageBuildId and self.__archive.canUploadLocal():
                     await self.__archive.uploadPackage(packageStep, packageBuildId, audit, prettyPackagePath)
+                    self.__archived.add((prettyPackagePath, packageBuildId))
+                    if self.__contentStore is not None:
+                        await self.__contentStore.insert(packageStep, packageBuildId,
+                            audit, prettyPackagePath)
 
         # Rehash directory if content was changed
         if workspaceChanged:
@@ -1312,6 +2177,169 @@ esac
             else:
                 BobState().setInputHashes(prettyPackagePath, [packageBuildId] + packageInputHashes)
 
+    async def __downloadPackage(self, step, buildId, audit, content):
+        """Download package and record the time it took for the planner.
+
+        The content store is tried first if enabled. Downloaded packages are
+        added to the store.
+        """
+        if (self.__contentStore is not None) and \
+           await self.__contentStore.checkout(step, buildId, audit, content):
+            return True
+        releaseWorkspace(content)
+        startTime = time.monotonic()
+        ret = await self.__archive.downloadPackage(step, buildId, audit, content)
+        if ret:
+            BobState().setStepDuration(content, "download", time.monotonic() - startTime)
+            if self.__contentStore is not None:
+                await self.__contentStore.insert(step, buildId, audit, content)
+        return ret
+
+    async def __cookRemote(self, packageStep, packageBuildId, depth):
+        """Build a package on a worker.
+
+        The build and package step are executed remotely if all their inputs
+        can be exchanged through the archive. These are the checkout step of
+        the package and other packages that are relocatable or built in a
+        sandbox. Returns True if the package was built remotely and the result
+        was downloaded. Otherwise the package has to be built locally.
+        """
+        if not (self.__workers and self.__archive.canDownloadLocal() and
+                self.__archive.canUploadLocal()):
+            return False
+
+        package = packageStep.getPackage()
+        steps = [ s for s in (package.getBuildStep(), packageStep) if s.isValid() ]
+        stepPaths = set(s.getWorkspacePath() for s in steps)
+        inputs = {}
+        for s in steps:
+            for dep in s.getAllDepSteps():
+                path = dep.getWorkspacePath()
+                if not dep.isValid() or (path in stepPaths): continue
+                if dep.isPackageStep() and not (dep.isRelocatable() or
+                                                (dep.getSandbox() is not None)):
+                    return False
+                inputs[path] = dep
+
+        generation = self.__getGeneration(packageStep)
+        await self._cook(list(inputs.values()), package, False, depth+1)
+        if generation != self.__getGeneration(packageStep): return False
+        if not self.__workers: return False
+
+        # Make sure that all inputs are available in the archive. Checkouts
+        # are uploaded as sources with their result hash as id. They are kept
+        # apart from the packages so that they are never downloaded as such.
+        jobInputs = []
+        for (path, dep) in sorted(inputs.items()):
+            audit = os.path.join(path, "..", "audit.json.gz")
+            if dep.isCheckoutStep():
+                buildId = BobState().getResultHash(path)
+                if buildId is None: return False
+                if not os.path.exists(audit):
+                    await self._generateAudit(dep, depth, buildId, False)
+                if (path, buildId) not in self.__archived:
+                    await self.__archive.uploadSources(dep, buildId, audit, path)
+            else:
+                buildId = await self._getBuildId(dep, depth+1)
+                if (path, buildId) not in self.__archived:
+                    await self.__archive.uploadPackage(dep, buildId, audit, path)
+            self.__archived.add((path, buildId))
+            jobInputs.append({ "package" : dep.getPackage().getStack(),
+                "workspace" : path, "buildId" : asHexStr(buildId),
+                "sources" : dep.isCheckoutStep() })
+
+        jobSteps = []
+        recipesAudit = package.getRecipe().getRecipeSet().getScmAudit()
+        for s in steps:
+            name = "build" if s.isBuildStep() else "package"
+            stepEnv, runScript, script = self._generateScripts(s, name, True, True)
+            sandbox = s.getSandbox()
+            jobSteps.append({
+                "package" : package.getStack(),
+                "workspace" : s.getWorkspacePath(),
+                "name" : name,
+                "runScript" : runScript,
+                "script" : script,
+                "variantId" : asHexStr(s.getVariantId()),
+                "buildId" : asHexStr(await self._getBuildId(s, depth)),
+                "defines" : {
+                    "bob" : BOB_VERSION,
+                    "recipe" : package.getRecipe().getName(),
+                    "package" : "/".join(package.getStack()),
+                    "step" : s.getLabel(),
+                },
+                "metaEnv" : dict(package.getMetaEnv()),
+                "recipes" : recipesAudit.dump() if recipesAudit is not None else None,
+                "tools" : { n : t.getStep().getWorkspacePath()
+                            for (n,t) in s.getTools().items() },
+                "sandbox" : sandbox.getStep().getWorkspacePath() if sandbox is not None else None,
+                "args" : [ a.getWorkspacePath() for a in s.getArguments() if a.isValid() ],
+            })
+
+        prettyPackagePath = packageStep.getWorkspacePath()
+        job = {
+            "archive" : self.__getRemoteArchiveSpec(),
+            "whitelist" : sorted(self.__envWhiteList),
+            "preserveEnv" : self.__preserveEnv,
+            "inputs" : jobInputs,
+            "steps" : jobSteps,
+            "result" : { "package" : package.getStack(),
+                         "workspace" : prettyPackagePath,
+                         "buildId" : asHexStr(packageBuildId) },
+        }
+        try:
+            worker = await self.__workers.connect(packageStep)
+        except WorkerUnavailableError:
+            stepMessage(packageStep, "REMOTE", "no worker available, building {} locally"
+                .format(prettyPackagePath), WARNING, IMPORTANT)
+            return False
+        with stepAction(packageStep, "REMOTE", prettyPackagePath,
+                        details="on "+worker.getAddress()) as a:
+            try:
+                answer = await worker.run(job)
+            except WorkerTimeoutError:
+                a.fail("timeout", WARNING)
+                answer = None
+            if (answer is not None) and (answer.get("status") != "ok"):
+                a.fail("failed")
+                raise BuildError("Remote build of {} failed: {}".format(prettyPackagePath,
+                                    answer.get("message", "unknown error")),
+                                 help=answer.get("log", ""))
+        if answer is None:
+            stepMessage(packageStep, "REMOTE", "worker {} did not answer in time, building {} locally"
+                .format(worker.getAddress(), prettyPackagePath), WARNING, IMPORTANT)
+            return False
+
+        audit = os.path.join(prettyPackagePath, "..", "audit.json.gz")
+        if await self.__downloadPackage(packageStep, packageBuildId, audit, prettyPackagePath):
+            self.__archived.add((prettyPackagePath, packageBuildId))
+            return True
+
+        stepMessage(packageStep, "REMOTE", "result of {} not found in archive".format(prettyPackagePath),
+            WARNING, IMPORTANT)
+        return False
+
+    def __getRemoteArchiveSpec(self):
+        """Get archive spec for workers.
+
+        Relative paths and policies are resolved because they cannot be
+        evaluated by the worker.
+        """
+        def resolve(spec):
+            spec = spec.copy()
+            backend = spec.get("backend")
+            if backend == "file":
+                spec["path"] = os.path.abspath(spec["path"])
+            elif (backend == "http") and ("sslVerify" not in spec):
+                spec["sslVerify"] = self.__recipes.getPolicy('secureSSL')
+            return spec
+
+        spec = self.__recipes.archiveSpec()
+        if isinstance(spec, list):
+            return [ resolve(i) for i in spec ]
+        else:
+            return resolve(spec)
+
     async def __queryLiveBuildId(self, step):
         """Predict live build-id of checkout step.
 
@@ -1356,24 +2384,50 @@ esac
 
         return bid
 
-    async def __getCheckoutStepBuildId(self, step, depth):
-        ret = None
+    def __getBuildIdLock(self, key):
+        lock = self.__buildIdLocks.get(key)
+        if lock is None:
+            lock = self.__buildIdLocks[key] = asyncio.Lock()
+        return lock
 
-        # Try to use live build-ids for checkout steps. Do not use them if
-        # there is already a workspace or if the package matches one of the
-        # 'always-checkout' patterns. Fall back to a regular checkout if any
-        # condition is not met.
-        name = step.getPackage().getName()
-        path = step.getWorkspacePath()
-        if not os.path.exists(step.getWorkspacePath()) and \
-           not any(pat.match(name) for pat in self.__alwaysCheckout) and \
-           step.hasLiveBuildId() and self.__archive.canDownloadLocal():
-            with stepAction(step, "QUERY", step.getPackage().getName(), (IMPORTANT, NORMAL)) as a:
-                liveBId = await self.__queryLiveBuildId(step)
-                if liveBId:
-                    ret = await self.__translateLiveBuildId(step, liveBId)
-                if ret is None:
-                    a.fail("unknown", WARNING)
+    async def __predictCheckoutStepBuildId(self, step):
+        """Try to predict the build-id of a checkout step.
+
+        Live build-ids are used for checkout steps. Do not use them if there is
+        already a workspace or if the package matches one of the
+        'always-checkout' patterns. Returns None if no prediction is possible.
+        Failed predictions are remembered so that the user is bothered only
+        once.
+
+        Prefetches and the regular build might predict the same step
+        concurrently. The prediction is done under a per-step lock and the
+        result is recorded. Hence the archive is queried only once.
+        """
+        key = (step.getWorkspacePath(), step.getVariantId())
+        async with self.__getBuildIdLock(key):
+            ret = self.__srcBuildIds.get(key, (None, False))[0]
+            if ret is not None: return ret
+
+            name = step.getPackage().getName()
+            if key not in self.__unpredictableSrcIds and \
+               not os.path.exists(step.getWorkspacePath()) and \
+               not any(pat.match(name) for pat in self.__alwaysCheckout) and \
+               step.hasLiveBuildId() and self.__archive.canDownloadLocal():
+                with stepAction(step, "QUERY", step.getPackage().getName(), (IMPORTANT, NORMAL)) as a:
+                    liveBId = await self.__queryLiveBuildId(step)
+                    if liveBId:
+                        ret = await self.__translateLiveBuildId(step, liveBId)
+                    if ret is None:
+                        a.fail("unknown", WARNING)
+                        self.__unpredictableSrcIds.add(key)
+                    else:
+                        self.__srcBuildIds[key] = (ret, True)
+        return ret
+
+    async def __getCheckoutStepBuildId(self, step, depth):
+        # Try to predict the build-id. Fall back to a regular checkout if
+        # that is not possible.
+        ret = await self.__predictCheckoutStepBuildId(step)
 
         # do the checkout if we still don't have a build-id
         if ret is None:
@@ -1422,7 +2476,7 @@ esac
         return ret
 
     async def __getBuildIdTask(self, step, depth):
-        async with self.__runners:
+        async with self.__acquireJob(step):
             if not self.__running: raise CancelBuildException
             ret = await self.__getBuildIdSingle(step, depth)
         return ret
@@ -1439,34 +2493,186 @@ esac
         else:
             ret = self.__buildDistBuildIds.get(path)
             if ret is None:
+                generation = self.__getGeneration(step)
                 ret = await step.getDigestCoro(lambda x: self.__getBuildIdList(x, depth+1), True)
-                self.__buildDistBuildIds[path] = ret
+                if generation == self.__getGeneration(step):
+                    self.__buildDistBuildIds[path] = ret
+                    self.__knownSteps[path] = step
+
+        return ret
+
+    def __spawnPrefetch(self, step, depth):
+        """Start prefetching the artifact of a package step.
+
+        Every package step is considered at most once. If it was already
+        visited by a prefetch or by _cookPackageStep() nothing is done.
+        """
+        path = step.getWorkspacePath()
+        if (not step.isValid()) or (path in self.__prefetchVisited): return
+        self.__prefetchVisited.add(path)
+        if self._wasAlreadyRun(step, False): return
+        self.__createTask(lambda: self.__prefetchTask(step, depth), step,
+                          self.__prefetchTasks)
+
+    async def __prefetchTask(self, step, depth):
+        async with self.__acquireJob(step):
+            if not self.__running: raise CancelBuildException
+            downloaded = await self.__prefetchPackageStep(step, depth)
+
+        # Descend into the next level of packages only if we could not
+        # download this one. Otherwise the dependencies are not needed.
+        if not downloaded and not self.__skipDeps:
+            for dep in self.__getPrefetchChildren(step):
+                self.__spawnPrefetch(dep, depth+1)
+
+    async def __prefetchPackageStep(self, packageStep, depth):
+        """Try to download a package step ahead of time.
+
+        Only fresh or empty workspaces are considered. Everything else is left
+        to _cookPackageStep() which knows how to deal with stale results. A
+        successful download leaves the workspace in the same state as a
+        regular download. Misses are remembered so that the archive is not
+        queried again.
+        """
+        if not (packageStep.isRelocatable() or (packageStep.getSandbox() is not None)):
+            return False
+        if depth < self.__downloadDepth:
+            return False
+
+        packageDigest = packageStep.getVariantId()
+        path = packageStep.getWorkspacePath()
+        if os.path.exists(path):
+            if BobState().getDirectoryState(path) != packageDigest: return False
+            if BobState().getResultHash(path) is not None: return False
+            if BobState().getInputHashes(path) is not None: return False
+
+        packageBuildId = await self.__getPrefetchBuildId(packageStep)
+        if packageBuildId is None:
+            return False
+
+        (prettyPackagePath, created) = self._constructDir(packageStep, "dist")
+        if created:
+            BobState().resetWorkspaceState(prettyPackagePath, packageDigest)
+        audit = os.path.join(prettyPackagePath, "..", "audit.json.gz")
+        if await self.__downloadPackage(packageStep, packageBuildId, audit,
+                                        prettyPackagePath):
+            self.__statistic.packagesDownloaded += 1
+            BobState().setInputHashes(prettyPackagePath, packageBuildId)
+            BobState().setResultHash(prettyPackagePath, hashWorkspace(packageStep))
+            BobState().setVariantId(prettyPackagePath, packageDigest)
+            return True
+        else:
+            self.__prefetchMisses.add((prettyPackagePath, packageBuildId))
+            return False
+
+    async def __getPrefetchBuildIdList(self, steps):
+        return [ (await self.__getPrefetchBuildId(s)) for s in steps ]
+
+    async def __getPrefetchBuildId(self, step):
+        """Calculate build-id without touching any workspace.
+
+        Works like __getBuildIdSingle() but does not fall back to a checkout
+        if the build-id of a checkout step cannot be predicted. Returns None
+        in this case.
+        """
+        path = step.getWorkspacePath()
+        if step.isCheckoutStep():
+            key = (path, step.getVariantId())
+            ret = self.__srcBuildIds.get(key, (None, False))[0]
+            if ret is not None:
+                pass
+            elif os.path.exists(path):
+                if self._wasAlreadyRun(step, False):
+                    ret = BobState().getResultHash(path)
+            else:
+                ret = await self.__predictCheckoutStepBuildId(step)
+                if ret is not None:
+                    self.__srcBuildIds[key] = (ret, True)
+        else:
+            ret = self.__buildDistBuildIds.get(path)
+            if ret is None:
+                generation = self.__getGeneration(step)
+                ret = await step.getDigestCoro(self.__getPrefetchBuildIdList, True)
+                if (ret is not None) and (generation == self.__getGeneration(step)):
+                    self.__buildDistBuildIds[path] = ret
+                    self.__knownSteps[path] = step
 
         return ret
 
+    @staticmethod
+    def __getPrefetchChildren(packageStep):
+        """Get the next level of package steps below a package step."""
+        ret = []
+        visited = set()
+        todo = packageStep.getAllDepSteps()
+        while todo:
+            step = todo.pop(0)
+            if not step.isValid(): continue
+            path = step.getWorkspacePath()
+            if path in visited: continue
+            visited.add(path)
+            if step.isPackageStep():
+                ret.append(step)
+            else:
+                todo.extend(step.getAllDepSteps())
+        return ret
+
     def __handleChangedBuildId(self, step, checkoutHash):
         """Handle different build-id of src step after checkout.
 
         Through live-build-ids it is possible that an initially queried
         build-id does not match the real build-id after the sources have been
         checked out. As we might have already downloaded artifacts based on
-        the now invalidated build-id we have to restart the build and check all
-        build-ids, build- and package-steps again.
+        the now invalidated build-id we have to check all build-ids, build-
+        and package-steps again that depend on this checkout. Other steps are
+        not affected and the build continues.
         """
         key = (step.getWorkspacePath(), step.getVariantId())
+        log("Wrongly predicted sources of {}. Re-evaluate dependent steps."
+                .format(step.getPackage().getName()), WARNING)
 
         # Invalidate wrong live-build-id
         self.__invalidateLiveBuildId(step)
-
-        # Invalidate (possibly) derived build-ids
         self.__srcBuildIds[key] = (checkoutHash, False)
-        self.__buildDistBuildIds = {}
 
-        # Forget all executed build- and package-steps
-        self._clearWasRun()
+        # Invalidate (possibly) derived build-ids and forget all executed
+        # dependent build- and package-steps. Steps that are currently running
+        # will notice the changed generation and will not be marked as run.
+        checkoutPath = step.getWorkspacePath()
+        dependsMemo = { checkoutPath : True }
+        def dependsOnCheckout(s):
+            path = s.getWorkspacePath()
+            ret = dependsMemo.get(path)
+            if ret is None:
+                ret = any(dependsOnCheckout(d) for d in s.getAllDepSteps(True)
+                          if d.isValid())
+                dependsMemo[path] = ret
+            return ret
 
-        # start from scratch
-        raise RestartBuildException()
+        candidates = set(self.__buildDistBuildIds.keys())
+        candidates.update(self.__buildIdTasks.keys())
+        candidates.update(path for path, (vid, isCheckoutStep) in self.__wasRun.items()
+                          if not isCheckoutStep)
+        for path in candidates:
+            # Be conservative if we do not know the step, e.g. after a resume.
+            knownStep = self.__knownSteps.get(path)
+            if (knownStep is not None) and not dependsOnCheckout(knownStep):
+                continue
+            self.__buildDistBuildIds.pop(path, None)
+            self.__buildIdTasks.pop(path, None)
+            self.__wasRun.pop(path, None)
+            self.__invalidated[path] = self.__invalidated.get(path, 0) + 1
+
+        # Make sure the affected steps are visited again
+        self.__rewalk = True
+
+    def __getGeneration(self, step):
+        """Get invalidation generation of a step.
+
+        The number is increased every time the step is invalidated because of
+        a wrongly predicted build-id.
+        """
+        return self.__invalidated.get(step.getWorkspacePath(), 0)
 
     def __getIncrementalVariantId(self, step):
         """Calculate the variant-id with respect to workspace state.
@@ -1502,20 +2708,118 @@ esac
         Handles the dirty details of cancellation. Might throw CancelledError
         if overall execution was stopped.
         """
+        # Steps of the executor do not count as active while waiting.
+        # Otherwise their dependencies might never be dispatched.
         self.__runners.release()
+        blocked = currentTask() in self.__cookNodeTasks
+        if blocked:
+            self.__activeNodes -= 1
+            self.__dispatchCookNodes()
         try:
             ret = await coro
         finally:
+            if blocked: self.__activeNodes += 1
             acquired = False
             while not acquired:
                 try:
-                    await self.__runners.acquire()
+                    with traceSpan(None, "WAIT", "runner"):
+                        await self.__runners.acquire()
                     acquired = True
                 except concurrent.futures.CancelledError:
                     pass
         if not self.__running: raise CancelBuildException
         return ret
 
+    def __acquireJob(self, step):
+        """Get a job slot for the step.
+
+        Must be used in an 'async with' statement.
+        """
+        return JobSlot(self.__runners, step)
+
+
+def formatSize(size):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024: break
+        size /= 1024
+    return "{:.1f} {}".format(size, unit) if unit != "B" else "{} B".format(size)
+
+def showArchiveStatistics(archives):
+    def transfer(what, size, throughput, latency, codec, codecTime):
+        details = []
+        if throughput is not None:
+            details.append(formatSize(throughput) + "/s")
+        if latency["p50"] is not None:
+            details.append("latency p50 {:.2f}s, p90 {:.2f}s, p99 {:.2f}s".format(
+                latency["p50"], latency["p90"], latency["p99"]))
+        details.append("{} {:.1f}s".format(codec, codecTime))
+        return "    {} {} ({})".format(what, formatSize(size), ", ".join(details))
+
+    for a in archives:
+        print("Archive {}: {} hit{}, {} miss{}, {} error{}, {} upload{} ({} skipped)".format(
+            a["name"], a["hits"], "s" if a["hits"] != 1 else "",
+            a["misses"], "es" if a["misses"] != 1 else "",
+            a["errors"], "s" if a["errors"] != 1 else "",
+            a["uploads"], "s" if a["uploads"] != 1 else "", a["uploadsSkipped"]))
+        if a["hits"]:
+            print(transfer("downloaded", a["bytesDownloaded"], a["downloadThroughput"],
+                           a["downloadLatency"], "extract", a["extractTime"]))
+        if a["uploads"]:
+            print(transfer("uploaded", a["bytesUploaded"], a["uploadThroughput"],
+                           a["uploadLatency"], "compress", a["compressTime"]))
+
+def writeArchiveStatistics(fileName, archives):
+    tmpName = fileName + ".new"
+    with open(tmpName, "w") as f:
+        json.dump({ "archives" : archives }, f, indent=2, sort_keys=True)
+    os.replace(tmpName, fileName)
+
+def showBuildPlan(plan):
+    currentPackage = None
+    counts = {}
+    downloadSize = 0
+    duration = 0.0
+    unknown = 0
+    for entry in plan:
+        step = entry.step
+        package = "/".join(step.getPackage().getStack())
+        if package != currentPackage:
+            currentPackage = package
+            print(">>", colorize(package, EXECUTED|HEADLINE))
+        details = entry.reason
+        if entry.size is not None:
+            details += ", " + formatSize(entry.size)
+            downloadSize += entry.size
+        if entry.decision != "skip":
+            if entry.estimate is not None:
+                details += ", ~" + str(datetime.timedelta(seconds=int(entry.estimate)))
+                duration += entry.estimate
+            else:
+                unknown += 1
+        kind = { "skip" : SKIPPED, "fail" : ERROR }.get(entry.decision, EXECUTED)
+        if step.isCheckoutStep():
+            action = "CHECKOUT"
+        elif step.isBuildStep():
+            action = "BUILD"
+        else:
+            action = "PACKAGE"
+        print(colorize("   {:10}{:10}{} ({})".format(action, entry.decision,
+            step.getWorkspacePath(), details), kind))
+        counts[entry.decision] = counts.get(entry.decision, 0) + 1
+
+    summary = ", ".join("{} {}".format(counts.get(d, 0), n) for (d, n) in
+        [("checkout", "checkouts"), ("build", "builds"), ("download", "downloads"),
+         ("skip", "skipped")])
+    if downloadSize:
+        summary += " ({} to download)".format(formatSize(downloadSize))
+    print("Plan:", summary)
+    if counts.get("download?"):
+        print("     ", counts["download?"], "artifacts with unknown availability")
+    if counts.get("fail"):
+        print("     ", counts["fail"], "forced downloads will fail")
+    print("Estimated duration: {} (sequential{})".format(
+        str(datetime.timedelta(seconds=int(duration))),
+        ", {} steps without history".format(unknown) if unknown else ""))
 
 def commonBuildDevelop(parser, argv, bobRoot, develop):
     parser.add_argument('packages', metavar='PACKAGE', type=str, nargs='+',
@@ -1559,6 +2863,12 @@ def commonBuildDevelop(parser, argv, bobRoot, develop):
         help="Increase verbosity (may be specified multiple times)")
     parser.add_argument('--no-logfiles', default=None, action='store_true',
         help="Disable logFile generation.")
+    parser.add_argument('--compress-logfiles', default=None, action='store_true',
+        help="Compress log files")
+    parser.add_argument('--direct-launch', default=None, action='store_true',
+        help="Launch build scripts directly without the run file")
+    parser.add_argument('--show-tail', metavar="LINES", default=None, type=int,
+        help="Show last lines of output of running jobs in parallel builds")
     parser.add_argument('-D', default=[], action='append', dest="defines",
         help="Override default environment variable")
     parser.add_argument('-c', dest="configFile", default=[], action='append',
@@ -1583,6 +2893,18 @@ def commonBuildDevelop(parser, argv, bobRoot, develop):
         help="Disable sandboxing")
     parser.add_argument('--clean-checkout', action='store_true', default=None, dest='clean_checkout',
         help="Do a clean checkout if SCM state is dirty.")
+    parser.add_argument('--trace', metavar="FILE", default=None,
+        help="Record a timeline of the build in Chrome trace event format")
+    parser.add_argument('--archive-stats', metavar="FILE", default=None,
+        help="Save archive transfer statistics as JSON")
+    parser.add_argument('--plan', default=False, action='store_true',
+        help="Show what would be done without doing it")
+    parser.add_argument('--worker', default=[], action='append', metavar="ADDRESS",
+        help="Build packages on remote worker (unix:PATH or HOST:PORT)")
+    parser.add_argument('--worker-token', metavar="FILE",
+        help="Authenticate at the workers with the token that is stored in FILE")
+    parser.add_argument('--worker-timeout', metavar="SECONDS", type=int,
+        help="Build locally if a worker does not answer in time")
     args = parser.parse_args(argv)
 
     defines = processDefines(args.defines)
@@ -1636,9 +2958,13 @@ def commonBuildDevelop(parser, argv, bobRoot, develop):
                 'sandbox' : not develop,
                 'clean_checkout' : False,
                 'no_logfiles' : False,
+                'compress_logfiles' : False,
+                'direct_launch' : False,
+                'show_tail' : 0,
                 'link_deps' : True,
                 'jobs' : 1,
                 'keep_going' : False,
+                'worker_timeout' : DEFAULT_TIMEOUT,
             }
 
         for a in vars(args):
@@ -1649,6 +2975,10 @@ def commonBuildDevelop(parser, argv, bobRoot, develop):
             args.jobs = os.cpu_count()
         elif args.jobs <= 0:
             parser.error("--jobs argument must be greater than zero!")
+        if args.show_tail < 0:
+            parser.error("--show-tail argument must not be negative!")
+        if args.worker_timeout <= 0:
+            parser.error("--worker-timeout argument must be greater than zero!")
 
         envWhiteList = recipes.envWhiteList()
         envWhiteList |= set(args.white_list)
@@ -1679,6 +3009,14 @@ def commonBuildDevelop(parser, argv, bobRoot, develop):
         builder.setLinkDependencies(args.link_deps)
         builder.setJobs(args.jobs)
         builder.setKeepGoing(args.keep_going)
+        builder.setPrefetch(args.jobs > 1)
+        builder.setWorkers(args.worker + cfg.get('worker', []),
+            readToken(args.worker_token) if args.worker_token else None,
+            args.worker_timeout)
+        builder.setCompressLogFiles(args.compress_logfiles)
+        builder.setDirectLaunch(args.direct_launch)
+        if recipes.contentStore() is not None:
+            builder.setContentStore(ContentStore(recipes.contentStore()))
         if args.resume: builder.loadBuildState()
 
         backlog = []
@@ -1692,6 +3030,13 @@ def commonBuildDevelop(parser, argv, bobRoot, develop):
                 build_provided = (args.destination and args.build_provided == None) or args.build_provided
                 if build_provided: providedBacklog.extend(packageStep._getProvidedDeps())
 
+        if args.plan:
+            checkoutOnly = True if args.build_mode == 'checkout-only' else False
+            plan = builder.plan(backlog, checkoutOnly)
+            plan.extend(builder.plan(providedBacklog, checkoutOnly, 1))
+            showBuildPlan(plan)
+            return
+
         success = runHook(recipes, 'preBuildHook',
             ["/".join(p.getPackage().getStack()) for p in backlog])
         if not success:
@@ -1699,8 +3044,10 @@ def commonBuildDevelop(parser, argv, bobRoot, develop):
                 help="A preBuildHook is set but it returned with a non-zero status.")
         success = False
         if args.jobs > 1:
+            setShowTail(args.show_tail)
             setTui(args.jobs)
             builder.enableBufferedIO()
+        if args.trace: enableTrace()
         try:
             builder.cook(backlog, True if args.build_mode == 'checkout-only' else False)
             for p in backlog:
@@ -1716,6 +3063,10 @@ def commonBuildDevelop(parser, argv, bobRoot, develop):
         finally:
             if args.jobs > 1: setTui(1)
             builder.saveBuildState()
+            if args.trace: writeTrace(args.trace)
+            if args.archive_stats:
+                writeArchiveStatistics(args.archive_stats,
+                                       builder.getStatistic().archives)
             runHook(recipes, 'postBuildHook', ["success" if success else "fail"] + results)
 
     finally:
@@ -1739,6 +3090,7 @@ def commonBuildDevelop(parser, argv, bobRoot, develop):
                 + str(stats.packagesBuilt)
                     + " package" + ("s" if (stats.packagesBuilt != 1) else "") + " built, "
                 + str(stats.packagesDownloaded) + " downloaded.")
+        showArchiveStatistics(stats.archives)
 
         # copy build result if requested
         ok = True
@@ -2024,6 +3376,11 @@ would get removed without actually deleting that already.
             print("rm", d)
         if not args.dry_run:
             removePath(d)
+            BobState().delWorkspaceState(d)
+
+    # drop entries of the content store that are not used anymore
+    if recipes.contentStore() is not None:
+        ContentStore(recipes.contentStore()).collect(args.dry_run, args.verbose)
 
 def doQueryPath(argv, bobRoot):
     # Local imports
@@ -1270,6 +1270,16 @@ class PackageStep(Step):
     def hasNetAccess(self):
         return self.getPackage().getRecipe()._getPackageNetAccess()
 
+    def getCopySpec(self):
+        """Get the declarative copy of the package step.
+
+        Returns ``None`` if the step is defined by a regular ``packageScript``.
+        Otherwise a dict with the source directory in ``from`` relative to the
+        build step workspace and the ``include`` and ``exclude`` glob lists is
+        returned.
+        """
+        return self.getPackage().getRecipe().packageCopy
+
 
 class CorePackageInternal(CoreItem):
     __slots__ = []
@@ -1547,6 +1557,38 @@ class IncludeHelper:
         else:
             return (None, None)
 
+def packageCopy(spec, sourceName):
+    """Create the package script of a ``packageCopy`` recipe entry.
+
+    Returns a tuple of the normalized spec, the script and the digest script.
+    The script is what Bob executes natively when building the package step.
+    It is still used for Jenkins builds and manual invocations. The digest is
+    calculated from the canonical script without the source anchor so that it
+    depends only on the normalized spec.
+    """
+    src = os.path.normpath(spec.get("from", "."))
+    if os.path.isabs(src) or src == ".." or src.startswith("../"):
+        raise ParseError("packageCopy: 'from' must be a relative path inside the build workspace: "
+                         + spec["from"])
+    spec = {
+        "from" : src,
+        "include" : spec.get("include", ["*"]),
+        "exclude" : spec.get("exclude", []),
+    }
+    if not spec["include"]:
+        raise ParseError("packageCopy: 'include' must not be empty")
+    script = "\n".join([
+        '_bob_dst="$PWD"',
+        'cd "$1"/' + quote(src),
+        "find . ! -type d \\( " +
+            " -o ".join("-path " + quote("./"+i) for i in spec["include"]) + " \\)" +
+            "".join(" ! -path " + quote("./"+e) for e in spec["exclude"]) +
+            ' -exec cp -a --parents -t "$_bob_dst" {} +',
+    ])
+    digest = asHexStr(hashlib.sha1(script.encode('utf8')).digest())
+    sourceAnchor = "_BOB_SOURCES[$LINENO]=" + quote(sourceName + " (packageCopy)")
+    return (spec, sourceAnchor + "\n" + script, digest)
+
 def mergeFilter(left, right):
     if left is None:
         return right
@@ -1796,6 +1838,8 @@ class Recipe(object):
         self.__checkout = (checkoutScript, checkoutDigestScript, checkoutSCMs, checkoutAsserts)
         self.__build = incHelper.resolve(recipe.get("buildScript"), "buildScript")
         self.__package = incHelper.resolve(recipe.get("packageScript"), "packageScript")
+        self.__packageCopy = (packageCopy(recipe["packageCopy"], sourceName)
+            if "packageCopy" in recipe else None)
 
         # Consider checkout deterministic by default if no checkout script is
         # involved.
@@ -1883,6 +1927,7 @@ class Recipe(object):
             self.__checkoutDeterministic = self.__checkoutDeterministic and cls.__checkoutDeterministic
             if self.__buildNetAccess is None: self.__buildNetAccess = cls.__buildNetAccess
             if self.__packageNetAccess is None: self.__packageNetAccess = cls.__packageNetAccess
+            if self.__packageCopy is None: self.__packageCopy = cls.__packageCopy
             # merge scripts
             checkoutScript = joinScripts([cls.__checkout[0], checkoutScript])
             checkoutDigestScript = joinScripts([cls.__checkout[1], checkoutDigestScript], "\n")
@@ -1912,6 +1957,15 @@ class Recipe(object):
             self.__varSelf = [ self.__varSelf ] if self.__varSelf else []
             self.__varPrivate = [ self.__varPrivate ] if self.__varPrivate else []
 
+        # a declarative copy replaces the package script
+        if self.__packageCopy is not None:
+            if self.__package[0] is not None:
+                raise ParseError("packageCopy and packageScript are mutually exclusive",
+                    help="Either the recipe or one of its classes define both.")
+            if self.__build[0] is None:
+                raise ParseError("packageCopy requires a buildScript")
+            self.__package = self.__packageCopy[1:]
+
         # the package step must always be valid
         if self.__package[0] is None:
             self.__package = ("", 'da39a3ee5e6b4b0d3255bfef95601890afd80709')
@@ -2277,6 +2331,10 @@ Every dependency must only be given once."""
     def packageDigestScript(self):
         return self.__package[1]
 
+    @property
+    def packageCopy(self):
+        return self.__packageCopy[0] if self.__packageCopy is not None else None
+
     @property
     def toolDepCheckout(self):
         return self.__toolDepCheckout
@@ -2327,17 +2385,39 @@ class ArchiveValidator:
         baseArchive = {
             'backend' : str,
             schema.Optional('flags') : schema.Schema(["download", "upload",
-                "nofail", "nolocal", "nojenkins"])
+                "nofail", "nolocal", "nojenkins"]),
+            schema.Optional('compression') : schema.Schema({
+                schema.Optional('method') : schema.Or("gzip", "xz", "zstd"),
+                schema.Optional('level') : int,
+                schema.Optional('threads') : schema.And(int, lambda x: x >= 1),
+            }),
+            schema.Optional('missCacheTTL') : schema.And(int, lambda x: x >= 0),
+            schema.Optional('chunked') : bool,
+            schema.Optional('maxFailures') : schema.And(int, lambda x: x >= 0),
         }
         fileArchive = baseArchive.copy()
         fileArchive["path"] = str
+        fileArchive[schema.Optional("manifest")] = bool
+        fileArchive[schema.Optional("unpacked")] = bool
+        fileArchive[schema.Optional("linkMethod")] = schema.Or("hardlink", "copy")
         httpArchive = baseArchive.copy()
         httpArchive["url"] = str
         httpArchive[schema.Optional("sslVerify")] = bool
+        httpArchive[schema.Optional("poolSize")] = schema.And(int, lambda x: x >= 0)
+        httpArchive[schema.Optional("retries")] = schema.And(int, lambda x: x >= 0)
+        httpArchive[schema.Optional("retryDelay")] = schema.And(schema.Or(int, float),
+                                                                lambda x: x >= 0)
+        httpArchive[schema.Optional("downloadStreams")] = schema.And(int, lambda x: x >= 1)
+        httpArchive[schema.Optional("streamUpload")] = bool
+        httpArchive[schema.Optional("manifest")] = bool
+        httpArchive[schema.Optional("asyncio")] = bool
         shellArchive = baseArchive.copy()
         shellArchive.update({
             schema.Optional('download') : str,
             schema.Optional('upload') : str,
+            schema.Optional('streamUpload') : bool,
+            schema.Optional('server') : str,
+            schema.Optional('manifest') : bool,
         })
         azureArchive = baseArchive.copy()
         azureArchive.update({
@@ -2345,6 +2425,10 @@ class ArchiveValidator:
             'container' : str,
             schema.Optional('key') : str,
             schema.Optional('sasToken"') : str,
+            schema.Optional('endpoint') : str,
+            schema.Optional('maxConnections') : schema.And(int, lambda x: x >= 1),
+            schema.Optional('blockSize') : schema.And(int,
+                lambda x: 64*1024 <= x <= 100*1024*1024),
         })
         self.__backends = {
             'none' : schema.Schema(baseArchive),
@@ -2392,6 +2476,9 @@ class RecipeSet:
             schema.Optional('clean') : bool,
             schema.Optional('verbosity') : int,
             schema.Optional('no_logfiles') : bool,
+            schema.Optional('compress_logfiles') : bool,
+            schema.Optional('direct_launch') : bool,
+            schema.Optional('show_tail') : int,
             schema.Optional('link_deps') : bool,
             schema.Optional('upload') : bool,
             schema.Optional('download') : schema.Or("yes", "no", "deps", "forced", "forced-deps"),
@@ -2399,6 +2486,9 @@ class RecipeSet:
             schema.Optional('clean_checkout') : bool,
             schema.Optional('always_checkout') : [str],
             schema.Optional('jobs') : int,
+            schema.Optional('worker') : [str],
+            schema.Optional('worker_token') : str,
+            schema.Optional('worker_timeout') : int,
         })
 
     GRAPH_SCHEMA = schema.Schema(
@@ -2443,6 +2533,9 @@ class RecipeSet:
         self.__classes = {}
         self.__whiteList = set(["TERM", "SHELL", "USER", "HOME"])
         self.__archive = { "backend" : "none" }
+        self.__contentStore = None
+        self.__archiveCache = None
+        self.__archiveStrategy = {}
         self.__rootFilter = []
         self.__scmOverrides = []
         self.__hooks = {}
@@ -2506,6 +2599,8 @@ class RecipeSet:
         self.__sandboxOpts = {}
 
         def updateArchive(x): self.__archive = x
+        def updateContentStore(x): self.__contentStore = x
+        def updateArchiveCache(x): self.__archiveCache = x
 
         self.__settings = {
             "alias" : BuiltinSetting(
@@ -2519,6 +2614,26 @@ class RecipeSet:
                 ),
                 updateArchive
             ),
+            "archiveCache" : BuiltinSetting(
+                schema.Schema({
+                    'path' : str,
+                    schema.Optional('size') : schema.Or(int,
+                        schema.Regex(r'^[0-9]+[KMGT]?$'))
+                }),
+                updateArchiveCache
+            ),
+            "archiveStrategy" : BuiltinSetting(
+                schema.Schema({
+                    schema.Optional('download') : schema.Or("sequential", "race"),
+                    schema.Optional('upload') : schema.Or("sequential", "parallel"),
+                    schema.Optional('order') : schema.Or("config", "latency"),
+                }),
+                lambda x: self.__archiveStrategy.update(x)
+            ),
+            "contentStore" : BuiltinSetting(
+                schema.Schema(str),
+                updateContentStore
+            ),
             "command" : BuiltinSetting(
                 schema.Schema({
                     schema.Optional('dev') : self.BUILD_DEV_SCHEMA,
@@ -2721,6 +2836,31 @@ class RecipeSet:
     def archiveSpec(self):
         return self.__archive
 
+    def archiveCache(self):
+        """Spec of the local archive cache or None if disabled.
+
+        The size is always returned in bytes.
+        """
+        if self.__archiveCache is None:
+            return None
+        size = str(self.__archiveCache.get("size", "10G"))
+        if size[-1] in "KMGT":
+            size = int(size[:-1]) * 1024 ** ("KMGT".index(size[-1]) + 1)
+        return {
+            "path" : os.path.abspath(os.path.expanduser(self.__archiveCache["path"])),
+            "size" : int(size),
+        }
+
+    def archiveStrategy(self):
+        """How multiple archive backends are used. See MultiArchive."""
+        return self.__archiveStrategy
+
+    def contentStore(self):
+        """Path of the machine-local content store or None if disabled."""
+        if self.__contentStore is None:
+            return None
+        return os.path.abspath(os.path.expanduser(self.__contentStore))
+
     def defaultEnv(self):
         return self.__defaultEnv
 
@@ -2886,6 +3026,11 @@ class RecipeSet:
             schema.Optional('checkoutScript') : str,
             schema.Optional('buildScript') : str,
             schema.Optional('packageScript') : str,
+            schema.Optional('packageCopy') : schema.Schema({
+                schema.Optional('from') : str,
+                schema.Optional('include') : [str],
+                schema.Optional('exclude') : [str],
+            }, error="packageCopy: invalid entry"),
             schema.Optional('checkoutTools') : [ toolNameSchema ],
             schema.Optional('buildTools') : [ toolNameSchema ],
             schema.Optional('packageTools') : [ toolNameSchema ],
@@ -78,6 +78,10 @@ def __upload(*args, **kwargs):
     from .archive import doUpload
     doUpload(*args, **kwargs)
 
+def __worker(*args, **kwargs):
+    from .worker import doWorker
+    doWorker(*args, **kwargs)
+
 availableCommands = {
     "archive"       : ('hl', __archive, "Manage binary artifact archives"),
     "build"         : ('hl', __build, "Build (sub-)packages in release mode"),
@@ -89,6 +93,7 @@ availableCommands = {
     "ls"            : ('hl', __ls, "List package hierarchy"),
     "project"       : ('hl', __project, "Create project files"),
     "status"        : ('hl', __status, "Show SCM status"),
+    "worker"        : ('hl', __worker, "Execute build steps for remote clients"),
 
     "query-scm"     : ('ll', __queryscm, "Query SCM information"),
     "query-recipe"  : ('ll', __queryrecipe, "Query package sources"),
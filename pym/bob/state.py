@@ -37,6 +37,8 @@ class _BobState():
         self.__lock = None
         self.__buildIdCache = None
         self.__variantIds = {}
+        self.__durations = {}
+        self.__durationsChanged = False
 
         # lock state
         lockFile = ".bob-state.lock"
@@ -78,6 +80,7 @@ class _BobState():
                 self.__dirStates = state.get("dirStates", {})
                 self.__buildState = state.get("buildState", {})
                 self.__variantIds = state.get("variantIds", {})
+                self.__durations = state.get("durations", {})
 
                 # version upgrades
                 if state["version"] == 2:
@@ -115,6 +118,7 @@ class _BobState():
                 "dirStates" : self.__dirStates,
                 "buildState" : self.__buildState,
                 "variantIds" : self.__variantIds,
+                "durations" : self.__durations,
             }
             tmpFile = self.__path+".new"
             try:
@@ -126,6 +130,7 @@ class _BobState():
             except OSError as e:
                 raise ParseError("Error saving workspace state: " + str(e))
             self.__dirty = False
+            self.__durationsChanged = False
         else:
             self.__dirty = True
 
@@ -134,6 +139,7 @@ class _BobState():
             try:
                 self.__buildIdCache = sqlite3.connect(".bob-buildids.sqlite3", isolation_level=None).cursor()
                 self.__buildIdCache.execute("CREATE TABLE IF NOT EXISTS buildids(key PRIMARY KEY, value)")
+                self.__buildIdCache.execute("CREATE TABLE IF NOT EXISTS archivemisses(key PRIMARY KEY, time)")
                 self.__buildIdCache.execute("BEGIN")
             except sqlite3.Error as e:
                 self.__buildIdCache = None
@@ -141,6 +147,14 @@ class _BobState():
 
     def finalize(self):
         assert (self.__asynchronous == 0) and not self.__dirty
+        if self.__durationsChanged:
+            try:
+                self.__save()
+            except ParseError as e:
+                from .tty import colorize
+                from sys import stderr
+                print(colorize("Warning: cannot save step durations: "+str(e), "33"),
+                    file=stderr)
         if self.__buildIdCache is not None:
             try:
                 self.__buildIdCache.execute("END")
@@ -229,6 +243,19 @@ class _BobState():
             self.__variantIds[path] = variantId
             self.__save()
 
+    def getStepDuration(self, path, action):
+        """Get duration in seconds of last execution of action in workspace."""
+        return self.__durations.get(path, {}).get(action)
+
+    def setStepDuration(self, path, action, duration):
+        """Record duration of action in workspace.
+
+        The durations are only informational. They are saved together with the
+        next state change or when Bob finishes.
+        """
+        self.__durations.setdefault(path, {})[action] = duration
+        self.__durationsChanged = True
+
     def resetWorkspaceState(self, path, dirState):
         needSave = False
         if path in self.__results:
@@ -243,6 +270,19 @@ class _BobState():
         if path in self.__variantIds:
             del self.__variantIds[path]
             needSave = True
+        if path in self.__durations:
+            del self.__durations[path]
+            needSave = True
+        if needSave:
+            self.__save()
+
+    def delWorkspaceState(self, path):
+        needSave = False
+        for d in (self.__results, self.__inputs, self.__dirStates,
+                  self.__variantIds, self.__durations):
+            if path in d:
+                del d[path]
+                needSave = True
         if needSave:
             self.__save()
 
@@ -329,6 +369,45 @@ class _BobState():
         except sqlite3.Error as e:
             raise ParseError("Cannot access buildid cache: " + str(e))
 
+    def getArchiveMiss(self, key):
+        """Get the time when an artifact was last found missing in an archive.
+
+        The misses are stored persistently. They are kept across invocations
+        until they are removed by delArchiveMiss() or delArchiveMisses().
+        """
+        self.__openBIdCache()
+        try:
+            self.__buildIdCache.execute("SELECT time FROM archivemisses WHERE key=?", (key,))
+            ret = self.__buildIdCache.fetchone()
+            return ret and ret[0]
+        except sqlite3.Error as e:
+            raise ParseError("Cannot access buildid cache: " + str(e))
+
+    def setArchiveMiss(self, key, time):
+        self.__openBIdCache()
+        try:
+            self.__buildIdCache.execute("INSERT OR REPLACE INTO archivemisses VALUES (?, ?)", (key, time))
+        except sqlite3.Error as e:
+            raise ParseError("Cannot access buildid cache: " + str(e))
+
+    def delArchiveMiss(self, key):
+        self.__openBIdCache()
+        try:
+            self.__buildIdCache.execute("DELETE FROM archivemisses WHERE key=?", (key,))
+        except sqlite3.Error as e:
+            raise ParseError("Cannot access buildid cache: " + str(e))
+
+    def delArchiveMisses(self, prefix, before):
+        """Delete all misses whose key starts with prefix and that were
+        recorded before the given time."""
+        self.__openBIdCache()
+        try:
+            self.__buildIdCache.execute(
+                "DELETE FROM archivemisses WHERE substr(key, 1, ?)=? AND time<?",
+                (len(prefix), prefix, before))
+        except sqlite3.Error as e:
+            raise ParseError("Cannot access buildid cache: " + str(e))
+
 def BobState():
     if _BobState.instance is None:
         _BobState.instance = _BobState()
@@ -0,0 +1,277 @@
+# Bob build tool
+# Copyright (C) 2018  TechniSat Digital GmbH
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Machine-local content store of package results.
+
+Package results are kept in the store keyed by their build-id. Workspaces of
+packages with the same build-id are populated from the store by hard links
+instead of downloading and extracting the artifact again. This deduplicates
+identical results of different variants and projects on the same machine.
+Entries are created by copying (or cloning) the files of the workspace. Hence
+the workspace that was added to the store is not linked to the entry and stays
+writable.
+
+Every workspace that is populated from an entry (or that was used to create
+it) registers a reference in the entry. Additionally the build-id is recorded
+next to the workspace. A reference stays valid as long as the workspace exists
+and still records the build-id of the entry. Entries without valid references
+are removed by :meth:`ContentStore.collect`. Because the files are hard linked
+this never affects existing workspaces. For the same reason the files are
+write protected in the store and in all workspaces that are populated from it.
+Workspaces that are rebuilt or unpacked by other means must drop their
+reference by :func:`releaseWorkspace`.
+
+Entries are created in a temporary directory and renamed into place so that
+concurrent Bob processes see either a complete entry or none at all.
+"""
+
+from .errors import BuildError
+from .tty import stepAction, WARNING
+from .utils import asHexStr, copyFiles, removePath
+import asyncio
+import concurrent.futures
+import concurrent.futures.process
+import errno
+import hashlib
+import os
+import shutil
+import signal
+import stat
+import tempfile
+import time
+
+# Name of the file next to the workspace that holds the build-id
+MARKER_FILE = "content-store"
+
+# Keep temporary directories of other processes for at least this long
+TMP_MAX_AGE = 24 * 60 * 60
+
+def linkTree(src, dst):
+    """Populate 'dst' with hard links to all files in 'src'.
+
+    Directories are re-created. Falls back to copying the files if 'src' and
+    'dst' are on different file systems.
+    """
+    created = []
+    try:
+        for root, dirs, files in os.walk(src):
+            rel = os.path.relpath(root, src)
+            for d in dirs[:]:
+                if os.path.islink(os.path.join(root, d)):
+                    # symlinks to directories are linked like files
+                    dirs.remove(d)
+                    files.append(d)
+                else:
+                    os.mkdir(os.path.join(dst, rel, d))
+                    created.append(os.path.join(rel, d))
+            for f in files:
+                os.link(os.path.join(root, f), os.path.join(dst, rel, f),
+                        follow_symlinks=False)
+    except OSError as e:
+        if e.errno != errno.EXDEV: raise
+        for i in os.listdir(dst): removePath(os.path.join(dst, i))
+        copyFiles(src, dst)
+        return
+
+    for rel in reversed(created):
+        shutil.copystat(os.path.join(src, rel), os.path.join(dst, rel),
+                        follow_symlinks=False)
+
+def cloneTree(src, dst):
+    """Copy all files and directories of 'src' to 'dst'.
+
+    The file data is cloned if supported by the file system. Unlike
+    copyFiles() empty directories are copied too.
+    """
+    copyFiles(src, dst)
+    for root, dirs, files in os.walk(src):
+        rel = os.path.relpath(root, src)
+        for d in dirs:
+            srcDir = os.path.join(root, d)
+            dstDir = os.path.join(dst, rel, d)
+            if not os.path.islink(srcDir) and not os.path.isdir(dstDir):
+                os.mkdir(dstDir)
+                shutil.copystat(srcDir, dstDir)
+
+def writeProtectTree(path):
+    """Remove the write permissions of all files below 'path'.
+
+    Directories are not touched so that the tree can still be removed.
+    """
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            name = os.path.join(root, f)
+            st = os.lstat(name)
+            if stat.S_ISREG(st.st_mode):
+                os.chmod(name, stat.S_IMODE(st.st_mode) & ~0o222)
+
+def releaseWorkspace(content):
+    """Drop the content store reference of a package workspace.
+
+    Must be called before the workspace is rebuilt or populated by other means
+    than the store. Otherwise the workspace would still keep the store entry
+    alive.
+    """
+    try:
+        os.unlink(os.path.join(content, "..", MARKER_FILE))
+    except FileNotFoundError:
+        pass
+
+class ContentStore:
+    def __init__(self, path):
+        self.__path = path
+
+    def __entryPath(self, buildId):
+        name = asHexStr(buildId)
+        return os.path.join(self.__path, name[0:2], name[2:])
+
+    def __tmpPath(self):
+        return os.path.join(self.__path, "tmp")
+
+    def __addRef(self, entry, buildId, content):
+        workspace = os.path.abspath(content)
+        with open(os.path.join(workspace, "..", MARKER_FILE), "w") as f:
+            f.write(asHexStr(buildId))
+        ref = hashlib.sha1(workspace.encode("utf8")).hexdigest()
+        with open(os.path.join(entry, "refs", ref), "w") as f:
+            f.write(workspace)
+
+    def contains(self, buildId):
+        return os.path.isdir(os.path.join(self.__entryPath(buildId), "content"))
+
+    async def checkout(self, step, buildId, audit, content):
+        """Populate a package workspace from the store.
+
+        Returns True if the entry was found and the workspace was populated.
+        """
+        if not self.contains(buildId):
+            return False
+
+        loop = asyncio.get_event_loop()
+        with stepAction(step, "LINK", content, details=" from content store") as a:
+            try:
+                ret = await loop.run_in_executor(None, ContentStore._checkout,
+                    self, buildId, audit, content)
+                if not ret: a.fail("vanished", WARNING)
+                return ret
+            except (concurrent.futures.CancelledError, concurrent.futures.process.BrokenProcessPool):
+                raise BuildError("Checkout from content store interrupted.")
+
+    def _checkout(self, buildId, audit, content):
+        # restore signals to default so that Ctrl+C kills us
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+        entry = self.__entryPath(buildId)
+        try:
+            removePath(audit)
+            removePath(content)
+            os.makedirs(content)
+            linkTree(os.path.join(entry, "content"), content)
+            shutil.copyfile(os.path.join(entry, "audit.json.gz"), audit)
+            self.__addRef(entry, buildId, content)
+            return True
+        except OSError:
+            # The entry was probably removed concurrently. Leave the
+            # workspace empty so that the package is downloaded or built.
+            removePath(audit)
+            removePath(content)
+            os.makedirs(content)
+            return False
+
+    async def insert(self, step, buildId, audit, content):
+        """Add a package workspace to the store.
+
+        Errors are not fatal. The package is just not deduplicated.
+        """
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(None, ContentStore._insert,
+                self, buildId, audit, content)
+        except OSError as e:
+            with stepAction(step, "STORE", content) as a:
+                a.setResult("error ({})".format(str(e)), WARNING)
+        except BuildError as e:
+            with stepAction(step, "STORE", content) as a:
+                a.setResult("error ({})".format(e.slogan), WARNING)
+        except (concurrent.futures.CancelledError, concurrent.futures.process.BrokenProcessPool):
+            raise BuildError("Insertion into content store interrupted.")
+
+    def _insert(self, buildId, audit, content):
+        # restore signals to default so that Ctrl+C kills us
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+        entry = self.__entryPath(buildId)
+        if not os.path.isdir(entry):
+            os.makedirs(self.__tmpPath(), exist_ok=True)
+            tmp = tempfile.mkdtemp(dir=self.__tmpPath())
+            try:
+                os.mkdir(os.path.join(tmp, "content"))
+                os.mkdir(os.path.join(tmp, "refs"))
+                # Never link the workspace. It must stay writable.
+                cloneTree(content, os.path.join(tmp, "content"))
+                shutil.copyfile(audit, os.path.join(tmp, "audit.json.gz"))
+                writeProtectTree(tmp)
+                os.makedirs(os.path.dirname(entry), exist_ok=True)
+                try:
+                    os.rename(tmp, entry)
+                except OSError:
+                    # Somebody else was faster?
+                    if not os.path.isdir(entry): raise
+            finally:
+                if os.path.exists(tmp): removePath(tmp)
+        self.__addRef(entry, buildId, content)
+
+    def collect(self, dryRun=False, verbose=False):
+        """Remove all entries that are not referenced anymore.
+
+        Returns the number of removed entries.
+        """
+        removed = 0
+        if not os.path.isdir(self.__path): return removed
+        for prefix in sorted(os.listdir(self.__path)):
+            if prefix == "tmp":
+                self.__collectTmp(dryRun, verbose)
+                continue
+            for suffix in sorted(os.listdir(os.path.join(self.__path, prefix))):
+                entry = os.path.join(self.__path, prefix, suffix)
+                if self.__collectRefs(entry, prefix+suffix, dryRun): continue
+                if verbose or dryRun:
+                    print("rm", entry)
+                if not dryRun:
+                    # rename first so that concurrent checkouts fail cleanly
+                    os.makedirs(self.__tmpPath(), exist_ok=True)
+                    tmp = tempfile.mkdtemp(dir=self.__tmpPath())
+                    os.rename(entry, os.path.join(tmp, "entry"))
+                    removePath(tmp)
+                removed += 1
+        return removed
+
+    def __collectRefs(self, entry, name, dryRun):
+        """Drop stale references of an entry. Returns True if still used."""
+        used = False
+        refsDir = os.path.join(entry, "refs")
+        for ref in os.listdir(refsDir) if os.path.isdir(refsDir) else []:
+            try:
+                with open(os.path.join(refsDir, ref)) as f:
+                    workspace = f.read()
+                with open(os.path.join(workspace, "..", MARKER_FILE)) as f:
+                    valid = os.path.isdir(workspace) and (f.read() == name)
+            except OSError:
+                valid = False
+            if valid:
+                used = True
+            elif not dryRun:
+                os.unlink(os.path.join(refsDir, ref))
+        return used
+
+    def __collectTmp(self, dryRun, verbose):
+        now = time.time()
+        for i in os.listdir(self.__tmpPath()):
+            tmp = os.path.join(self.__tmpPath(), i)
+            if now - os.lstat(tmp).st_mtime < TMP_MAX_AGE: continue
+            if verbose or dryRun:
+                print("rm", tmp)
+            if not dryRun:
+                removePath(tmp)
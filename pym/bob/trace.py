@@ -0,0 +1,181 @@
+# Bob build tool
+# Copyright (C) 2018  TechniSat Digital GmbH
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Timeline recording of builds.
+
+Records the phases of all steps as "complete" events of the Chrome trace event
+format. The resulting file can be loaded into chrome://tracing or Perfetto.
+Every lane corresponds to a job slot of the build. Events are placed on the
+lane of the job slot that is held by their task. Nested events inherit the
+lane of the enclosing event. Events that happen without a job slot, e.g.
+waiting for one, are recorded as asynchronous events that do not occupy a
+lane.
+"""
+
+import json
+import os
+import time
+
+def currentTask():
+    # Imported lazily because bob.utils depends on this module indirectly
+    from .utils import currentTask
+    return currentTask()
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+class TraceSpan:
+    def __init__(self, tracer, name, category, args):
+        self.__tracer = tracer
+        self.__name = name
+        self.__category = category
+        self.__args = args
+
+    def __enter__(self):
+        self.__task = currentTask()
+        self.__lane = self.__tracer._enterSpan(self.__task)
+        self.__start = self.__tracer._now()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.__args["error"] = str(exc_value) or exc_type.__name__
+        self.__tracer._putEvent(self.__name, self.__category, self.__task,
+            self.__lane, self.__start, self.__args)
+        return False
+
+class TraceAction:
+    """Wrap a TUI action to record its duration."""
+
+    def __init__(self, span, action):
+        self.__span = span
+        self.__action = action
+
+    def __enter__(self):
+        self.__span.__enter__()
+        return self.__action.__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            return self.__action.__exit__(exc_type, exc_value, traceback)
+        finally:
+            self.__span.__exit__(exc_type, exc_value, traceback)
+
+class Tracer:
+    def __init__(self):
+        self.__origin = time.monotonic()
+        self.__events = []
+        self.__lanes = set()
+        self.__taskLanes = {}
+        self.__taskSpans = {}
+        self.__asyncIds = 0
+
+    def _now(self):
+        return int((time.monotonic() - self.__origin) * 1000000)
+
+    def setLane(self, lane):
+        """Set the lane of the current task.
+
+        Called whenever the task acquires (or releases with None) a job slot.
+        """
+        task = currentTask()
+        if lane is None:
+            self.__taskLanes.pop(task, None)
+        else:
+            self.__taskLanes[task] = lane
+
+    def _enterSpan(self, task):
+        spans = self.__taskSpans.setdefault(task, [])
+        lane = spans[-1] if spans else self.__taskLanes.get(task)
+        spans.append(lane)
+        return lane
+
+    def _putEvent(self, name, category, task, lane, start, args):
+        spans = self.__taskSpans[task]
+        spans.pop()
+        if not spans: del self.__taskSpans[task]
+
+        end = self._now()
+        if lane is not None:
+            self.__lanes.add(lane)
+            self.__events.append({
+                "name" : name,
+                "cat" : category,
+                "ph" : "X",
+                "pid" : 1,
+                "tid" : lane,
+                "ts" : start,
+                "dur" : end - start,
+                "args" : args,
+            })
+        else:
+            self.__asyncIds += 1
+            self.__events.append({ "name" : name, "cat" : category, "ph" : "b",
+                "id" : self.__asyncIds, "pid" : 1, "tid" : 0, "ts" : start,
+                "args" : args })
+            self.__events.append({ "name" : name, "cat" : category, "ph" : "e",
+                "id" : self.__asyncIds, "pid" : 1, "tid" : 0, "ts" : end })
+
+    def span(self, step, name, category):
+        args = {}
+        if step is not None:
+            args["package"] = "/".join(step.getPackage().getStack())
+            args["workspace"] = step.getWorkspacePath()
+            name = "{} {}".format(name, step.getPackage().getName())
+        return TraceSpan(self, name, category, args)
+
+    def write(self, fileName):
+        meta = [ { "name" : "process_name", "ph" : "M", "pid" : 1, "tid" : 0,
+                   "args" : { "name" : "bob" } } ]
+        meta.extend({ "name" : "thread_name", "ph" : "M", "pid" : 1, "tid" : i,
+                      "args" : { "name" : "lane {}".format(i) } }
+                    for i in sorted(self.__lanes))
+        trace = {
+            "traceEvents" : meta + self.__events,
+            "displayTimeUnit" : "ms",
+        }
+        tmpName = fileName + ".new"
+        with open(tmpName, "w") as f:
+            json.dump(trace, f)
+        os.replace(tmpName, fileName)
+
+def enableTrace():
+    global __tracer
+    __tracer = Tracer()
+
+def traceSpan(step, name, category):
+    """Record the time of a code section.
+
+    The step may be None if the section is not associated to any step. Does
+    nothing unless tracing was enabled.
+    """
+    if __tracer is None:
+        return __nullSpan
+    else:
+        return __tracer.span(step, name, category)
+
+def traceAction(step, name, category, action):
+    if __tracer is None:
+        return action
+    else:
+        return TraceAction(__tracer.span(step, name, category), action)
+
+def traceLane(lane):
+    """Set the lane of the current task. Does nothing unless tracing is enabled."""
+    if __tracer is not None:
+        __tracer.setLane(lane)
+
+def writeTrace(fileName):
+    if __tracer is not None:
+        __tracer.write(fileName)
+
+# module initialization
+
+__tracer = None
+__nullSpan = NullSpan()
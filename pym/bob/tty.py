@@ -3,6 +3,8 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+from .trace import traceAction
+import re
 import sys
 
 DEFAULT = 0
@@ -106,6 +108,14 @@ class BaseTUIAction:
         self.setResult(message, kind, details)
         self.setError(message, kind, details)
 
+    def getTailLines(self):
+        """Number of output lines that should be passed to setTail()."""
+        return 0
+
+    def setTail(self, lines):
+        """Update the last lines of the output of a running job."""
+        pass
+
 class BaseTUI:
     def __init__(self, verbosity):
         self.__verbosity = verbosity
@@ -207,6 +217,12 @@ class ParallelTtyUIAction(BaseTUIAction):
     def __enter__(self):
         return self
 
+    def getTailLines(self):
+        return self.__tui._getTailLines()
+
+    def setTail(self, lines):
+        self.__tui._setTail(self.__slot, lines)
+
     def __exit__(self, exc_type, exc_value, traceback):
         if exc_type is not None:
             kind = ERROR
@@ -229,13 +245,15 @@ class ParallelTtyUIAction(BaseTUIAction):
         return False
 
 class ParallelTtyUI(BaseTUI):
-    def __init__(self, verbosity, maxJobs):
+    def __init__(self, verbosity, maxJobs, showTail):
         super().__init__(verbosity)
         import termios
         self.__index = 1
         self.__maxJobs = maxJobs
+        self.__showTail = showTail
         self.__jobs = {}
         self.__slots = [None] * maxJobs
+        self.__tails = [ [] for i in range(maxJobs) ]
 
         # disable cursor
         print("\x1b[?25l")
@@ -262,19 +280,34 @@ class ParallelTtyUI(BaseTUI):
     def __putFooter(self):
         print("\r\x1b[?7l\x1b[2K====== {}/{} jobs running "
                 .format(len(self.__jobs), self.__maxJobs), end="")
-        i = 0
-        while i < self.__maxJobs:
+        lines = 0
+        for i in range(self.__maxJobs):
             num = self.__slots[i]
             if num is not None:
                 print("\n\x1b[2K {:>4}  {}".format(num, self.__jobs[num]), end='')
             else:
                 print("\n\x1b[2K ****  <idle>", end='')
-            i += 1
-        print("\x1b[{}A".format(i), "\x1b[?7h\r", sep='', end='')
+            # Always reserve the lines of the tail so that the footer does not
+            # change its size.
+            tail = self.__tails[i]
+            for j in range(self.__showTail):
+                print("\n\x1b[2K", end='')
+                if j < len(tail): print("       |", tail[j], end='')
+            lines += 1 + self.__showTail
+        print("\x1b[{}A".format(lines), "\x1b[?7h\r", sep='', end='')
+
+    def _getTailLines(self):
+        return self.__showTail
+
+    def _setTail(self, slot, lines):
+        if not self.__showTail: return
+        self.__tails[slot] = [ sanitize(l) for l in lines[-self.__showTail:] ]
+        self.__putFooter()
 
     def _putResult(self, slot, msg):
         job = self.__slots[slot]
         self.__slots[slot] = None
+        self.__tails[slot] = []
         del self.__jobs[job]
         if msg:
             if isinstance(msg, list):
@@ -321,7 +354,7 @@ class ParallelTtyUI(BaseTUI):
         return ParallelTtyUIAction(self, job, slot, name, msg, ellipsis, showDetails)
 
     def cleanup(self):
-        for i in range(max(len(self.__jobs), self.__maxJobs)+1):
+        for i in range(self.__maxJobs * (1 + self.__showTail) + 1):
             print()
         print("\x1b[?25h")
         import termios
@@ -416,10 +449,12 @@ def stepMessage(step, action, message, kind, severity=-2):
     __tui.stepMessage(step, action, message, kind, severity)
 
 def stepAction(step, action, message, severity=-2, details=""):
-    return __tui.stepAction(step, action, message, severity, details)
+    return traceAction(step, action, "action",
+        __tui.stepAction(step, action, message, severity, details))
 
 def stepExec(step, action, message, severity=-2, details=""):
-    return __tui.stepExec(step, action, message, severity, details)
+    return traceAction(step, action, "exec",
+        __tui.stepExec(step, action, message, severity, details))
 
 def setVerbosity(verbosity):
     verbosity = max(ALWAYS, min(TRACE, verbosity))
@@ -431,10 +466,24 @@ def setTui(maxJobs):
     if maxJobs <= 1:
         __tui = SingleTUI(__tui.getVerbosity())
     elif __onTTY:
-        __tui = ParallelTtyUI(__tui.getVerbosity(), maxJobs)
+        __tui = ParallelTtyUI(__tui.getVerbosity(), maxJobs, __showTail)
     else:
         __tui = ParallelDumbUI(__tui.getVerbosity())
 
+def setShowTail(lines):
+    """Set number of output lines that are shown for running jobs.
+
+    Only the interactive user interface of parallel builds shows the output.
+    Must be called before setTui().
+    """
+    global __showTail
+    __showTail = lines
+
+def sanitize(line):
+    """Make output of a job safe to be printed on a single terminal line."""
+    return "".join(c for c in __escapeSequence.sub("", line).expandtabs()
+                   if c.isprintable())
+
 def cleanup():
     __tui.cleanup()
 
@@ -442,6 +491,8 @@ def cleanup():
 
 __onTTY = (sys.stdout.isatty() and sys.stderr.isatty())
 __useColor = False
+__showTail = 0
+__escapeSequence = re.compile(r"\x1b\[[0-9;?]*[A-Za-z]")
 __tui = SingleTUI(NORMAL)
 
 def setColorMode(mode):
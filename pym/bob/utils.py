@@ -6,7 +6,9 @@
 from .errors import BuildError, ParseError
 from binascii import hexlify
 from tempfile import NamedTemporaryFile
+import asyncio
 import collections
+import fnmatch
 import hashlib
 import logging
 import os
@@ -15,6 +17,11 @@ import stat
 import struct
 import sys
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 def hashString(string):
     h = hashlib.md5()
     h.update(string.encode("utf8"))
@@ -109,6 +116,26 @@ def isWindows():
         return False
     return True
 
+# The Task class methods were replaced by module level functions in Python 3.7
+# and were removed in 3.9.
+if hasattr(asyncio, "current_task"):
+    def currentTask():
+        """Return the currently running task or None."""
+        try:
+            return asyncio.current_task()
+        except RuntimeError:
+            return None
+
+    def allTasks(loop):
+        return asyncio.all_tasks(loop)
+else:
+    def currentTask():
+        """Return the currently running task or None."""
+        return asyncio.Task.current_task()
+
+    def allTasks(loop):
+        return asyncio.Task.all_tasks(loop)
+
 ### directory hashing ###
 
 def hashFile(path):
@@ -256,7 +283,8 @@ class DirHasher:
         def check(self, prefix, name, st, process):
             return process(os.path.join(prefix, name) if name else prefix)
 
-    def __init__(self, basePath=None, ignoreDirs=None):
+    def __init__(self, basePath=None, ignoreDirs=None, digests=None):
+        self.__digests = digests or {}
         if basePath:
             self.__index = DirHasher.FileIndex(basePath)
         else:
@@ -268,7 +296,9 @@ class DirHasher:
 
     def __hashEntry(self, prefix, entry, s):
         if stat.S_ISREG(s.st_mode):
-            digest = self.__index.check(prefix, entry, s, hashFile)
+            known = self.__digests.get(entry)
+            digest = self.__index.check(prefix, entry, s,
+                hashFile if known is None else (lambda path: known))
         elif stat.S_ISDIR(s.st_mode):
             digest = self.__hashDir(prefix, entry)
         elif stat.S_ISLNK(s.st_mode):
@@ -347,8 +377,14 @@ class DirHasher:
             self.__index.close()
 
 
-def hashDirectory(path, index=None, ignoreDirs=None):
-    return DirHasher(index, ignoreDirs).hashDirectory(path)
+def hashDirectory(path, index=None, ignoreDirs=None, digests=None):
+    """Hash a directory.
+
+    The optional ``digests`` dict holds already known SHA1 digests of files,
+    keyed by their relative path (bytes). They are used instead of reading
+    the files if the entries are not in the ``index`` yet.
+    """
+    return DirHasher(index, ignoreDirs, digests).hashDirectory(path)
 
 def hashPath(path, index=None, ignoreDirs=None):
     return DirHasher(index, ignoreDirs).hashPath(path)
@@ -416,6 +452,96 @@ def copyTree(src, dst):
 
     return ret
 
+# ioctl to share the data blocks of two files (btrfs, xfs)
+FICLONE = 0x40049409
+
+def __copyFileHashed(src, dst):
+    m = hashlib.sha1()
+    with open(src, "rb") as fsrc:
+        with open(dst, "wb") as fdst:
+            cloned = False
+            if fcntl is not None:
+                try:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                    cloned = True
+                except OSError:
+                    pass
+            buf = fsrc.read(0x100000)
+            while buf:
+                m.update(buf)
+                if not cloned: fdst.write(buf)
+                buf = fsrc.read(0x100000)
+    return m.digest()
+
+def __copyAttributes(src, dst, st):
+    if hasattr(os, "lchown"):
+        try:
+            os.lchown(dst, st.st_uid, st.st_gid)
+        except OSError:
+            pass # like 'cp -a' as regular user
+    shutil.copystat(src, dst, follow_symlinks=False)
+
+def copyFiles(src, dst, include=["*"], exclude=[]):
+    """Copy matching files from src to dst.
+
+    The relative path of every non-directory entry in ``src`` is matched
+    against the ``include`` and ``exclude`` glob patterns the same way as
+    ``find -path`` does, i.e. ``*`` matches ``/`` too. Missing directories are
+    created. File data is cloned if the file system supports it and copied
+    otherwise. Attributes are preserved like ``cp -a``.
+
+    Returns the SHA1 digests of all copied regular files, keyed by their
+    relative path as expected by :func:`hashDirectory`.
+    """
+    src = os.fsencode(src)
+    dst = os.fsencode(dst)
+    include = [ os.fsencode(i) for i in include ]
+    exclude = [ os.fsencode(e) for e in exclude ]
+    digests = {}
+    createdDirs = []
+
+    def makeParents(rel):
+        if not rel or os.path.isdir(os.path.join(dst, rel)): return
+        makeParents(os.path.dirname(rel))
+        os.mkdir(os.path.join(dst, rel))
+        createdDirs.append(rel)
+
+    def copy(rel):
+        srcPath = os.path.join(src, rel)
+        dstPath = os.path.join(dst, rel)
+        st = os.lstat(srcPath)
+        makeParents(os.path.dirname(rel))
+        if os.path.lexists(dstPath): os.unlink(dstPath)
+        if stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(srcPath), dstPath)
+        elif stat.S_ISREG(st.st_mode):
+            digests[rel] = __copyFileHashed(srcPath, dstPath)
+        else:
+            os.mknod(dstPath, st.st_mode, st.st_rdev)
+        __copyAttributes(srcPath, dstPath, st)
+
+    def walk(rel):
+        with os.scandir(os.path.join(src, rel) if rel else src) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        for entry in entries:
+            entryRel = os.path.join(rel, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                walk(entryRel)
+            elif any(fnmatch.fnmatchcase(entryRel, i) for i in include) and \
+                 not any(fnmatch.fnmatchcase(entryRel, e) for e in exclude):
+                copy(entryRel)
+
+    try:
+        walk(b"")
+        # Directory attributes last. Otherwise the mtime is changed again.
+        for rel in reversed(createdDirs):
+            srcPath = os.path.join(src, rel)
+            __copyAttributes(srcPath, os.path.join(dst, rel), os.lstat(srcPath))
+    except OSError as e:
+        raise BuildError("Cannot copy package files: " + str(e))
+
+    return digests
+
 
 def processDefines(defs):
     defines = {}
@@ -423,3 +549,34 @@ def processDefines(defs):
         key, _sep, value = define.partition('=')
         defines[key] = value
     return defines
+
+### output capture ###
+
+class OutputTail:
+    """Keep the tail of the output of a process.
+
+    The output is fed in arbitrary chunks. Only the last ``maxLines`` lines are
+    kept. Overlong lines are truncated to ``maxLineLength`` bytes. Hence the
+    memory usage is bounded regardless of the amount of output.
+    """
+
+    def __init__(self, maxLines, maxLineLength=4096):
+        self.__lines = collections.deque(maxlen=maxLines)
+        self.__partial = b""
+        self.__maxLineLength = maxLineLength
+
+    def feed(self, data):
+        lines = (self.__partial + data).split(b"\n")
+        self.__partial = lines.pop()[:self.__maxLineLength]
+        for l in lines[-self.__lines.maxlen:]:
+            self.__lines.append(l[:self.__maxLineLength])
+
+    def getLines(self, num=None):
+        lines = list(self.__lines)
+        if self.__partial: lines.append(self.__partial)
+        num = self.__lines.maxlen if num is None else min(num, self.__lines.maxlen)
+        lines = lines[-num:] if num else []
+        return [ l.decode("utf8", errors="replace") for l in lines ]
+
+    def getText(self):
+        return "\n".join(self.getLines()).strip()
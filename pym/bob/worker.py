@@ -0,0 +1,466 @@
+# Bob build tool
+# Copyright (C) 2018  TechniSat Digital GmbH
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Remote execution of build steps.
+
+A worker executes the build and package step of packages on behalf of a
+client. All inputs of a job are exchanged through the binary archive that is
+shared by the client and the worker. The client makes sure that the inputs are
+available in the archive and sends the job description to the worker. The
+worker downloads the inputs by their build-id, executes the steps, uploads the
+result and reports back. The client finally downloads the result from the
+archive.
+
+The client and the worker exchange a single JSON encoded line each over a
+stream socket. The client sends the request and the worker answers with the
+outcome of the job. If the worker was started with a token, the request must
+carry the same token. Otherwise the worker only listens on Unix domain sockets
+that are only accessible by the user running the worker.
+
+Scripts are generated by the client. Because the worker executes the job in a
+different directory the scripts refer to the project root, the system PATH and
+the sandbox helper by environment variables. They are set by the worker to
+their counterparts on the worker.
+"""
+
+from .archive import getArchiver
+from .audit import Audit
+from .errors import BuildError
+from .tty import log, setTui, setVerbosity, stepExec, stepMessage, \
+    EXECUTED, INFO, WARNING, NORMAL, IMPORTANT
+from .utils import hashDirectory, removePath
+import argparse
+import asyncio
+import concurrent.futures
+import hmac
+import io
+import json
+import multiprocessing
+import os
+import signal
+import stat
+import subprocess
+import tempfile
+
+PROTOCOL_VERSION = 1
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+MAX_LOG_SIZE = 64 * 1024
+DEFAULT_TIMEOUT = 4 * 60 * 60
+
+# Environment variables that relocate the scripts on the worker
+BASE_VAR = "BOB_WORKER_BASE"
+PATH_VAR = "BOB_WORKER_PATH"
+SANDBOX_VAR = "BOB_WORKER_SANDBOX"
+
+def dummy():
+    pass
+
+def parseAddress(address):
+    """Parse a worker address.
+
+    Workers are either reachable by a Unix domain socket ("unix:PATH") or by
+    TCP ("HOST:PORT").
+    """
+    if address.startswith("unix:"):
+        path = address[5:]
+        if path: return ("unix", path)
+    else:
+        (host, sep, port) = address.rpartition(":")
+        if sep and host and port.isdigit():
+            return ("tcp", (host.strip("[]"), int(port)))
+    raise BuildError("Invalid worker address: " + address,
+        help="Use 'unix:PATH' or 'HOST:PORT'.")
+
+def readToken(fileName):
+    """Read the shared secret of the clients and workers from a file."""
+    try:
+        with open(fileName, "r") as f:
+            token = f.read().strip()
+    except OSError as e:
+        raise BuildError("Cannot read worker token: " + str(e))
+    if not token:
+        raise BuildError("Worker token file '{}' is empty".format(fileName))
+    return token
+
+def jobPath(jobDir, path):
+    """Get the location of a workspace of a job.
+
+    The workspace paths are sent by the client. They must be relative and must
+    not leave the job directory.
+    """
+    if not isinstance(path, str) or not path or os.path.isabs(path) or \
+       (os.path.normpath(path) != path) or (path == "..") or path.startswith("../"):
+        raise BuildError("Invalid workspace path in job: " + str(path))
+    return os.path.join(jobDir, path)
+
+class WorkerUnavailableError(Exception):
+    pass
+
+class WorkerTimeoutError(WorkerUnavailableError):
+    pass
+
+class ScriptError(BuildError):
+    def __init__(self, slogan, log):
+        super().__init__(slogan)
+        self.log = log
+
+class WorkerPool:
+    """Dispatches jobs to a set of workers.
+
+    Every job is sent to the worker with the least number of jobs that are
+    currently in flight. Workers that cannot be reached are not used anymore.
+    """
+
+    def __init__(self, addresses, token=None, timeout=DEFAULT_TIMEOUT):
+        self.__workers = { a : (parseAddress(a), 0) for a in addresses }
+        self.__unreachable = set()
+        self.__token = token
+        self.__timeout = timeout
+
+    def __bool__(self):
+        return len(self.__workers) > len(self.__unreachable)
+
+    async def __connect(self, address):
+        (kind, location) = self.__workers[address][0]
+        if kind == "unix":
+            return await asyncio.open_unix_connection(location, limit=MAX_MESSAGE_SIZE)
+        else:
+            return await asyncio.open_connection(*location, limit=MAX_MESSAGE_SIZE)
+
+    async def connect(self, step):
+        """Connect to the worker with the least number of jobs in flight.
+
+        Raises WorkerUnavailableError if no worker could be reached.
+        """
+        while True:
+            candidates = sorted((load, address)
+                for (address, (location, load)) in self.__workers.items()
+                if address not in self.__unreachable)
+            if not candidates:
+                raise WorkerUnavailableError()
+            address = candidates[0][1]
+            try:
+                (reader, writer) = await self.__connect(address)
+                break
+            except OSError as e:
+                stepMessage(step, "REMOTE", "worker {} unreachable: {}".format(address, str(e)),
+                    WARNING, IMPORTANT)
+                self.__unreachable.add(address)
+
+        (location, load) = self.__workers[address]
+        self.__workers[address] = (location, load+1)
+        return WorkerConnection(self, address, reader, writer, self.__token,
+                                self.__timeout)
+
+    def _release(self, address):
+        (location, load) = self.__workers[address]
+        self.__workers[address] = (location, load-1)
+
+class WorkerConnection:
+    def __init__(self, pool, address, reader, writer, token, timeout):
+        self.__pool = pool
+        self.__address = address
+        self.__reader = reader
+        self.__writer = writer
+        self.__token = token
+        self.__timeout = timeout
+
+    def getAddress(self):
+        return self.__address
+
+    async def run(self, job):
+        """Run job on the worker and return its answer.
+
+        The connection is closed afterwards. Raises WorkerTimeoutError if the
+        worker does not answer in time.
+        """
+        request = { "version" : PROTOCOL_VERSION, "job" : job }
+        if self.__token is not None:
+            request["token"] = self.__token
+        try:
+            self.__writer.write(json.dumps(request).encode("utf8") + b"\n")
+            await self.__writer.drain()
+            try:
+                answer = await asyncio.wait_for(self.__reader.readline(),
+                                                self.__timeout)
+            except asyncio.TimeoutError:
+                raise WorkerTimeoutError()
+            if not answer:
+                raise BuildError("Worker {} closed the connection unexpectedly"
+                                    .format(self.__address))
+            return json.loads(answer.decode("utf8"))
+        except (OSError, ValueError) as e:
+            raise BuildError("Communication with worker {} failed: {}"
+                                .format(self.__address, str(e)))
+        finally:
+            self.__writer.close()
+            self.__pool._release(self.__address)
+
+class JobRecipes:
+    """Stand-in of the RecipeSet to create the archive of a job."""
+
+    def __init__(self, job):
+        self.__archiveSpec = job["archive"]
+        self.__whiteList = set(job["whitelist"])
+
+    def archiveSpec(self):
+        return self.__archiveSpec
+
+    def archiveCache(self):
+        return None
+
+    def archiveStrategy(self):
+        return {}
+
+    def envWhiteList(self):
+        return set(self.__whiteList)
+
+    def getPolicy(self, name, location=None):
+        # The client resolves all policies that are relevant for the archive
+        # into the archive spec.
+        return True
+
+class JobStep:
+    """Stand-in of a step of a job.
+
+    Provides just enough of the Step and Package interface for the archive and
+    the user interface.
+    """
+
+    def __init__(self, stack, workspace):
+        self.__stack = stack
+        self.__workspace = workspace
+
+    def getPackage(self):
+        return self
+
+    def getName(self):
+        return self.__stack[-1]
+
+    def getStack(self):
+        return self.__stack
+
+    def getWorkspacePath(self):
+        return self.__workspace
+
+class Worker:
+    def __init__(self, bobRoot, jobs, keep, token=None):
+        self.__bobRoot = bobRoot
+        self.__jobs = asyncio.Semaphore(jobs)
+        self.__keep = keep
+        self.__token = token
+
+    async def serve(self, address):
+        (kind, location) = parseAddress(address)
+        if (self.__token is None) and (kind != "unix"):
+            raise BuildError("Refusing to listen on {} without token".format(address),
+                help="Use --token-file or listen on a Unix domain socket.")
+        try:
+            if kind == "unix":
+                if os.path.exists(location): os.unlink(location)
+                # The socket must never be accessible by other users
+                oldMask = os.umask(0o077)
+                try:
+                    return await asyncio.start_unix_server(self.__handle, location,
+                        limit=MAX_MESSAGE_SIZE)
+                finally:
+                    os.umask(oldMask)
+            else:
+                return await asyncio.start_server(self.__handle, *location,
+                    limit=MAX_MESSAGE_SIZE)
+        except OSError as e:
+            raise BuildError("Cannot listen on {}: {}".format(address, str(e)))
+
+    async def __handle(self, reader, writer):
+        try:
+            try:
+                request = json.loads((await reader.readline()).decode("utf8"))
+                if not self.__authenticate(request.get("token")):
+                    answer = { "status" : "error",
+                               "message" : "Authentication failed" }
+                elif request.get("version") != PROTOCOL_VERSION:
+                    answer = { "status" : "error",
+                               "message" : "Unsupported protocol version" }
+                else:
+                    async with self.__jobs:
+                        answer = await self.__runJob(request["job"])
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                answer = { "status" : "error", "message" : "Invalid request: " + str(e) }
+            writer.write(json.dumps(answer).encode("utf8") + b"\n")
+            await writer.drain()
+        except OSError as e:
+            log("Lost connection to client: " + str(e), WARNING)
+        finally:
+            writer.close()
+
+    def __authenticate(self, token):
+        if self.__token is None: return True
+        if not isinstance(token, str): return False
+        return hmac.compare_digest(token.encode("utf8"), self.__token.encode("utf8"))
+
+    async def __runJob(self, job):
+        jobDir = tempfile.mkdtemp(prefix="bob-worker-")
+        try:
+            return await self.__executeJob(job, jobDir)
+        except ScriptError as e:
+            return { "status" : "failed", "message" : e.slogan, "log" : e.log }
+        except BuildError as e:
+            return { "status" : "failed", "message" : e.slogan, "log" : "" }
+        except OSError as e:
+            return { "status" : "failed", "message" : "Job failed: " + str(e), "log" : "" }
+        finally:
+            if self.__keep:
+                log("Keeping job directory " + jobDir, INFO)
+            else:
+                removePath(jobDir)
+
+    async def __executeJob(self, job, jobDir):
+        archive = getArchiver(JobRecipes(job))
+        archive.wantDownload(True)
+        archive.wantUpload(True)
+        if not archive.canDownloadLocal() or not archive.canUploadLocal():
+            raise BuildError("Archive must be usable for downloads and uploads")
+
+        # fetch inputs
+        for i in job["inputs"]:
+            workspace = jobPath(jobDir, i["workspace"])
+            os.makedirs(workspace)
+            download = archive.downloadSources if i["sources"] else archive.downloadPackage
+            if not await download(JobStep(i["package"], i["workspace"]),
+                    bytes.fromhex(i["buildId"]),
+                    os.path.join(workspace, "..", "audit.json.gz"), workspace):
+                raise BuildError("Input {} not found in archive".format(i["workspace"]))
+
+        # execute steps
+        for s in job["steps"]:
+            if s["name"] not in ("build", "package"):
+                raise BuildError("Invalid step in job: " + str(s["name"]))
+            step = JobStep(s["package"], s["workspace"])
+            workspace = jobPath(jobDir, s["workspace"])
+            os.makedirs(workspace, exist_ok=True)
+            runFile = os.path.join(workspace, "..", s["name"] + ".sh")
+            with open(runFile, "w") as f:
+                f.write(s["runScript"])
+            os.chmod(runFile, stat.S_IRWXU | stat.S_IRGRP | stat.S_IROTH)
+            with open(os.path.join(workspace, "..", "script"), "w") as f:
+                f.write(s["script"])
+            if job["preserveEnv"]:
+                runEnv = os.environ.copy()
+            else:
+                runEnv = { k:v for (k,v) in os.environ.items()
+                                         if k in job["whitelist"] }
+            runEnv[BASE_VAR] = jobDir
+            runEnv[PATH_VAR] = os.environ["PATH"]
+            runEnv[SANDBOX_VAR] = self.__getSandboxHelper()
+
+            with stepExec(step, s["name"].upper(), s["workspace"]):
+                await self.__runScript(["/bin/bash", os.path.join("..", s["name"] + ".sh"),
+                    "__run", "-n", "-v"], workspace, runEnv)
+            resultHash = await asyncio.get_event_loop().run_in_executor(None,
+                hashDirectory, workspace)
+            self.__saveAudit(s, jobDir, resultHash)
+
+        # publish result
+        result = job["result"]
+        workspace = jobPath(jobDir, result["workspace"])
+        await archive.uploadPackage(JobStep(result["package"], result["workspace"]),
+            bytes.fromhex(result["buildId"]),
+            os.path.join(workspace, "..", "audit.json.gz"), workspace)
+        return { "status" : "ok" }
+
+    def __getSandboxHelper(self):
+        return os.path.join(self.__bobRoot, "bin", "namespace-sandbox")
+
+    async def __runScript(self, cmdLine, cwd, env):
+        with tempfile.TemporaryFile() as tmp:
+            try:
+                proc = await asyncio.create_subprocess_exec(*cmdLine, cwd=cwd, env=env,
+                    stdin=subprocess.DEVNULL, stdout=tmp, stderr=subprocess.STDOUT)
+                ret = await proc.wait()
+            except OSError as e:
+                raise BuildError("Cannot execute build script: " + str(e))
+            if ret != 0:
+                size = tmp.seek(0, io.SEEK_END)
+                tmp.seek(max(0, size - MAX_LOG_SIZE))
+                raise ScriptError("Build script returned with {}".format(ret),
+                    tmp.read().decode("utf8", errors="replace").strip())
+
+    def __saveAudit(self, s, jobDir, resultHash):
+        workspace = jobPath(jobDir, s["workspace"])
+        audit = Audit.create(bytes.fromhex(s["variantId"]),
+            bytes.fromhex(s["buildId"]), resultHash)
+        for (name, value) in s["defines"].items():
+            audit.addDefine(name, value)
+        for (var, val) in s["metaEnv"].items():
+            audit.addMetaEnv(var, val)
+        if s["recipes"] is not None:
+            audit.setRecipesData(s["recipes"])
+        audit.setEnv(os.path.join(workspace, "..", "env"))
+        for (name, tool) in sorted(s["tools"].items()):
+            audit.addTool(name, os.path.join(jobPath(jobDir, tool), "..", "audit.json.gz"))
+        if s["sandbox"] is not None:
+            audit.setSandbox(os.path.join(jobPath(jobDir, s["sandbox"]), "..", "audit.json.gz"))
+        for arg in s["args"]:
+            audit.addArg(os.path.join(jobPath(jobDir, arg), "..", "audit.json.gz"))
+        audit.save(os.path.join(workspace, "..", "audit.json.gz"))
+
+def doWorker(argv, bobRoot):
+    parser = argparse.ArgumentParser(prog="bob worker",
+        description="Execute build steps on behalf of other Bob instances.")
+    parser.add_argument('address', metavar='ADDRESS', nargs='+',
+        help="Listen address (unix:PATH or HOST:PORT)")
+    parser.add_argument('-j', '--jobs', default=1, type=int, nargs='?', const=...,
+        help="Specifies the number of jobs to run simultaneously.")
+    parser.add_argument('--keep', default=False, action='store_true',
+        help="Keep job directories")
+    parser.add_argument('--token-file', metavar="FILE",
+        help="Require clients to send the token that is stored in FILE")
+    parser.add_argument('-q', '--quiet', default=0, action='count',
+        help="Decrease verbosity (may be specified multiple times)")
+    parser.add_argument('-v', '--verbose', default=0, action='count',
+        help="Increase verbosity (may be specified multiple times)")
+    args = parser.parse_args(argv)
+
+    if args.jobs is ...:
+        args.jobs = os.cpu_count()
+    elif args.jobs <= 0:
+        parser.error("--jobs argument must be greater than zero!")
+
+    # See commonBuildDevelop() for the rationale of this setup
+    loop = asyncio.get_event_loop()
+    origSigInt = signal.getsignal(signal.SIGINT)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    multiprocessing.set_start_method('forkserver')
+    executor = concurrent.futures.ProcessPoolExecutor()
+    executor.submit(dummy).result()
+    signal.signal(signal.SIGINT, origSigInt)
+    loop.set_default_executor(executor)
+
+    servers = []
+    sockets = []
+    try:
+        setVerbosity(args.verbose - args.quiet)
+        setTui(args.jobs)
+        token = readToken(args.token_file) if args.token_file else None
+        worker = Worker(bobRoot, args.jobs, args.keep, token)
+        for address in args.address:
+            servers.append(loop.run_until_complete(worker.serve(address)))
+            (kind, location) = parseAddress(address)
+            if kind == "unix": sockets.append(location)
+            log("Listening on " + address, EXECUTED, NORMAL)
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+    finally:
+        for server in servers:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+        for location in sockets:
+            if os.path.exists(location): os.unlink(location)
+        setTui(1)
+        executor.shutdown()
+        loop.close()
@@ -0,0 +1,53 @@
+#!/bin/bash -e
+. ../test-lib.sh 2>/dev/null || { echo "Must run in script directory!" ; exit 1 ; }
+cleanup
+
+ARCHIVE="$(mktemp -d)"
+trap 'rm -rf "$ARCHIVE" default.yaml' EXIT
+
+cat >default.yaml <<EOF2
+archive:
+    backend: file
+    path: "$ARCHIVE"
+EOF2
+
+# A plan of a fresh project must not do anything
+PLAN="$(run_bob build --plan root)"
+[[ ! -e work ]]
+grep -q "Plan: 2 checkouts, 4 builds, 0 downloads, 0 skipped" <<<"$PLAN"
+
+# Build and upload. Afterwards everything is up-to-date.
+run_bob build --upload root
+PLAN="$(run_bob build --plan root)"
+grep -q "Plan: 0 checkouts, 0 builds, 0 downloads, 6 skipped" <<<"$PLAN"
+
+# The step durations of the build are recorded. Forced steps have an estimate.
+PLAN="$(run_bob build -f --plan root)"
+grep -q "Plan: 2 checkouts, 4 builds, 0 downloads, 0 skipped" <<<"$PLAN"
+grep -q "^Estimated duration: [0-9:]* (sequential)$" <<<"$PLAN"
+
+# Without workspace the result of root is downloaded. Nothing else is needed.
+rm -rf work
+PLAN="$(run_bob build --download=yes --plan root)"
+[[ ! -e work ]]
+grep -q "Plan: 0 checkouts, 0 builds, 1 downloads, 0 skipped" <<<"$PLAN"
+
+# Downloading only the dependencies requires to build root
+PLAN="$(run_bob build --download=deps --plan root)"
+grep -q "Plan: 1 checkouts, 2 builds, 1 downloads, 0 skipped" <<<"$PLAN"
+
+# With a manifest the artifacts are looked up there. Artifacts that are not
+# listed are considered missing.
+cat >default.yaml <<EOF2
+archive:
+    backend: file
+    path: "$ARCHIVE"
+    manifest: True
+EOF2
+( cd "$ARCHIVE" && run_bob archive manifest )
+[[ -e "$ARCHIVE/MANIFEST" ]]
+PLAN="$(run_bob build --download=yes --plan root)"
+grep -q "Plan: 0 checkouts, 0 builds, 1 downloads, 0 skipped" <<<"$PLAN"
+: > "$ARCHIVE/MANIFEST"
+PLAN="$(run_bob build --download=yes --plan root)"
+grep -q "Plan: 2 checkouts, 4 builds, 0 downloads, 0 skipped" <<<"$PLAN"
@@ -0,0 +1,78 @@
+#!/bin/bash -e
+. ../test-lib.sh 2>/dev/null || { echo "Must run in script directory!" ; exit 1 ; }
+cleanup
+
+REPO="$(mktemp -d)"
+trap 'rm -rf "$REPO" default.yaml' EXIT
+export BUILD_LOG="$REPO/build.log"
+
+# create empty git repo and archive
+pushd "$REPO"
+git init --bare test.git
+mkdir archive
+popd
+
+# fill git repo
+D="$(mktemp -d)"
+pushd "$D"
+git init .
+echo "first" > first.txt
+git add first.txt
+git commit -m '1st commit'
+git remote add origin "$REPO/test.git"
+git push origin HEAD
+popd
+rm -rf "$D"
+
+cat >default.yaml <<EOF2
+whitelist: [APPLY_CHANGE, BUILD_LOG, FAIL_OTHER]
+archive:
+    backend: file
+    path: "$REPO/archive"
+EOF2
+
+prepare()
+{
+	rm -rf work "$REPO"/archive/*
+
+	# Upload "common" and "right". This records the live-build-id
+	# prediction of the "common" sources.
+	run_bob build -DREPO="$REPO" --download=yes --upload root/right/common
+	A=( "$REPO"/archive/*/*/*.tgz )
+	[[ ${#A[@]} -eq 1 ]]
+	run_bob build -DREPO="$REPO" --download=yes --upload root/right
+
+	# Remove workspace and the "common" artifact so that it is checked out
+	# again.
+	rm -rf work "$BUILD_LOG"* "${A[0]}"
+}
+
+# Build again in parallel. The sources of "common" are changed during the
+# checkout while "other" is still being built.
+prepare
+APPLY_CHANGE=second run_bob build -DREPO="$REPO" --download=yes -j4 root
+
+# The packages depending on "common" are built with the new sources. The
+# "other" package is not affected and is built only once.
+diff -u <(sort "$BUILD_LOG") <(printf '%s\n' common left other right root)
+RES=$(run_bob query-path --release -f '{dist}' -DREPO="$REPO" root)
+diff -u <(cat "$RES"/left/*.txt) <(echo first ; echo second)
+diff -u <(cat "$RES"/right/*.txt) <(echo first ; echo second)
+[[ -e $RES/other/other.txt ]]
+
+# Same again but "other" fails. The tree is still walked again with
+# '--keep-going'. All packages that depend on the changed sources are built.
+# The root package is not.
+prepare
+APPLY_CHANGE=third FAIL_OTHER=1 expect_fail \
+	run_bob build -DREPO="$REPO" --download=yes -j4 -k root
+diff -u <(sort "$BUILD_LOG") <(printf '%s\n' common left other right)
+
+# The next build only builds the remaining packages
+rm "$BUILD_LOG"
+run_bob build -DREPO="$REPO" --download=yes -j4 root
+diff -u <(sort "$BUILD_LOG") <(printf '%s\n' other root)
+RES=$(run_bob query-path --release -f '{dist}' -DREPO="$REPO" root)
+diff -u <(cat "$RES"/left/*.txt) <(echo first ; echo second ; echo third)
+diff -u <(cat "$RES"/right/*.txt) <(echo first ; echo second ; echo third)
+[[ -e $RES/other/other.txt ]]
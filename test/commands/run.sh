@@ -13,7 +13,7 @@ for cmd, (hl, func, help) in sorted(availableCommands.items()):
 
 for c in $cmds; do
 	case "$c" in
-		archive | jenkins | help | _*)
+		archive | jenkins | help | worker | _*)
 			;;
         clean)
 			run_bob $c -DBAR=1 -c testconfig
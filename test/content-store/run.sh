@@ -0,0 +1,45 @@
+#!/bin/bash -e
+. ../test-lib.sh 2>/dev/null || { echo "Must run in script directory!" ; exit 1 ; }
+cleanup
+
+TMP="$(mktemp -d)"
+trap 'rm -rf "$TMP" default.yaml' EXIT
+
+cat >default.yaml <<EOF2
+archive:
+    backend: file
+    path: "$TMP/archive"
+contentStore: "$TMP/store"
+EOF2
+
+# Uploaded packages are put into the store. The files are copied so that
+# the workspace stays writable.
+run_bob build --upload root
+[[ -d "$TMP/store" ]]
+[[ $(stat -c %h work/root/dist/1/workspace/root.txt) -eq 1 ]]
+[[ -w work/root/dist/1/workspace/root.txt ]]
+
+# A develop build links the results from the store instead of downloading
+run_bob dev --download=yes root | tee "$TMP/log"
+grep -q "LINK" "$TMP/log"
+[[ $(stat -c %h dev/dist/root/1/workspace/root.txt) -eq 2 ]]
+[[ $(cat dev/dist/root/1/workspace/lib.txt) == lib ]]
+
+# Files in the store are write protected
+[[ -z "$(find dev/dist/root/1/workspace -type f -perm /222)" ]]
+
+# Rebuilding the workspace drops the reference
+[[ -e dev/dist/root/1/content-store ]]
+run_bob dev --download=no -f root
+[[ ! -e dev/dist/root/1/content-store ]]
+run_bob dev --download=yes -f root
+[[ -e dev/dist/root/1/content-store ]]
+
+# Used entries are kept
+run_bob clean
+[[ -n "$(find "$TMP/store" -name root.txt)" ]]
+
+# Once the workspaces are gone the entries are removed
+rm -rf work dev
+run_bob clean
+[[ -z "$(find "$TMP/store" -name root.txt)" ]]
@@ -0,0 +1,37 @@
+#!/bin/bash -e
+. ../test-lib.sh 2>/dev/null || { echo "Must run in script directory!" ; exit 1 ; }
+cleanup
+
+OUT="$(mktemp -d)"
+trap 'rm -rf "$OUT"' EXIT
+
+# Regular build. Stdout of the scripts goes only to the log file.
+run_bob dev --direct-launch root >"$OUT/stdout" 2>"$OUT/stderr"
+[[ $(cat dev/dist/root/1/workspace/root.txt) == root ]]
+[[ $(cat dev/dist/root/1/workspace/lib.txt) == lib ]]
+grep -q "build-stderr" "$OUT/stderr"
+! grep -q "build-stdout" "$OUT/stdout"
+grep -q "^### START: " dev/build/root/1/log.txt
+grep -q "^build-stdout$" dev/build/root/1/log.txt
+grep -q "^build-stderr$" dev/build/root/1/log.txt
+grep -q "^### END(0): " dev/build/root/1/log.txt
+
+# The run file is still generated and can be used manually
+rm dev/build/root/1/workspace/*.txt
+dev/build/root/1/build.sh -q
+[[ $(cat dev/build/root/1/workspace/root.txt) == root ]]
+
+# Stdout is shown in verbose mode
+run_bob dev --direct-launch -f -v root >"$OUT/stdout" 2>"$OUT/stderr"
+grep -q "build-stdout" "$OUT/stdout"
+grep -q "build-stderr" "$OUT/stderr"
+
+# Nothing is shown in quiet mode if there is a log file
+run_bob dev --direct-launch -f -q root >"$OUT/stdout" 2>"$OUT/stderr"
+! grep -q "build-" "$OUT/stdout" "$OUT/stderr"
+
+# Parallel build without log files
+cleanup
+run_bob dev --direct-launch --no-logfiles -j 2 root
+[[ $(cat dev/dist/root/1/workspace/lib.txt) == lib ]]
+[[ ! -e dev/build/root/1/log.txt ]]
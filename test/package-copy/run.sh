@@ -0,0 +1,22 @@
+#!/bin/bash -e
+. ../test-lib.sh 2>/dev/null || { echo "Must run in script directory!" ; exit 1 ; }
+cleanup
+
+REF="$(mktemp -d)"
+trap 'rm -rf "$REF"' EXIT
+
+# The package step is executed natively
+run_bob dev root
+D=dev/dist/root/1/workspace
+[[ $(cat $D/bin/tool) == tool ]]
+[[ -x $D/bin/tool ]]
+[[ $(readlink $D/lib/libfoo.so) == libfoo.so.1 ]]
+[[ ! -e $D/lib/libfoo.a ]]
+[[ ! -e $D/share ]]
+[[ ! -e $D/foo.o ]]
+
+# The generated script yields the same result
+cp -a dev/dist/root/1 "$REF/dist"
+rm -rf "$REF/dist/workspace"/*
+( cd "$REF/dist/workspace" && /bin/bash ../script "$OLDPWD/dev/build/root/1/workspace" )
+diff -r --no-dereference "$D" "$REF/dist/workspace"
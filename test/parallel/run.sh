@@ -1,8 +1,57 @@
 #!/bin/bash -e
 . ../test-lib.sh 2>/dev/null || { echo "Must run in script directory!" ; exit 1 ; }
 cleanup
+TMP="$(mktemp -d)"
+trap 'rm -rf trace.json output.txt "$TMP"' EXIT
+BUILD_LOG="$TMP/build.log"
 
-run_bob dev root -j4 -k
+run_bob dev root -j4 -k --trace trace.json
+
+# Every job slot is one lane in the trace
+python3 - <<EOF
+import json
+with open("trace.json") as f:
+    events = json.load(f)["traceEvents"]
+lanes = { e["tid"] for e in events if e["ph"] != "M" }
+assert lanes and lanes <= set(range(4)), lanes
+EOF
 
 expect_fail run_bob dev root -j4 -k -DFAIL_LIB1=1
 expect_fail run_bob dev root -j4 -k -DFAIL_LIB1=1 -DFAIL_LIB2=1
+
+# Only the tail of the output is shown. The error points to the complete log.
+if run_bob dev root -j4 -k -DFAIL_LIB1=1 --compress-logfiles > output.txt 2>&1 ; then
+	exit 1
+fi
+LOG=$(sed -n -e 's/.*Complete log: \(.*log\.txt\.gz\)$/\1/p' output.txt)
+[[ -n $LOG && -e $LOG ]]
+
+# Without '--keep-going' nothing is started after the failure. The dependents
+# of the failed and of the still running steps are never built.
+cleanup
+expect_fail run_bob dev root -j4 -DFAIL_LIB1=1 -DSLOW_LIB2=2 -DBUILD_LOG="$BUILD_LOG"
+[[ ! -e $BUILD_LOG ]] || ! grep -q -e lib3 -e root "$BUILD_LOG"
+
+# With '--keep-going' all steps that do not depend on the failed step are
+# built. The root package is not.
+cleanup ; rm -f "$BUILD_LOG"*
+expect_fail run_bob dev root -j4 -k -DFAIL_LIB1=1 -DSLOW_LIB2=2 -DBUILD_LOG="$BUILD_LOG"
+diff -u <(sort "$BUILD_LOG") <(printf '%s\n' lib2 lib3)
+
+# Ctrl+C cancels all running steps. Start bob in its own process group with
+# SIGINT enabled, like in a terminal, and interrupt it while lib2 is running.
+cleanup ; rm -f "$BUILD_LOG"*
+python3 -c 'import os, signal, sys; signal.signal(signal.SIGINT, signal.SIG_DFL); os.setsid(); os.execvp(sys.argv[1], sys.argv[1:])' \
+	${RUN:-python3} "$BOB_ROOT/bob" --debug=pkgck,ngd dev root -j4 -DSLOW_LIB2=30 \
+	-DBUILD_LOG="$BUILD_LOG" > output.txt 2>&1 &
+BOB=$!
+for i in $(seq 100) ; do
+	[[ -e $BUILD_LOG.lib2 ]] && break
+	sleep 0.1
+done
+kill -INT -- -$BOB
+RET=0
+wait $BOB || RET=$?
+[[ $RET -ne 0 ]]
+grep -q "Canceled by user" output.txt
+! grep -q -e lib2 -e lib3 -e root "$BUILD_LOG"
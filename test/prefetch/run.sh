@@ -0,0 +1,48 @@
+#!/bin/bash -e
+. ../test-lib.sh 2>/dev/null || { echo "Must run in script directory!" ; exit 1 ; }
+cleanup
+
+REPO="$(mktemp -d)"
+trap 'rm -rf "$REPO" default.yaml output.txt' EXIT
+
+# create git repo with the sources of "common"
+git init --bare "$REPO/test.git"
+D="$(mktemp -d)"
+pushd "$D"
+git init .
+echo "first" > first.txt
+git add first.txt
+git commit -m '1st commit'
+git remote add origin "$REPO/test.git"
+git push origin HEAD
+popd
+rm -rf "$D"
+
+cat >default.yaml <<EOF2
+archive:
+    backend: file
+    path: "$REPO/archive"
+EOF2
+
+# Upload the libraries. The root package is not uploaded.
+run_bob build -DREPO="$REPO" --upload root/lib1 root/lib2
+rm -rf work
+
+# The libraries are prefetched in parallel. The build-id of "common" is
+# predicted only once and the prefetched artifacts are not downloaded again.
+run_bob build -DREPO="$REPO" --download=yes -j4 root | tee output.txt
+[[ $(grep -c "Start.*QUERY.*common" output.txt) -eq 1 ]]
+[[ $(grep -c "Start.*DOWNLOAD.*lib1" output.txt) -eq 1 ]]
+[[ $(grep -c "Start.*DOWNLOAD.*lib2" output.txt) -eq 1 ]]
+! grep -q "CHECKOUT.*common" output.txt
+! grep -q "BUILD.*lib" output.txt
+
+RES=$(run_bob query-path --release -f '{dist}' -DREPO="$REPO" root)
+diff -u <(cat "$RES"/lib1/*.txt "$RES"/lib2/*.txt) <(echo first ; echo first)
+
+# Both libraries are prefetched concurrently. They need the same prediction.
+rm -rf work
+run_bob build -DREPO="$REPO" --download=yes -j4 root/lib1 root/lib2 | tee output.txt
+[[ $(grep -c "Start.*QUERY.*common" output.txt) -eq 1 ]]
+[[ $(grep -c "Start.*DOWNLOAD.*lib1" output.txt) -eq 1 ]]
+[[ $(grep -c "Start.*DOWNLOAD.*lib2" output.txt) -eq 1 ]]
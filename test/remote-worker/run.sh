@@ -0,0 +1,62 @@
+#!/bin/bash -e
+. ../test-lib.sh 2>/dev/null || { echo "Must run in script directory!" ; exit 1 ; }
+cleanup
+
+TMP="$(mktemp -d)"
+WORKER=
+trap '[[ -z $WORKER ]] || { kill $WORKER ; wait $WORKER ; } ; rm -rf "$TMP" default.yaml' EXIT
+
+cat >default.yaml <<EOF2
+archive:
+    backend: file
+    path: "$TMP/archive"
+EOF2
+
+# start worker and wait until it is ready
+${RUN:-python3} "$BOB_ROOT/bob" worker "unix:$TMP/worker.sock" > "$TMP/worker.log" 2>&1 &
+WORKER=$!
+for i in $(seq 50) ; do
+	[[ -S "$TMP/worker.sock" ]] && break
+	sleep 0.1
+done
+
+# The packages are built by the worker. Only the sources are checked out
+# locally.
+run_bob build --upload --worker "unix:$TMP/worker.sock" root
+RES=$(run_bob query-path -f '{dist}' --release root)
+diff -u <(cat "$RES"/*.txt) <(echo lib ; echo root)
+[[ ! -e work/root/build/1/workspace/root.txt ]]
+grep -q "BUILD.*root" "$TMP/worker.log"
+
+# Checkouts are only stored as sources, not as binary artifacts
+[[ $(find "$TMP/archive" -name '*.sources' | wc -l) -eq 2 ]]
+[[ $(find "$TMP/archive" -name '*.tgz' | wc -l) -eq 2 ]]
+
+# A second build must not do anything
+run_bob build --upload --worker "unix:$TMP/worker.sock" root | grep -q "0 packages built"
+
+# Fall back to local builds if no worker can be reached
+cleanup
+rm -rf "$TMP/archive"
+run_bob build --upload --worker "unix:$TMP/missing.sock" root
+RES=$(run_bob query-path -f '{dist}' --release root)
+diff -u <(cat "$RES"/*.txt) <(echo lib ; echo root)
+[[ -e work/root/build/1/workspace/root.txt ]]
+
+# A worker with token only accepts clients that present the same token
+kill $WORKER ; wait $WORKER || true
+echo secret > "$TMP/token"
+${RUN:-python3} "$BOB_ROOT/bob" worker --token-file "$TMP/token" "unix:$TMP/worker.sock" > "$TMP/worker.log" 2>&1 &
+WORKER=$!
+for i in $(seq 50) ; do
+	[[ -S "$TMP/worker.sock" ]] && break
+	sleep 0.1
+done
+cleanup
+rm -rf "$TMP/archive"
+expect_fail run_bob build --upload --worker "unix:$TMP/worker.sock" root
+cleanup
+run_bob build --upload --worker "unix:$TMP/worker.sock" --worker-token "$TMP/token" root
+RES=$(run_bob query-path -f '{dist}' --release root)
+diff -u <(cat "$RES"/*.txt) <(echo lib ; echo root)
+[[ ! -e work/root/build/1/workspace/root.txt ]]
@@ -5,19 +5,40 @@
 
 from binascii import hexlify
 from tempfile import NamedTemporaryFile, TemporaryDirectory
-from unittest import TestCase
+from unittest import TestCase, skipIf
 from unittest.mock import MagicMock, patch
 import asyncio
+import concurrent.futures
+import email.utils
 import http.server
 import os, os.path
+import random
+import re
+import socket
 import socketserver
+import sqlite3
 import stat
 import subprocess
 import tarfile
 import threading
-
-from bob.archive import DummyArchive, SimpleHttpArchive, getArchiver
+import time
+import urllib.parse
+import xml.etree.ElementTree as ET
+
+from bob.archive import DummyArchive, LocalArchive, SimpleHttpArchive, getArchiver, \
+    HttpConnectionPool, CustomArchive, ArtifactUploadError, openArtifactReader, \
+    MultiArchive, percentile, ArtifactExistsError, AzureArchive, findChunkBoundary, \
+    CHUNK_GEAR
 from bob.errors import BuildError
+from bob.state import finalize
+from bob.tty import EXECUTED, SKIPPED, ERROR
+from bob.utils import removePath
+
+try:
+    import azure.storage.blob
+    AZURE_MISSING = False
+except ImportError:
+    AZURE_MISSING = True
 
 DOWNLOAD_ARITFACT = b'\x00'*20
 NOT_EXISTS_ARTIFACT = b'\x01'*20
@@ -49,8 +70,68 @@ def callJenkinsScript(script, workspace):
     subprocess.check_call(['/bin/bash', '-eEx', '-c', script],
         universal_newlines=True, stderr=subprocess.STDOUT, cwd=workspace, env=env)
 
+def createWorkspace(tmp, files=None):
+    """Create an audit trail and a workspace with the given files in tmp.
+
+    The files are given as dict of (relative) names and their content.
+    Returns the tuple (audit, content).
+    """
+    if files is None: files = { "data" : b'DATA' }
+    audit = os.path.join(tmp, "audit.json.gz")
+    with open(audit, "wb") as f:
+        f.write(b'AUDIT')
+    content = os.path.join(tmp, "src")
+    os.makedirs(content)
+    for name, data in files.items():
+        name = os.path.join(content, name)
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+        with open(name, "wb") as f:
+            f.write(data)
+    return (audit, content)
+
+def createArtifact(repo, bid, files=None):
+    """Upload a package and its live-build-id to the file archive at repo."""
+    archive = LocalArchive({ "path" : repo })
+    archive.wantUpload(True)
+    with TemporaryDirectory() as tmp:
+        audit, content = createWorkspace(tmp, files)
+        run(archive.uploadPackage(DummyStep(), bid, audit, content))
+        run(archive.uploadLocalLiveBuildId(DummyStep(), bid, b'\x00'*20))
+
+def downloadArtifact(archive, bid, name="data"):
+    """Download a package into a temporary workspace.
+
+    Returns the content of the given file or None if the download failed.
+    """
+    with TemporaryDirectory() as tmp:
+        audit = os.path.join(tmp, "audit.json.gz")
+        content = os.path.join(tmp, "workspace")
+        if not run(archive.downloadPackage(DummyStep(), bid, audit, content)):
+            return None
+        with open(os.path.join(content, name), "rb") as f:
+            return f.read()
+
+class HttpServer:
+    """Serve the requests of a handler in a background thread"""
+
+    def __init__(self, handler):
+        self.httpd = socketserver.ThreadingTCPServer(("localhost", 0), handler)
+        self.httpd.daemon_threads = True
+        ip, port = self.httpd.server_address
+        self.url = "http://{}:{}".format(ip, port)
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
 class BaseTester:
 
+    # Can the backend tell missing artifacts from errors?
+    DETECTS_MISSING = True
+
     def __createArtifact(self, bid, version="1"):
         bid = hexlify(bid).decode("ascii")
         name = os.path.join(self.repo.name, bid[0:2], bid[2:4], bid[4:] + "-1.tgz")
@@ -136,6 +217,10 @@ class BaseTester:
         recipes.archiveSpec.return_value = [ { 'backend' : 'none' }, spec ]
         recipes.envWhiteList = MagicMock()
         recipes.envWhiteList.return_value = []
+        recipes.archiveCache = MagicMock()
+        recipes.archiveCache.return_value = None
+        recipes.archiveStrategy = MagicMock()
+        recipes.archiveStrategy.return_value = {}
         return getArchiver(recipes)
 
     def __getSingleArchiveInstance(self, spec):
@@ -146,6 +231,10 @@ class BaseTester:
         recipes.archiveSpec.return_value = spec
         recipes.envWhiteList = MagicMock()
         recipes.envWhiteList.return_value = []
+        recipes.archiveCache = MagicMock()
+        recipes.archiveCache.return_value = None
+        recipes.archiveStrategy = MagicMock()
+        recipes.archiveStrategy.return_value = {}
         return getArchiver(recipes)
 
     def setUp(self):
@@ -312,6 +401,170 @@ class BaseTester:
             with self.assertRaises(BuildError):
                 run(archive.downloadPackage(DummyStep(), WRONG_VERSION_ARTIFACT, audit, content))
 
+    def testQueryPackage(self):
+        """Query existence of packages without downloading them"""
+
+        archive = self.__getArchiveInstance({})
+        self.assertEqual(run(archive.queryPackage(DummyStep(), DOWNLOAD_ARITFACT)), (False, None))
+
+        # Backends may not know the existence or the size. But they must never
+        # claim the opposite of the truth.
+        archive.wantDownload(True)
+        exists, size = run(archive.queryPackage(DummyStep(), DOWNLOAD_ARITFACT))
+        self.assertNotEqual(exists, False)
+        if size is not None:
+            self.assertEqual(size, os.stat(self.dummyFileName).st_size)
+        exists, size = run(archive.queryPackage(DummyStep(), NOT_EXISTS_ARTIFACT))
+        self.assertNotEqual(exists, True)
+        self.assertEqual(size, None)
+
+    def testQueryPackages(self):
+        """Query existence of multiple packages at once"""
+
+        bids = [ DOWNLOAD_ARITFACT, NOT_EXISTS_ARTIFACT ]
+        archive = self.__getArchiveInstance({})
+        self.assertEqual(run(archive.queryPackages(DummyStep(), bids)),
+            { DOWNLOAD_ARITFACT : (False, None), NOT_EXISTS_ARTIFACT : (False, None) })
+
+        archive.wantDownload(True)
+        ret = run(archive.queryPackages(DummyStep(), bids))
+        self.assertEqual(set(ret.keys()), set(bids))
+        self.assertNotEqual(ret[DOWNLOAD_ARITFACT][0], False)
+        self.assertNotEqual(ret[NOT_EXISTS_ARTIFACT], (True, None))
+        self.assertEqual(ret[NOT_EXISTS_ARTIFACT][1], None)
+
+    def testQueryPackagesManifest(self):
+        """Packages are looked up in the manifest if available"""
+
+        bids = [ DOWNLOAD_ARITFACT, UPLOAD1_ARTIFACT, NOT_EXISTS_ARTIFACT ]
+        archive = self.__getArchiveInstance({ "manifest" : True })
+        archive.wantDownload(True)
+
+        # Without manifest the artifacts are queried
+        ret = run(archive.queryPackages(DummyStep(), bids))
+        self.assertNotEqual(ret[DOWNLOAD_ARITFACT][0], False)
+        self.assertNotEqual(ret[UPLOAD1_ARTIFACT][0], True)
+
+        # The manifest is downloaded only once. Artifacts that are not listed
+        # are not found even if they exist.
+        with open(os.path.join(self.repo.name, "MANIFEST"), "w") as f:
+            for bid in (UPLOAD1_ARTIFACT, UPLOAD2_ARTIFACT):
+                bid = hexlify(bid).decode("ascii")
+                f.write("{}/{}/{}-1.tgz 42\n".format(bid[0:2], bid[2:4], bid[4:]))
+        archive = self.__getArchiveInstance({ "manifest" : True })
+        archive.wantDownload(True)
+        self.assertEqual(run(archive.queryPackages(DummyStep(), bids)),
+            { DOWNLOAD_ARITFACT : (False, None), UPLOAD1_ARTIFACT : (True, 42),
+              NOT_EXISTS_ARTIFACT : (False, None) })
+        os.unlink(os.path.join(self.repo.name, "MANIFEST"))
+        self.assertEqual(run(archive.queryPackages(DummyStep(), [UPLOAD2_ARTIFACT])),
+            { UPLOAD2_ARTIFACT : (True, 42) })
+
+    def testMissCache(self):
+        """Misses are remembered until the artifact is uploaded by Bob"""
+        if not self.DETECTS_MISSING:
+            self.skipTest("backend cannot detect missing artifacts")
+
+        oldCwd = os.getcwd()
+        with TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                archive = self.__getArchiveInstance({ "missCacheTTL" : 3600 })
+                archive.wantDownload(True)
+                archive.wantUpload(True)
+                audit = os.path.join(tmp, "audit.json.gz")
+                content = os.path.join(tmp, "workspace")
+
+                # Artifacts that appear later are not seen until the TTL expired
+                self.assertFalse(run(archive.downloadPackage(DummyStep(), UPLOAD1_ARTIFACT, audit, content)))
+                self.assertEqual(run(archive.downloadLocalLiveBuildId(DummyStep(), UPLOAD1_ARTIFACT)), None)
+                self.__createArtifact(UPLOAD1_ARTIFACT)
+                self.__createBuildId(UPLOAD1_ARTIFACT)
+                self.assertFalse(run(archive.downloadPackage(DummyStep(), UPLOAD1_ARTIFACT, audit, content)))
+                self.assertEqual(run(archive.queryPackage(DummyStep(), UPLOAD1_ARTIFACT)), (False, None))
+                self.assertEqual(run(archive.downloadLocalLiveBuildId(DummyStep(), UPLOAD1_ARTIFACT)), None)
+                with patch('time.time', return_value=time.time()+7200):
+                    self.assertTrue(run(archive.downloadPackage(DummyStep(), UPLOAD1_ARTIFACT, audit, content)))
+                    self.assertEqual(run(archive.downloadLocalLiveBuildId(DummyStep(), UPLOAD1_ARTIFACT)),
+                                     b'\x00'*20)
+
+                # Uploads invalidate the cache
+                self.assertEqual(run(archive.queryPackages(DummyStep(), [UPLOAD2_ARTIFACT])),
+                                 { UPLOAD2_ARTIFACT : (False, None) })
+                self.assertEqual(run(archive.downloadLocalLiveBuildId(DummyStep(), UPLOAD2_ARTIFACT)), None)
+
+                # Failed uploads keep the miss
+                with patch("bob.archive.BaseArchive._uploadPackage", return_value=("error", ERROR)):
+                    run(archive.uploadPackage(DummyStep(), UPLOAD2_ARTIFACT, audit, content))
+                with patch("bob.archive.BaseArchive._uploadLocalLiveBuildId", return_value=("error", ERROR)):
+                    run(archive.uploadLocalLiveBuildId(DummyStep(), UPLOAD2_ARTIFACT, b'\x00'*20))
+                self.__createArtifact(UPLOAD2_ARTIFACT)
+                self.__createBuildId(UPLOAD2_ARTIFACT)
+                self.assertEqual(run(archive.queryPackage(DummyStep(), UPLOAD2_ARTIFACT)), (False, None))
+                self.assertEqual(run(archive.downloadLocalLiveBuildId(DummyStep(), UPLOAD2_ARTIFACT)), None)
+
+                run(archive.uploadPackage(DummyStep(), UPLOAD2_ARTIFACT, audit, content))
+                run(archive.uploadLocalLiveBuildId(DummyStep(), UPLOAD2_ARTIFACT, b'\x00'*20))
+                self.assertTrue(run(archive.downloadPackage(DummyStep(), UPLOAD2_ARTIFACT, audit, content)))
+                self.assertEqual(run(archive.downloadLocalLiveBuildId(DummyStep(), UPLOAD2_ARTIFACT)),
+                                 b'\x00'*20)
+            finally:
+                finalize()
+                os.chdir(oldCwd)
+
+    def testMissCachePrune(self):
+        """Expired misses are deleted from the project state"""
+        if not self.DETECTS_MISSING:
+            self.skipTest("backend cannot detect missing artifacts")
+
+        oldCwd = os.getcwd()
+        with TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                archive = self.__getArchiveInstance({ "missCacheTTL" : 3600 })
+                archive.wantDownload(True)
+                self.assertEqual(run(archive.queryPackage(DummyStep(), UPLOAD1_ARTIFACT)), (False, None))
+                finalize()
+
+                with patch('time.time', return_value=time.time()+7200):
+                    archive = self.__getArchiveInstance({ "missCacheTTL" : 3600 })
+                    archive.wantDownload(True)
+                    self.assertEqual(run(archive.queryPackage(DummyStep(), UPLOAD2_ARTIFACT)), (False, None))
+                finalize()
+
+                with sqlite3.connect(".bob-buildids.sqlite3") as db:
+                    keys = [ k for (k,) in db.execute("SELECT key FROM archivemisses") ]
+                self.assertEqual(len(keys), 1)
+                self.assertIn(hexlify(UPLOAD2_ARTIFACT).decode("ascii")[4:], keys[0])
+            finally:
+                finalize()
+                os.chdir(oldCwd)
+
+    def testSources(self):
+        """Sources are kept apart from the packages"""
+        archive = self.__getArchiveInstance({})
+        archive.wantDownload(True)
+        archive.wantUpload(True)
+        with TemporaryDirectory() as tmp:
+            audit = os.path.join(tmp, "audit.json.gz")
+            content = os.path.join(tmp, "workspace")
+            with open(audit, "wb") as f:
+                f.write(b"AUDIT")
+            os.mkdir(content)
+            with open(os.path.join(content, "data"), "wb") as f:
+                f.write(b"SOURCES")
+
+            run(archive.uploadSources(DummyStep(), UPLOAD1_ARTIFACT, audit, content))
+            result = os.path.join(tmp, "result")
+            self.assertFalse(run(archive.downloadPackage(DummyStep(), UPLOAD1_ARTIFACT,
+                os.path.join(tmp, "result.json.gz"), result)))
+            self.assertTrue(run(archive.downloadSources(DummyStep(), UPLOAD1_ARTIFACT,
+                os.path.join(tmp, "result.json.gz"), result)))
+            with open(os.path.join(result, "data"), "rb") as f:
+                self.assertEqual(f.read(), b"SOURCES")
+            self.assertFalse(run(archive.downloadSources(DummyStep(), UPLOAD2_ARTIFACT,
+                os.path.join(tmp, "result.json.gz"), result)))
+
     def testUploadPackageNormal(self):
         """Local upload tests"""
 
@@ -493,10 +746,18 @@ class TestDummyArchive(TestCase):
         run(DummyArchive().uploadLocalLiveBuildId(DummyStep(), b'\x00'*20, b'\x00'*20))
 
 
-def createHttpHandler(repoPath):
+def createHttpHandler(repoPath, keepAlive=False, ranges=False):
 
     class Handler(http.server.BaseHTTPRequestHandler):
 
+        protocol_version = "HTTP/1.1" if keepAlive else "HTTP/1.0"
+        connections = 0
+        rangeRequests = 0
+
+        def setup(self):
+            super().setup()
+            type(self).connections += 1
+
         def getCommon(self):
             path = repoPath + self.path
             try:
@@ -508,8 +769,21 @@ def createHttpHandler(repoPath):
                 self.send_error(500, "internal error")
                 return None
 
-            self.send_response(200)
+            size = os.fstat(f.fileno()).st_size
+            m = re.fullmatch(r'bytes=([0-9]+)-([0-9]+)', self.headers.get("Range", ""))
+            if ranges and m:
+                type(self).rangeRequests += 1
+                first = int(m.group(1))
+                last = min(int(m.group(2)), size-1)
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes {}-{}/{}".format(first, last, size))
+                f.seek(first)
+                self.length = last - first + 1
+            else:
+                self.send_response(200)
+                self.length = size
             self.send_header("Content-type", "application/octet-stream")
+            self.send_header("Content-Length", str(self.length))
             self.end_headers()
             return f
 
@@ -520,18 +794,38 @@ def createHttpHandler(repoPath):
         def do_GET(self):
             f = self.getCommon()
             if f:
-                self.wfile.write(f.read())
+                self.wfile.write(f.read(self.length))
                 f.close()
 
+        def readChunked(self):
+            content = b''
+            while True:
+                line = self.rfile.readline()
+                if not line: return None
+                length = int(line.strip(), 16)
+                data = self.rfile.read(length)
+                if len(data) != length or self.rfile.readline() != b'\r\n':
+                    return None
+                if length == 0: return content
+                content += data
+
         def do_PUT(self):
-            length = int(self.headers['Content-Length'])
-            content  = self.rfile.read(length)
+            if self.headers.get('Transfer-Encoding') == 'chunked':
+                content = self.readChunked()
+                if content is None:
+                    # incomplete upload
+                    self.close_connection = True
+                    return
+            else:
+                length = int(self.headers['Content-Length'])
+                content  = self.rfile.read(length)
 
             exists = False
             path = repoPath + self.path
             if os.path.exists(path):
                 if "If-None-Match" in self.headers:
                     self.send_response(412)
+                    self.send_header("Content-Length", "0")
                     self.end_headers()
                     return
                 else:
@@ -542,6 +836,7 @@ def createHttpHandler(repoPath):
                 with open(path, "wb") as f:
                     f.write(content)
                 self.send_response(200 if exists else 201)
+                self.send_header("Content-Length", "0")
                 self.end_headers()
             except OSError:
                 self.send_error(500, "internal error")
@@ -554,25 +849,28 @@ class TestLocalArchive(BaseTester, TestCase):
         spec['backend'] = "file"
         spec["path"] = self.repo.name
 
+    def testQueryPackageSize(self):
+        """Local archive always knows the size of artifacts"""
+        archive = LocalArchive({ "path" : self.repo.name })
+        archive.wantDownload(True)
+        self.assertEqual(run(archive.queryPackage(DummyStep(), DOWNLOAD_ARITFACT)),
+            (True, os.stat(self.dummyFileName).st_size))
+        self.assertEqual(run(archive.queryPackage(DummyStep(), NOT_EXISTS_ARTIFACT)),
+            (False, None))
 
 class TestHttpArchive(BaseTester, TestCase):
 
     def setUp(self):
         super().setUp()
-        self.httpd = socketserver.ThreadingTCPServer(("localhost", 0), createHttpHandler(self.repo.name))
-        self.ip, self.port = self.httpd.server_address
-        self.server = threading.Thread(target=self.httpd.serve_forever)
-        self.server.daemon = True
-        self.server.start()
+        self.http = HttpServer(createHttpHandler(self.repo.name))
 
     def tearDown(self):
-        self.httpd.shutdown()
-        self.httpd.server_close()
+        self.http.close()
         super().tearDown()
 
     def _setArchiveSpec(self, spec):
         spec['backend'] = "http"
-        spec["url"] = "http://{}:{}".format(self.ip, self.port)
+        spec["url"] = self.http.url
 
     def testInvalidServer(self):
         """Test download on non-existent server"""
@@ -593,10 +891,1065 @@ class TestHttpArchive(BaseTester, TestCase):
             script = archive.download(None, "test.buildid", "result.tgz")
             callJenkinsScript(script, workspace)
 
+class TestHttpArchiveStreamUpload(TestHttpArchive):
+
+    def _setArchiveSpec(self, spec):
+        super()._setArchiveSpec(spec)
+        spec["streamUpload"] = True
+
+    def testAbort(self):
+        """Aborted uploads must not create the artifact"""
+        archive = SimpleHttpArchive({
+            "url" : self.http.url,
+            "streamUpload" : True }, None)
+        with self.assertRaises(RuntimeError):
+            with archive._openUploadFile(UPLOAD1_ARTIFACT, ".tgz") as (name, fileobj):
+                fileobj.write(os.urandom(1024*1024))
+                raise RuntimeError()
+        self.assertFalse(os.path.exists(os.path.join(self.repo.name, "10")))
+
+class TestHttpArchiveAsyncio(TestHttpArchive):
+
+    def _setArchiveSpec(self, spec):
+        super()._setArchiveSpec(spec)
+        spec["asyncio"] = True
+
+    def testConcurrent(self):
+        """Many concurrent downloads in the event loop"""
+        archive = SimpleHttpArchive({
+            "url" : self.http.url,
+            "asyncio" : True }, None)
+        with open(self.dummyFileName, "rb") as f:
+            expected = f.read()
+        names = run(asyncio.gather(*(archive._fetchFile(DOWNLOAD_ARITFACT, ".tgz")
+                                     for i in range(50))))
+        try:
+            for name in names:
+                with open(name, "rb") as f:
+                    self.assertEqual(f.read(), expected)
+        finally:
+            for name in names: os.unlink(name)
+
+def createAzureHandler(repoPath, account, container):
+    """Minimal stand-in for the Azurite blob storage emulator.
+
+    Serves the blobs of a single container from the repository directory and
+    keeps staged blocks in memory.
+    """
+
+    prefix = "/{}/{}/".format(account, container)
+    lock = threading.Lock()
+    staged = {}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        protocol_version = "HTTP/1.1"
+        blockRequests = 0
+
+        def log_message(self, format, *args):
+            pass
+
+        def parse(self):
+            url = urllib.parse.urlsplit(self.path)
+            if not url.path.startswith(prefix):
+                self.reply(400)
+                return (None, None)
+            blob = urllib.parse.unquote(url.path[len(prefix):])
+            return (blob, dict(urllib.parse.parse_qsl(url.query)))
+
+        def reply(self, status, headers={}, body=b''):
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def properties(self, f):
+            st = os.fstat(f.fileno())
+            return {
+                "x-ms-blob-type" : "BlockBlob",
+                "ETag" : '"{}"'.format(st.st_mtime_ns),
+                "Last-Modified" : email.utils.formatdate(st.st_mtime, usegmt=True),
+            }
+
+        def openBlob(self, blob):
+            try:
+                return open(os.path.join(repoPath, blob), "rb")
+            except FileNotFoundError:
+                self.reply(404, { "x-ms-error-code" : "BlobNotFound" })
+            except OSError:
+                self.reply(500)
+            return None
+
+        def do_HEAD(self):
+            blob, query = self.parse()
+            if blob is None: return
+            f = self.openBlob(blob)
+            if f is None: return
+            with f:
+                headers = self.properties(f)
+                headers["Content-Length"] = str(os.fstat(f.fileno()).st_size)
+                self.send_response(200)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+
+        def do_GET(self):
+            blob, query = self.parse()
+            if blob is None: return
+            f = self.openBlob(blob)
+            if f is None: return
+            with f:
+                headers = self.properties(f)
+                size = os.fstat(f.fileno()).st_size
+                m = re.fullmatch(r'bytes=([0-9]+)-([0-9]+)', self.headers.get("x-ms-range", ""))
+                if m:
+                    first = int(m.group(1))
+                    last = min(int(m.group(2)), size-1)
+                    headers["Content-Range"] = "bytes {}-{}/{}".format(first, last, size)
+                    f.seek(first)
+                    self.reply(206, headers, f.read(last - first + 1))
+                else:
+                    self.reply(200, headers, f.read())
+
+        def commit(self, blob, content):
+            path = os.path.join(repoPath, blob)
+            with lock:
+                if "If-None-Match" in self.headers and os.path.exists(path):
+                    self.reply(409, { "x-ms-error-code" : "BlobAlreadyExists" })
+                    return
+                try:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    with open(path + ".tmp", "wb") as f:
+                        f.write(content)
+                    os.rename(path + ".tmp", path)
+                except OSError:
+                    self.reply(500)
+                    return
+            self.reply(201, { "ETag" : '"0"',
+                "Last-Modified" : email.utils.formatdate(usegmt=True) })
+
+        def do_PUT(self):
+            blob, query = self.parse()
+            if blob is None: return
+            content = self.rfile.read(int(self.headers.get('Content-Length', "0")))
+            comp = query.get("comp")
+            if comp == "block":
+                type(self).blockRequests += 1
+                with lock:
+                    staged[(blob, query["blockid"])] = content
+                self.reply(201)
+            elif comp == "blocklist":
+                try:
+                    with lock:
+                        content = b"".join(staged[(blob, i.text)]
+                                           for i in ET.fromstring(content))
+                except KeyError:
+                    self.reply(400, { "x-ms-error-code" : "InvalidBlockList" })
+                    return
+                self.commit(blob, content)
+            else:
+                self.commit(blob, content)
+
+    return Handler
+
+@skipIf(AZURE_MISSING, "requires azure-storage-blob")
+class TestAzureArchive(BaseTester, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.handler = createAzureHandler(self.repo.name, "devstoreaccount1", "bob")
+        self.http = HttpServer(self.handler)
+
+    def tearDown(self):
+        self.http.close()
+        super().tearDown()
+
+    def _setArchiveSpec(self, spec):
+        spec['backend'] = "azure"
+        spec['account'] = "devstoreaccount1"
+        spec['container'] = "bob"
+        spec['endpoint'] = self.http.url + "/devstoreaccount1"
+        # Small blocks to transfer even the test artifacts in parallel
+        spec['blockSize'] = 64 * 1024
+        spec['maxConnections'] = 4
+
+    def testQueryPackagesManifest(self):
+        self.skipTest("manifest not supported by azure backend")
+
+    def __getArchive(self):
+        spec = {}
+        self._setArchiveSpec(spec)
+        return AzureArchive(spec)
+
+    def testBlockTransfer(self):
+        """Large artifacts are transferred in blocks"""
+        archive = self.__getArchive()
+        data = os.urandom(1024*1024)
+        with archive._openUploadFile(UPLOAD1_ARTIFACT, ".bin") as (name, fileobj):
+            with open(name, "wb") as f:
+                f.write(data)
+        self.assertEqual(self.handler.blockRequests, 16)
+
+        with archive._openDownloadFile(UPLOAD1_ARTIFACT, ".bin") as (name, fileobj):
+            with open(name, "rb") as f:
+                self.assertEqual(f.read(), data)
+
+    def testConcurrentUpload(self):
+        """Concurrent block uploads of the same build-id: first writer wins"""
+        barrier = threading.Barrier(2)
+        payloads = [ os.urandom(1024*1024), os.urandom(1024*1024) ]
+
+        def upload(data):
+            archive = self.__getArchive()
+            try:
+                with archive._openUploadFile(UPLOAD1_ARTIFACT, ".bin") as (name, fileobj):
+                    with open(name, "wb") as f:
+                        f.write(data)
+                    barrier.wait()
+            except ArtifactExistsError:
+                return False
+            return True
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            results = list(executor.map(upload, payloads))
+        self.assertEqual(sorted(results), [False, True])
+
+        bid = hexlify(UPLOAD1_ARTIFACT).decode("ascii")
+        with open(os.path.join(self.repo.name, bid[0:2], bid[2:4], bid[4:] + "-1.bin"), "rb") as f:
+            self.assertEqual(f.read(), payloads[results.index(True)])
+
+class TestHttpConnectionPool(TestCase):
+
+    def setUp(self):
+        self.repo = TemporaryDirectory()
+        self.handler = createHttpHandler(self.repo.name, True, True)
+        self.http = HttpServer(self.handler)
+        self.data = os.urandom(1000000)
+        createArtifact(self.repo.name, DOWNLOAD_ARITFACT,
+                       { "data" : os.urandom(100000), "big" : self.data })
+
+    def tearDown(self):
+        self.http.close()
+        self.repo.cleanup()
+
+    def __getArchive(self, poolSize):
+        archive = SimpleHttpArchive({
+            "url" : self.http.url + "/",
+            "poolSize" : poolSize }, None)
+        archive.wantDownload(True)
+        archive.wantUpload(True)
+        return archive
+
+    def __download(self, archive):
+        with TemporaryDirectory() as tmp:
+            audit = os.path.join(tmp, "audit.json.gz")
+            content = os.path.join(tmp, "workspace")
+            with patch('bob.archive.signal.signal'):
+                if not archive._downloadPackage(DOWNLOAD_ARITFACT, audit, content)[0]:
+                    return False
+            with open(os.path.join(content, "big"), "rb") as f:
+                return f.read() == self.data
+
+    def testReuse(self):
+        """Sequential requests use the same connection"""
+        archive = self.__getArchive(1)
+        for i in range(5):
+            self.assertTrue(self.__download(archive))
+            self.assertEqual(run(archive.queryPackage(DummyStep(), DOWNLOAD_ARITFACT))[0], True)
+        self.assertEqual(self.handler.connections, 1)
+
+        # The server closes the connection on errors. Must not hurt.
+        self.assertEqual(run(archive.queryPackage(DummyStep(), NOT_EXISTS_ARTIFACT))[0], False)
+        self.assertTrue(self.__download(archive))
+
+    def testParallel(self):
+        """Parallel transfers use their own connections"""
+        archive = self.__getArchive(4)
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(lambda i: self.__download(archive), range(40)))
+        self.assertTrue(all(results))
+        self.assertLessEqual(self.handler.connections, 40)
+
+    def testRanges(self):
+        """Large files are downloaded by parallel range requests"""
+        archive = self.__getArchive(4)
+        with patch('bob.archive.SimpleHttpArchive.SEGMENT_SIZE', 64*1024):
+            self.assertTrue(self.__download(archive))
+            self.assertGreater(self.handler.rangeRequests, 10)
+
+            # Files that fit into one segment are downloaded at once.
+            self.handler.rangeRequests = 0
+            self.assertEqual(run(archive.downloadLocalLiveBuildId(DummyStep(), DOWNLOAD_ARITFACT)),
+                             b'\x00'*20)
+            self.assertEqual(self.handler.rangeRequests, 1)
+
+    def testRangesDisabled(self):
+        """Parallel downloads can be disabled"""
+        archive = SimpleHttpArchive({
+            "url" : self.http.url + "/",
+            "downloadStreams" : 1 }, None)
+        archive.wantDownload(True)
+        with patch('bob.archive.SimpleHttpArchive.SEGMENT_SIZE', 64*1024):
+            self.assertTrue(self.__download(archive))
+        self.assertEqual(self.handler.rangeRequests, 0)
+
+    def testServerClose(self):
+        """Connections that were closed by the server are not reused"""
+        pool = HttpConnectionPool(urllib.parse.urlparse("http://localhost/"), None, 2)
+        c1 = pool.checkout()
+        c2 = pool.checkout()
+        self.assertIsNot(c1, c2)
+        s1, peer1 = socket.socketpair()
+        s2, peer2 = socket.socketpair()
+        c1.sock = s1
+        c2.sock = s2
+        pool.checkin(c1)
+        pool.checkin(c2)
+        peer1.close()
+        self.assertIs(pool.checkout(), c2)
+        c3 = pool.checkout()
+        self.assertIsNot(c3, c1)
+        c2.close()
+        c3.close()
+        peer2.close()
+
+class TestArchiveCache(TestCase):
+
+    def setUp(self):
+        self.repo = TemporaryDirectory()
+        self.cache = TemporaryDirectory()
+        self.http = HttpServer(createHttpHandler(self.repo.name))
+
+    def tearDown(self):
+        self.http.close()
+        self.cache.cleanup()
+        self.repo.cleanup()
+
+    def __getArchive(self, size=1024*1024):
+        recipes = MagicMock()
+        recipes.archiveSpec = MagicMock()
+        recipes.archiveSpec.return_value = {
+            'backend' : "http",
+            'url' : self.http.url,
+        }
+        recipes.archiveCache = MagicMock()
+        recipes.archiveCache.return_value = { 'path' : self.cache.name, 'size' : size }
+        recipes.archiveStrategy = MagicMock()
+        recipes.archiveStrategy.return_value = {}
+        recipes.getPolicy = MagicMock()
+        recipes.getPolicy.return_value = True
+        archive = getArchiver(recipes)
+        archive.wantDownload(True)
+        return archive
+
+    def __cachedFiles(self):
+        return sorted(os.path.join(root, n) for root, dirs, names in os.walk(self.cache.name)
+                      for n in names if n.endswith((".tgz", ".buildid")))
+
+    def testFill(self):
+        """Downloaded artifacts are served from the cache afterwards"""
+        archive = self.__getArchive()
+        createArtifact(self.repo.name, DOWNLOAD_ARITFACT)
+        self.assertEqual(downloadArtifact(archive, DOWNLOAD_ARITFACT), b'DATA')
+        self.assertEqual(run(archive.downloadLocalLiveBuildId(DummyStep(), DOWNLOAD_ARITFACT)),
+                         b'\x00'*20)
+        self.assertEqual(len(self.__cachedFiles()), 2)
+
+        # remove from server
+        for root, dirs, names in os.walk(self.repo.name):
+            for n in names: os.unlink(os.path.join(root, n))
+        self.assertEqual(downloadArtifact(archive, DOWNLOAD_ARITFACT), b'DATA')
+        self.assertEqual(run(archive.downloadLocalLiveBuildId(DummyStep(), DOWNLOAD_ARITFACT)),
+                         b'\x00'*20)
+        self.assertEqual(run(archive.queryPackage(DummyStep(), DOWNLOAD_ARITFACT))[0], True)
+        self.assertEqual(downloadArtifact(archive, NOT_EXISTS_ARTIFACT), None)
+
+    def testBroken(self):
+        """Failed downloads are not cached"""
+        archive = self.__getArchive()
+        bid = hexlify(BROKEN_ARTIFACT).decode("ascii")
+        name = os.path.join(self.repo.name, bid[0:2], bid[2:4], bid[4:] + "-1.tgz")
+        os.makedirs(os.path.dirname(name))
+        with open(name, "wb") as f:
+            f.write(b'\x00')
+        with self.assertRaises(BuildError):
+            downloadArtifact(archive, BROKEN_ARTIFACT)
+        self.assertEqual(os.listdir(os.path.dirname(name).replace(self.repo.name, self.cache.name)), [])
+
+    def testEvict(self):
+        """Least recently used artifacts are evicted"""
+        createArtifact(self.repo.name, UPLOAD1_ARTIFACT, { "data" : os.urandom(4096) })
+        createArtifact(self.repo.name, UPLOAD2_ARTIFACT, { "data" : os.urandom(4096) })
+        createArtifact(self.repo.name, DOWNLOAD_ARITFACT, { "data" : os.urandom(4096) })
+
+        # The limit is enough for two of the artifacts
+        archive = self.__getArchive(12*1024)
+        self.assertNotEqual(downloadArtifact(archive, UPLOAD1_ARTIFACT), None)
+        self.assertNotEqual(downloadArtifact(archive, UPLOAD2_ARTIFACT), None)
+        self.assertEqual(len(self.__cachedFiles()), 2)
+        for i in self.__cachedFiles():
+            os.utime(i, (1, 1))
+
+        # Touch first artifact by a cache hit. The second is evicted then.
+        self.assertNotEqual(downloadArtifact(archive, UPLOAD1_ARTIFACT), None)
+        self.assertNotEqual(downloadArtifact(archive, DOWNLOAD_ARITFACT), None)
+        cached = [ os.path.basename(i) for i in self.__cachedFiles() ]
+        self.assertEqual(len(cached), 2)
+        self.assertNotIn(hexlify(UPLOAD2_ARTIFACT).decode("ascii")[4:] + "-1.tgz", cached)
+
+    def __cacheSize(self):
+        with open(os.path.join(self.cache.name, ".size")) as f:
+            return int(f.read().split()[0])
+
+    def testSizeTracking(self):
+        """The cache is only walked if the size limit is exceeded"""
+        createArtifact(self.repo.name, UPLOAD1_ARTIFACT, { "data" : os.urandom(4096) })
+        createArtifact(self.repo.name, UPLOAD2_ARTIFACT, { "data" : os.urandom(4096) })
+        createArtifact(self.repo.name, DOWNLOAD_ARITFACT, { "data" : os.urandom(4096) })
+        archive = self.__getArchive(12*1024)
+
+        # The first insert walks the cache to calculate the size
+        self.assertNotEqual(downloadArtifact(archive, UPLOAD1_ARTIFACT), None)
+        self.assertEqual(self.__cacheSize(), sum(os.path.getsize(i) for i in self.__cachedFiles()))
+
+        # Further inserts just add to the size
+        with patch('bob.archive.os.walk', side_effect=AssertionError("walked")):
+            self.assertNotEqual(downloadArtifact(archive, UPLOAD2_ARTIFACT), None)
+        self.assertEqual(self.__cacheSize(), sum(os.path.getsize(i) for i in self.__cachedFiles()))
+
+        # Exceeding the limit walks the cache and evicts files
+        with patch('bob.archive.os.walk', wraps=os.walk) as walk:
+            self.assertNotEqual(downloadArtifact(archive, DOWNLOAD_ARITFACT), None)
+            self.assertTrue(walk.called)
+        self.assertEqual(len(self.__cachedFiles()), 2)
+        self.assertEqual(self.__cacheSize(), sum(os.path.getsize(i) for i in self.__cachedFiles()))
+
 class TestCustomArchive(BaseTester, TestCase):
 
+    DETECTS_MISSING = False
+
     def _setArchiveSpec(self, spec):
         spec['backend'] = "shell"
         spec["download"] = "cp {}/$BOB_REMOTE_ARTIFACT $BOB_LOCAL_ARTIFACT".format(self.repo.name)
         spec["upload"] = "mkdir -p {P}/${{BOB_REMOTE_ARTIFACT%/*}} && cp $BOB_LOCAL_ARTIFACT {P}/$BOB_REMOTE_ARTIFACT".format(P=self.repo.name)
 
+
+class TestCustomArchiveStreamUpload(TestCustomArchive):
+
+    def _setArchiveSpec(self, spec):
+        super()._setArchiveSpec(spec)
+        spec["streamUpload"] = True
+
+    def testAbort(self):
+        """Aborted uploads must not create the artifact"""
+        archive = CustomArchive({
+            "upload" : "mkdir -p {P}/${{BOB_REMOTE_ARTIFACT%/*}} && "
+                       "cat $BOB_LOCAL_ARTIFACT > {P}/tmp && "
+                       "mv {P}/tmp {P}/$BOB_REMOTE_ARTIFACT".format(P=self.repo.name),
+            "streamUpload" : True }, [])
+        with self.assertRaises(RuntimeError):
+            with archive._openUploadFile(UPLOAD1_ARTIFACT, ".tgz") as (name, fileobj):
+                fileobj.write(os.urandom(1024*1024))
+                raise RuntimeError()
+        self.assertFalse(os.path.exists(os.path.join(self.repo.name,
+            "10", "10", hexlify(UPLOAD1_ARTIFACT).decode("ascii")[4:] + "-1.tgz")))
+
+    def testCommandFails(self):
+        """The upload fails if the command does not read the whole file"""
+        archive = CustomArchive({ "upload" : "head -c 10 $BOB_LOCAL_ARTIFACT",
+                                  "streamUpload" : True }, [])
+        with self.assertRaises((ArtifactUploadError, OSError)):
+            with archive._openUploadFile(UPLOAD1_ARTIFACT, ".tgz") as (name, fileobj):
+                fileobj.write(os.urandom(1024*1024))
+        archive = CustomArchive({ "upload" : "false", "streamUpload" : True }, [])
+        with self.assertRaises(ArtifactUploadError):
+            with archive._openUploadFile(UPLOAD1_ARTIFACT, ".tgz") as (name, fileobj):
+                fileobj.write(b'x')
+
+def customServerCmd(repo, exitAfter=0):
+    return """\
+        exec 3>&1 1>&2
+        echo start >> {P}/starts
+        n=0
+        while read -r op remote local ; do
+            case "$op" in
+                download)
+                    if [[ ! -e {P}/$remote ]] ; then
+                        echo missing >&3
+                    elif cp {P}/$remote "$local" ; then
+                        echo ok >&3
+                    else
+                        echo "error cp failed" >&3
+                    fi ;;
+                upload)
+                    if [[ -e {P}/$remote ]] ; then
+                        echo exists >&3
+                    elif mkdir -p {P}/${{remote%/*}} && cp "$local" {P}/$remote ; then
+                        echo ok >&3
+                    else
+                        echo "error cp failed" >&3
+                    fi ;;
+                stat)
+                    if [[ -e {P}/$remote ]] ; then
+                        echo "ok $(stat -c %s {P}/$remote)" >&3
+                    else
+                        echo missing >&3
+                    fi ;;
+                *) echo "error unknown request" >&3 ;;
+            esac
+            n=$((n+1))
+            [[ $n -ne {N} ]] || exit 0
+        done
+        """.format(P=repo, N=exitAfter)
+
+class TestCustomArchiveServer(TestCustomArchive):
+
+    DETECTS_MISSING = True
+
+    def _setArchiveSpec(self, spec):
+        super()._setArchiveSpec(spec)
+        spec["server"] = customServerCmd(self.repo.name)
+
+    def __starts(self):
+        with open(os.path.join(self.repo.name, "starts")) as f:
+            return len(f.readlines())
+
+    def testReuse(self):
+        """The helper is started only once"""
+        archive = CustomArchive({ "server" : customServerCmd(self.repo.name) }, [])
+        archive.wantDownload(True)
+        for i in range(3):
+            self.assertTrue(downloadArtifact(archive, DOWNLOAD_ARITFACT))
+        self.assertFalse(downloadArtifact(archive, NOT_EXISTS_ARTIFACT))
+        self.assertEqual(self.__starts(), 1)
+
+    def testMissCacheSeparate(self):
+        """Misses of different servers are kept apart"""
+        oldCwd = os.getcwd()
+        with TemporaryDirectory() as tmp, TemporaryDirectory() as empty:
+            os.chdir(tmp)
+            try:
+                other = CustomArchive({ "server" : customServerCmd(empty),
+                                        "missCacheTTL" : 3600 }, [])
+                other.wantDownload(True)
+                self.assertFalse(downloadArtifact(other, DOWNLOAD_ARITFACT))
+                archive = CustomArchive({ "server" : customServerCmd(self.repo.name),
+                                          "missCacheTTL" : 3600 }, [])
+                archive.wantDownload(True)
+                self.assertTrue(downloadArtifact(archive, DOWNLOAD_ARITFACT))
+            finally:
+                finalize()
+                os.chdir(oldCwd)
+
+    def testRestart(self):
+        """The helper is restarted if it exits"""
+        archive = CustomArchive({ "server" : customServerCmd(self.repo.name, 1) }, [])
+        archive.wantDownload(True)
+        for i in range(3):
+            self.assertTrue(downloadArtifact(archive, DOWNLOAD_ARITFACT))
+        self.assertEqual(self.__starts(), 3)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class TestCompression(TestCase):
+
+    def setUp(self):
+        self.repo = TemporaryDirectory()
+
+    def tearDown(self):
+        self.repo.cleanup()
+
+    def __roundTrip(self, compression):
+        archive = LocalArchive({ "path" : self.repo.name, "compression" : compression })
+        archive.wantDownload(True)
+        archive.wantUpload(True)
+        with TemporaryDirectory() as tmp:
+            audit, content = createWorkspace(tmp, { "data" : b'DATA' * 1000 })
+            run(archive.uploadPackage(DummyStep(), UPLOAD1_ARTIFACT, audit, content))
+
+        bid = hexlify(UPLOAD1_ARTIFACT).decode("ascii")
+        name = os.path.join(self.repo.name, bid[0:2], bid[2:4], bid[4:] + "-1.tgz")
+        with open(name, "rb") as f:
+            magic = f.read(6)
+
+        self.assertEqual(downloadArtifact(archive, UPLOAD1_ARTIFACT), b'DATA' * 1000)
+
+        with open(name, "rb") as f:
+            with openArtifactReader(f) as tar:
+                vsn = tar.pax_headers.get('bob-archive-vsn')
+        os.unlink(name)
+        return (magic, vsn)
+
+    def testGzip(self):
+        """Gzip compressed artifacts stay compatible"""
+        magic, vsn = self.__roundTrip({})
+        self.assertEqual(magic[0:2], b'\x1f\x8b')
+        self.assertEqual(vsn, "1")
+        magic, vsn = self.__roundTrip({ "method" : "gzip", "level" : 1 })
+        self.assertEqual(magic[0:2], b'\x1f\x8b')
+        self.assertEqual(vsn, "1")
+
+    def testXz(self):
+        magic, vsn = self.__roundTrip({ "method" : "xz", "level" : 1 })
+        self.assertEqual(magic, b'\xfd7zXZ\x00')
+        self.assertEqual(vsn, "2")
+
+    @skipIf(zstandard is None, "zstandard not installed")
+    def testZstd(self):
+        magic, vsn = self.__roundTrip({ "method" : "zstd", "threads" : 2 })
+        self.assertEqual(magic[0:4], b'\x28\xb5\x2f\xfd')
+        self.assertEqual(vsn, "2")
+
+    @skipIf(zstandard is not None, "zstandard installed")
+    def testZstdMissing(self):
+        with self.assertRaises(BuildError):
+            LocalArchive({ "path" : self.repo.name, "compression" : { "method" : "zstd" } })
+
+class TestChunkedArchive(TestCase):
+
+    def setUp(self):
+        self.repo = TemporaryDirectory()
+        self.tmp = TemporaryDirectory()
+        self.archive = LocalArchive({ "path" : self.repo.name, "chunked" : True })
+        self.archive.wantDownload(True)
+        self.archive.wantUpload(True)
+        self.audit = os.path.join(self.tmp.name, "audit.json.gz")
+        with open(self.audit, "wb") as f:
+            f.write(b'AUDIT')
+        self.chunkSizes = patch.multiple('bob.archive', CHUNK_MIN_SIZE=64,
+                                         CHUNK_AVG_SIZE=128, CHUNK_MAX_SIZE=512)
+        self.chunkSizes.start()
+
+    def tearDown(self):
+        self.chunkSizes.stop()
+        self.tmp.cleanup()
+        self.repo.cleanup()
+
+    def __createWorkspace(self, data):
+        content = os.path.join(self.tmp.name, "src")
+        if os.path.exists(content): removePath(content)
+        os.makedirs(os.path.join(content, "dir", "sub"))
+        with open(os.path.join(content, "data"), "wb") as f:
+            f.write(data)
+        with open(os.path.join(content, "dir", "script"), "w") as f:
+            f.write("#!/bin/sh\n")
+        os.chmod(os.path.join(content, "dir", "script"), 0o750)
+        os.symlink("../data", os.path.join(content, "dir", "link"))
+        os.symlink("dir", os.path.join(content, "dirlink"))
+        return content
+
+    def __upload(self, bid, data):
+        content = self.__createWorkspace(data)
+        return self.archive._uploadPackage(bid, self.audit, content)
+
+    def __download(self, bid, content):
+        audit = os.path.join(self.tmp.name, "download.json.gz")
+        fetched = []
+        openDownloadFile = self.archive._openDownloadFile
+        def countFetches(buildId, suffix):
+            if suffix == ".chunk": fetched.append(buildId)
+            return openDownloadFile(buildId, suffix)
+        with patch.object(self.archive, "_openDownloadFile", countFetches):
+            ret = run(self.archive.downloadPackage(DummyStep(), bid, audit, content))
+        if ret:
+            with open(audit, "rb") as f:
+                self.assertEqual(f.read(), b'AUDIT')
+        return (ret, len(fetched))
+
+    def __chunkFiles(self):
+        return sorted(os.path.join(root, f) for root, dirs, files in os.walk(self.repo.name)
+                      for f in files if f.endswith("-1.chunk"))
+
+    def testBoundaries(self):
+        """The chunk boundaries are the same as the ones of a bytewise gear hash"""
+        def reference(data):
+            size = min(len(data), 512)
+            h = 0
+            for i in range(max(0, 64-6), size):
+                h = ((h << 1) ^ CHUNK_GEAR[data[i]]) & 0x3f
+                if i >= 64 and h == 0: return i+1
+            return size
+
+        rnd = random.Random(42)
+        for scanSize in (1, 7, 64, 4096):
+            with patch('bob.archive.CHUNK_SCAN_SIZE', scanSize):
+                for n in (0, 1, 64, 65, 100, 511, 512, 513, 2000):
+                    data = bytes(rnd.getrandbits(8) for i in range(n))
+                    self.assertEqual(findChunkBoundary(data), reference(data))
+                    data = b'ab' * n
+                    self.assertEqual(findChunkBoundary(data), reference(data))
+
+    def testRoundTrip(self):
+        """Chunked artifacts restore files, modes and symlinks"""
+        data = b''.join(i.to_bytes(2, 'big') for i in range(4096))
+        self.assertEqual(self.__upload(UPLOAD1_ARTIFACT, data), ("ok (57 new chunks)", EXECUTED))
+        self.assertEqual(self.__upload(UPLOAD1_ARTIFACT, data)[1], SKIPPED)
+        self.assertEqual(run(self.archive.queryPackage(DummyStep(), UPLOAD1_ARTIFACT)), (True, None))
+
+        content = os.path.join(self.tmp.name, "workspace")
+        self.assertEqual(self.__download(UPLOAD1_ARTIFACT, content), (True, 57))
+        with open(os.path.join(content, "data"), "rb") as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(content, "dir", "script")).st_mode), 0o750)
+        self.assertEqual(os.readlink(os.path.join(content, "dir", "link")), "../data")
+        self.assertEqual(os.readlink(os.path.join(content, "dirlink")), "dir")
+        self.assertTrue(os.path.isdir(os.path.join(content, "dir", "sub")))
+
+        # Regular artifacts are still found
+        self.assertEqual(self.__download(NOT_EXISTS_ARTIFACT, content), (False, 0))
+
+    def testDelta(self):
+        """Only changed chunks are uploaded and downloaded"""
+        data = b''.join(i.to_bytes(2, 'big') for i in range(4096))
+        self.__upload(UPLOAD1_ARTIFACT, data)
+        changed = data[:1000] + b'X' + data[1001:]
+        self.assertEqual(self.__upload(UPLOAD2_ARTIFACT, changed), ("ok (1 new chunks)", EXECUTED))
+
+        content = os.path.join(self.tmp.name, "workspace")
+        self.assertEqual(self.__download(UPLOAD1_ARTIFACT, content), (True, 57))
+        # Only the changed chunk and the audit trail are fetched
+        self.assertEqual(self.__download(UPLOAD2_ARTIFACT, content), (True, 2))
+        with open(os.path.join(content, "data"), "rb") as f:
+            self.assertEqual(f.read(), changed)
+
+    def testInsert(self):
+        """Inserted data only changes the surrounding chunk"""
+        data = b''.join(i.to_bytes(2, 'big') for i in range(4096))
+        self.__upload(UPLOAD1_ARTIFACT, data)
+        changed = b'INSERTED' + data
+        self.assertEqual(self.__upload(UPLOAD2_ARTIFACT, changed), ("ok (1 new chunks)", EXECUTED))
+
+        content = os.path.join(self.tmp.name, "workspace")
+        self.__download(UPLOAD1_ARTIFACT, content)
+        self.assertEqual(self.__download(UPLOAD2_ARTIFACT, content), (True, 2))
+        with open(os.path.join(content, "data"), "rb") as f:
+            self.assertEqual(f.read(), changed)
+
+    def testMissingChunk(self):
+        """The old workspace is kept if a chunk is missing"""
+        data = b''.join(i.to_bytes(2, 'big') for i in range(4096))
+        self.__upload(UPLOAD1_ARTIFACT, data)
+        content = os.path.join(self.tmp.name, "workspace")
+        self.assertEqual(self.__download(UPLOAD1_ARTIFACT, content), (True, 57))
+
+        self.__upload(UPLOAD2_ARTIFACT, b'DIFFERENT DATA')
+        for i in self.__chunkFiles(): os.unlink(i)
+        self.assertFalse(self.__download(UPLOAD2_ARTIFACT, content)[0])
+        with open(os.path.join(content, "data"), "rb") as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(os.listdir(self.tmp.name).count("workspace"), 1)
+        self.assertEqual([ i for i in os.listdir(self.tmp.name) if i.startswith("tmp") ], [])
+
+class TestUnpackedArchive(TestCase):
+
+    def setUp(self):
+        self.repo = TemporaryDirectory()
+        self.tmp = TemporaryDirectory()
+        self.audit, self.content = createWorkspace(self.tmp.name,
+            { "data" : b'DATA', "dir/script" : b'#!/bin/sh\n' })
+        os.chmod(os.path.join(self.content, "dir", "script"), 0o750)
+        os.symlink("../data", os.path.join(self.content, "dir", "link"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        self.repo.cleanup()
+
+    def __getArchive(self, **spec):
+        spec["path"] = self.repo.name
+        archive = LocalArchive(spec)
+        archive.wantDownload(True)
+        archive.wantUpload(True)
+        return archive
+
+    def __entry(self, bid):
+        name = hexlify(bid).decode("ascii")
+        return os.path.join(self.repo.name, name[0:2], name[2:4], name[4:] + "-1.unpacked")
+
+    def __download(self, archive, bid):
+        audit = os.path.join(self.tmp.name, "download.json.gz")
+        content = os.path.join(self.tmp.name, "workspace")
+        self.assertTrue(run(archive.downloadPackage(DummyStep(), bid, audit, content)))
+        with open(audit, "rb") as f:
+            self.assertEqual(f.read(), b'AUDIT')
+        with open(os.path.join(content, "data"), "rb") as f:
+            self.assertEqual(f.read(), b'DATA')
+        self.assertEqual(os.readlink(os.path.join(content, "dir", "link")), "../data")
+        return content
+
+    def testRoundTrip(self):
+        """Unpacked artifacts are stored write protected and hard linked"""
+        archive = self.__getArchive(unpacked=True, linkMethod="hardlink")
+        self.assertEqual(archive._uploadPackage(UPLOAD1_ARTIFACT, self.audit, self.content),
+                         ("ok", EXECUTED))
+        self.assertEqual(archive._uploadPackage(UPLOAD1_ARTIFACT, self.audit, self.content)[1],
+                         SKIPPED)
+        entry = self.__entry(UPLOAD1_ARTIFACT)
+        self.assertTrue(os.path.isdir(entry))
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(entry, "content", "dir", "script")).st_mode),
+                         0o550)
+        self.assertEqual(run(archive.queryPackage(DummyStep(), UPLOAD1_ARTIFACT)), (True, None))
+
+        content = self.__download(archive, UPLOAD1_ARTIFACT)
+        self.assertTrue(os.path.samefile(os.path.join(content, "data"),
+                                         os.path.join(entry, "content", "data")))
+
+        # The original workspace is not affected
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(self.content, "dir", "script")).st_mode),
+                         0o750)
+
+    def testCopy(self):
+        """Files are copied by default"""
+        for spec in ({}, {"linkMethod" : "copy"}):
+            with self.subTest(spec=spec):
+                archive = self.__getArchive(unpacked=True, **spec)
+                archive._uploadPackage(UPLOAD1_ARTIFACT, self.audit, self.content)
+                content = self.__download(archive, UPLOAD1_ARTIFACT)
+                self.assertFalse(os.path.samefile(os.path.join(content, "data"),
+                    os.path.join(self.__entry(UPLOAD1_ARTIFACT), "content", "data")))
+
+    def testMixed(self):
+        """Regular and unpacked artifacts can be mixed"""
+        regular = self.__getArchive()
+        unpacked = self.__getArchive(unpacked=True)
+
+        regular._uploadPackage(UPLOAD1_ARTIFACT, self.audit, self.content)
+        self.assertEqual(unpacked._uploadPackage(UPLOAD1_ARTIFACT, self.audit, self.content)[1],
+                         SKIPPED)
+        self.assertFalse(os.path.exists(self.__entry(UPLOAD1_ARTIFACT)))
+        self.__download(unpacked, UPLOAD1_ARTIFACT)
+
+        unpacked._uploadPackage(UPLOAD2_ARTIFACT, self.audit, self.content)
+        self.__download(regular, UPLOAD2_ARTIFACT)
+
+class FakeArchive(DummyArchive):
+    """Archive backend that just records the calls after some delay"""
+
+    def __init__(self, name, delay, log, artifacts=()):
+        self.name = name
+        self.delay = delay
+        self.log = log
+        self.artifacts = set(artifacts)
+
+    def canDownloadLocal(self):
+        return True
+
+    def canUploadLocal(self):
+        return True
+
+    async def queryPackage(self, step, buildId):
+        await asyncio.sleep(self.delay)
+        self.log.append(("query", self.name))
+        return (buildId in self.artifacts, None)
+
+    async def queryPackages(self, step, buildIds):
+        return { bid : await self.queryPackage(step, bid) for bid in buildIds }
+
+    async def downloadPackage(self, step, buildId, audit, content):
+        await asyncio.sleep(self.delay)
+        self.log.append(("download", self.name))
+        return buildId in self.artifacts
+
+    async def uploadPackage(self, step, buildId, audit, content):
+        self.log.append(("upload", self.name))
+        await asyncio.sleep(self.delay)
+        self.log.append(("uploaded", self.name))
+        self.artifacts.add(buildId)
+
+    async def downloadLocalLiveBuildId(self, step, liveBuildId):
+        await asyncio.sleep(self.delay)
+        self.log.append(("download-bid", self.name))
+        return b'\x00'*20 if liveBuildId in self.artifacts else None
+
+class TestMultiArchive(TestCase):
+
+    def setUp(self):
+        self.log = []
+        self.slow = FakeArchive("slow", 0.2, self.log)
+        self.fast = FakeArchive("fast", 0.0, self.log, [DOWNLOAD_ARITFACT])
+
+    def __getArchive(self, **strategy):
+        return MultiArchive([self.slow, self.fast], None, strategy)
+
+    def __download(self, archive, bid):
+        return run(archive.downloadPackage(DummyStep(), bid, "audit", "content"))
+
+    def testSequential(self):
+        """Backends are tried in the configured order by default"""
+        archive = self.__getArchive()
+        self.assertTrue(self.__download(archive, DOWNLOAD_ARITFACT))
+        self.assertEqual(self.log, [("download", "slow"), ("download", "fast")])
+
+    def testRace(self):
+        """The lookups race and the first hit is downloaded"""
+        archive = self.__getArchive(download="race")
+        start = time.monotonic()
+        self.assertTrue(self.__download(archive, DOWNLOAD_ARITFACT))
+        self.assertTrue(time.monotonic() - start < 0.2)
+        self.assertEqual(self.log, [("query", "fast"), ("download", "fast")])
+        run(archive.finish())
+        self.assertEqual(self.log[-1], ("query", "slow"))
+        self.assertEqual(run(archive.downloadLocalLiveBuildId(DummyStep(), DOWNLOAD_ARITFACT)),
+                         b'\x00'*20)
+        self.assertEqual(run(archive.queryPackage(DummyStep(), DOWNLOAD_ARITFACT)), (True, None))
+        self.assertEqual(run(archive.queryPackages(DummyStep(), [DOWNLOAD_ARITFACT, NOT_EXISTS_ARTIFACT])),
+            { DOWNLOAD_ARITFACT : (True, None), NOT_EXISTS_ARTIFACT : (False, None) })
+
+        # Nothing is downloaded if no backend has the artifact
+        del self.log[:]
+        self.assertFalse(self.__download(archive, NOT_EXISTS_ARTIFACT))
+        self.assertEqual(sorted(self.log), [("query", "fast"), ("query", "slow")])
+
+    def testParallelUpload(self):
+        """Uploads can run concurrently"""
+        archive = self.__getArchive(upload="parallel")
+        run(archive.uploadPackage(DummyStep(), UPLOAD1_ARTIFACT, "audit", "content"))
+        self.assertEqual(sorted(self.log[:2]), [("upload", "fast"), ("upload", "slow")])
+        self.assertIn(UPLOAD1_ARTIFACT, self.slow.artifacts)
+
+        del self.log[:]
+        archive = self.__getArchive()
+        run(archive.uploadPackage(DummyStep(), UPLOAD2_ARTIFACT, "audit", "content"))
+        self.assertEqual(self.log, [("upload", "slow"), ("uploaded", "slow"),
+                                    ("upload", "fast"), ("uploaded", "fast")])
+
+    def testLatencyOrder(self):
+        """Backends can be ordered by their measured latency"""
+        archive = self.__getArchive(order="latency")
+        self.assertEqual(archive.getLatencies(), [None, None])
+        self.assertEqual(run(archive.queryPackage(DummyStep(), NOT_EXISTS_ARTIFACT)), (False, None))
+        slow, fast = archive.getLatencies()
+        self.assertGreater(slow, fast)
+
+        del self.log[:]
+        self.assertTrue(self.__download(archive, DOWNLOAD_ARITFACT))
+        self.assertEqual(self.log, [("download", "fast")])
+
+class TestHttpRetry(TestCase):
+
+    def setUp(self):
+        self.repo = TemporaryDirectory()
+        base = createHttpHandler(self.repo.name)
+
+        class FlakyHandler(base):
+            failures = 0
+            requests = 0
+
+            def flaky(self):
+                type(self).requests += 1
+                if type(self).failures:
+                    type(self).failures -= 1
+                    self.send_error(503, "unavailable")
+                    return True
+                return False
+
+            def do_HEAD(self):
+                if not self.flaky(): super().do_HEAD()
+
+            def do_GET(self):
+                if not self.flaky(): super().do_GET()
+
+        self.handler = FlakyHandler
+        self.http = HttpServer(FlakyHandler)
+        createArtifact(self.repo.name, DOWNLOAD_ARITFACT)
+
+    def tearDown(self):
+        self.http.close()
+        self.repo.cleanup()
+
+    def __getArchive(self, **spec):
+        spec["url"] = self.http.url
+        archive = SimpleHttpArchive(spec, None)
+        archive.wantDownload(True)
+        archive.wantUpload(True)
+        return archive
+
+    def testRetry(self):
+        """Server errors are retried"""
+        self.handler.failures = 2
+        self.assertFalse(downloadArtifact(self.__getArchive(), DOWNLOAD_ARITFACT))
+        self.assertEqual(self.handler.requests, 2)
+
+        self.handler.failures = 2
+        archive = self.__getArchive(retries=2, retryDelay=0.01)
+        self.assertTrue(downloadArtifact(archive, DOWNLOAD_ARITFACT))
+        self.assertEqual(run(archive.queryPackage(DummyStep(), DOWNLOAD_ARITFACT))[0], True)
+
+    def testCircuitBreaker(self):
+        """Backends are disabled after consecutive failures"""
+        archive = self.__getArchive(retries=0, maxFailures=2)
+
+        # Missing artifacts do not count
+        for i in range(3):
+            self.assertFalse(downloadArtifact(archive, NOT_EXISTS_ARTIFACT))
+        self.assertTrue(archive.canDownloadLocal())
+
+        # A success resets the counter
+        self.handler.failures = 1
+        self.assertFalse(downloadArtifact(archive, DOWNLOAD_ARITFACT))
+        self.assertTrue(downloadArtifact(archive, DOWNLOAD_ARITFACT))
+        self.handler.failures = 1
+        self.assertFalse(downloadArtifact(archive, DOWNLOAD_ARITFACT))
+        self.assertTrue(archive.canDownloadLocal())
+
+        self.handler.failures = 1
+        self.assertFalse(downloadArtifact(archive, DOWNLOAD_ARITFACT))
+        self.assertFalse(archive.canDownloadLocal())
+        self.assertFalse(archive.canUploadLocal())
+
+        # The server is not asked anymore
+        requests = self.handler.requests
+        self.assertFalse(downloadArtifact(archive, DOWNLOAD_ARITFACT))
+        self.assertEqual(self.handler.requests, requests)
+
+class TestArchiveStatistic(TestCase):
+
+    def setUp(self):
+        self.repo = TemporaryDirectory()
+        self.tmp = TemporaryDirectory()
+        self.audit, self.content = createWorkspace(self.tmp.name,
+            { "data" : os.urandom(100000) })
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        self.repo.cleanup()
+
+    def testCounters(self):
+        """Transfers are accounted per backend"""
+        archive = LocalArchive({ "path" : self.repo.name })
+        archive.wantDownload(True)
+        archive.wantUpload(True)
+        self.assertEqual(archive.getStatistics(), [])
+
+        run(archive.uploadPackage(DummyStep(), UPLOAD1_ARTIFACT, self.audit, self.content))
+        run(archive.uploadPackage(DummyStep(), UPLOAD1_ARTIFACT, self.audit, self.content))
+        audit = os.path.join(self.tmp.name, "download.json.gz")
+        content = os.path.join(self.tmp.name, "dst")
+        self.assertTrue(run(archive.downloadPackage(DummyStep(), UPLOAD1_ARTIFACT, audit, content)))
+        self.assertFalse(run(archive.downloadPackage(DummyStep(), NOT_EXISTS_ARTIFACT, audit, content)))
+
+        [stats] = archive.getStatistics()
+        self.assertEqual(stats["name"], os.path.abspath(self.repo.name))
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["errors"], 0)
+        self.assertEqual(stats["uploads"], 1)
+        self.assertEqual(stats["uploadsSkipped"], 1)
+        self.assertGreater(stats["bytesUploaded"], 100000)
+        self.assertEqual(stats["bytesDownloaded"], stats["bytesUploaded"])
+        self.assertIsNotNone(stats["downloadLatency"]["p50"])
+        self.assertIsNotNone(stats["uploadLatency"]["p99"])
+
+        multi = MultiArchive([DummyArchive(), archive])
+        self.assertEqual(multi.getStatistics(), [stats])
+
+    def testPercentile(self):
+        self.assertEqual(percentile([], 50), None)
+        self.assertEqual(percentile([3], 99), 3)
+        self.assertEqual(percentile([4, 1, 3, 2], 50), 2)
+        self.assertEqual(percentile(list(range(1, 101)), 90), 90)
+        self.assertEqual(percentile(list(range(1, 101)), 99), 99)
@@ -301,3 +301,62 @@ class TestRelocatable(TestCase):
         }
         p = self.parseAndPrepare("foo", recipe, allRelocatable=True)
         self.assertTrue(p.isRelocatable())
+
+
+class TestPackageCopy(TestCase):
+
+    def parseAndPrepare(self, recipe, classes={}):
+        cwd = os.getcwd()
+        recipeSet = MagicMock()
+        recipeSet.loadBinary = MagicMock()
+        recipeSet.getPolicy = lambda x: None
+
+        cc = { n : Recipe(recipeSet, r, n+".yaml", cwd, n, n, {}, False)
+            for n, r in classes.items() }
+        recipeSet.getClass = lambda x, cc=cc: cc[x]
+
+        ret = Recipe(recipeSet, recipe, "foo.yaml", cwd, "foo", "foo", {})
+        ret.resolveClasses()
+        return ret.prepare(Env(), False, {})[0].refDeref([], {}, None, None)
+
+    def testDefaults(self):
+        """Everything is copied from the build workspace by default"""
+        p = self.parseAndPrepare({ "buildScript" : "asdf", "packageCopy" : {} })
+        self.assertEqual(p.getPackageStep().getCopySpec(),
+            { "from" : ".", "include" : ["*"], "exclude" : [] })
+        self.assertTrue(p.getPackageStep().isValid())
+
+    def testRegularScript(self):
+        p = self.parseAndPrepare({ "buildScript" : "asdf", "packageScript" : "asdf" })
+        self.assertIsNone(p.getPackageStep().getCopySpec())
+
+    def testStableDigest(self):
+        """The variant-id only depends on the normalized spec"""
+        p1 = self.parseAndPrepare({ "buildScript" : "asdf",
+            "packageCopy" : { "from" : "install/./" } })
+        p2 = self.parseAndPrepare({ "buildScript" : "asdf",
+            "packageCopy" : { "from" : "install", "include" : ["*"] } })
+        p3 = self.parseAndPrepare({ "buildScript" : "asdf",
+            "packageCopy" : { "from" : "install", "exclude" : ["*.a"] } })
+        self.assertEqual(p1.getPackageStep().getVariantId(),
+                         p2.getPackageStep().getVariantId())
+        self.assertNotEqual(p1.getPackageStep().getVariantId(),
+                            p3.getPackageStep().getVariantId())
+
+    def testInherit(self):
+        """packageCopy can be inherited but not mixed with packageScript"""
+        p = self.parseAndPrepare({ "inherit" : ["bar"], "buildScript" : "asdf" },
+            { "bar" : { "packageCopy" : { "from" : "install" } } })
+        self.assertEqual(p.getPackageStep().getCopySpec()["from"], "install")
+
+        self.assertRaises(ParseError, self.parseAndPrepare,
+            { "inherit" : ["bar"], "buildScript" : "asdf", "packageScript" : "asdf" },
+            { "bar" : { "packageCopy" : { "from" : "install" } } })
+
+    def testInvalid(self):
+        self.assertRaises(ParseError, self.parseAndPrepare,
+            { "buildScript" : "asdf", "packageCopy" : { "from" : "../foo" } })
+        self.assertRaises(ParseError, self.parseAndPrepare,
+            { "buildScript" : "asdf", "packageCopy" : { "include" : [] } })
+        self.assertRaises(ParseError, self.parseAndPrepare,
+            { "packageCopy" : {} })
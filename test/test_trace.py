@@ -0,0 +1,83 @@
+# Bob build tool
+# Copyright (C) 2018  TechniSat Digital GmbH
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import MagicMock
+import asyncio, json, os
+
+from bob.trace import Tracer
+
+def createStep(name):
+    step = MagicMock()
+    step.getPackage().getName.return_value = name
+    step.getPackage().getStack.return_value = ["root", name]
+    step.getWorkspacePath.return_value = "work/" + name + "/dist/1/workspace"
+    return step
+
+class TestTracer(TestCase):
+
+    def load(self, tracer, phases="X"):
+        with TemporaryDirectory() as tmp:
+            fn = os.path.join(tmp, "trace.json")
+            tracer.write(fn)
+            with open(fn) as f:
+                trace = json.load(f)
+        return [ e for e in trace["traceEvents"] if e["ph"] in phases ]
+
+    def testEmpty(self):
+        self.assertEqual(self.load(Tracer()), [])
+
+    def testSpan(self):
+        t = Tracer()
+        t.setLane(0)
+        with t.span(createStep("foo"), "BUILD", "exec"):
+            pass
+        with t.span(None, "WAIT", "runner"):
+            pass
+
+        events = self.load(t)
+        self.assertEqual(len(events), 2)
+        self.assertEqual(events[0]["name"], "BUILD foo")
+        self.assertEqual(events[0]["cat"], "exec")
+        self.assertEqual(events[0]["args"]["package"], "root/foo")
+        self.assertEqual(events[1]["name"], "WAIT")
+        self.assertEqual(events[1]["args"], {})
+        for e in events:
+            self.assertGreaterEqual(e["dur"], 0)
+
+    def testLanes(self):
+        """Spans are placed on the lane of their task and nested spans inherit it"""
+        t = Tracer()
+        async def job(name, lane):
+            t.setLane(lane)
+            with t.span(None, name, "test"):
+                await asyncio.sleep(0)
+                t.setLane(None)
+                with t.span(None, name + "-nested", "test"):
+                    await asyncio.sleep(0)
+        async def main():
+            await asyncio.gather(job("a", 0), job("b", 1))
+        asyncio.get_event_loop().run_until_complete(main())
+
+        lanes = { e["name"] : e["tid"] for e in self.load(t) }
+        self.assertEqual(lanes, { "a" : 0, "a-nested" : 0, "b" : 1, "b-nested" : 1 })
+
+    def testNoLane(self):
+        """Spans outside of a job slot do not occupy a lane"""
+        t = Tracer()
+        with t.span(None, "WAIT", "runner"):
+            pass
+        self.assertEqual(self.load(t), [])
+        self.assertEqual([ e["ph"] for e in self.load(t, "be") ], ["b", "e"])
+
+    def testError(self):
+        t = Tracer()
+        t.setLane(0)
+        with self.assertRaises(ValueError):
+            with t.span(None, "fail", "test"):
+                raise ValueError("boom")
+        [e] = self.load(t)
+        self.assertEqual(e["args"]["error"], "boom")
@@ -7,7 +7,8 @@ from tempfile import NamedTemporaryFile, TemporaryDirectory
 from unittest import TestCase
 import os, stat
 
-from bob.utils import joinScripts, removePath, emptyDirectory
+from bob.utils import joinScripts, removePath, emptyDirectory, OutputTail, \
+    copyFiles, hashDirectory
 from bob.errors import BuildError
 
 class TestJoinScripts(TestCase):
@@ -95,3 +96,48 @@ class TestEmpty(TestCase):
             self.assertRaises(BuildError, emptyDirectory, tmp)
             os.chmod(d, stat.S_IRWXU)
 
+
+class TestOutputTail(TestCase):
+
+    def testChunks(self):
+        t = OutputTail(10)
+        t.feed(b"fo")
+        t.feed(b"o\nbar\nba")
+        self.assertEqual(t.getLines(), ["foo", "bar", "ba"])
+        t.feed(b"z\n")
+        self.assertEqual(t.getLines(), ["foo", "bar", "baz"])
+        self.assertEqual(t.getLines(2), ["bar", "baz"])
+        self.assertEqual(t.getLines(0), [])
+        self.assertEqual(t.getText(), "foo\nbar\nbaz")
+
+    def testBounded(self):
+        t = OutputTail(3, 4)
+        t.feed(b"".join(b"%d\n" % i for i in range(1000)))
+        self.assertEqual(t.getLines(), ["997", "998", "999"])
+        t.feed(b"x" * 100)
+        t.feed(b"y" * 100 + b"\nend")
+        self.assertEqual(t.getLines(), ["999", "xxxx", "end"])
+
+class TestCopyFiles(TestCase):
+
+    def testCopy(self):
+        with TemporaryDirectory() as src:
+            with TemporaryDirectory() as dst:
+                os.makedirs(os.path.join(src, "lib", "sub"))
+                os.mkdir(os.path.join(src, "empty"))
+                with open(os.path.join(src, "lib", "sub", "foo.so"), "w") as f:
+                    f.write("foo")
+                with open(os.path.join(src, "lib", "foo.a"), "w") as f:
+                    f.write("bar")
+                os.symlink("sub/foo.so", os.path.join(src, "lib", "foo.so"))
+                os.chmod(os.path.join(src, "lib", "sub", "foo.so"), 0o750)
+
+                digests = copyFiles(src, dst, ["lib/*"], ["*.a"])
+                self.assertEqual(set(digests.keys()), { b"lib/sub/foo.so" })
+                self.assertEqual(os.readlink(os.path.join(dst, "lib", "foo.so")), "sub/foo.so")
+                self.assertFalse(os.path.exists(os.path.join(dst, "lib", "foo.a")))
+                self.assertFalse(os.path.exists(os.path.join(dst, "empty")))
+                self.assertEqual(stat.S_IMODE(os.stat(os.path.join(dst, "lib", "sub", "foo.so")).st_mode), 0o750)
+
+                # digests must be usable to hash the result
+                self.assertEqual(hashDirectory(dst, digests=digests), hashDirectory(dst))
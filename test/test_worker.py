@@ -0,0 +1,119 @@
+# Bob build tool
+# Copyright (C) 2018  TechniSat Digital GmbH
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+import asyncio
+import os
+import stat
+
+from bob.errors import BuildError
+from bob.worker import parseAddress, jobPath, WorkerPool, Worker, \
+    WorkerTimeoutError
+
+class TestAddress(TestCase):
+
+    def testUnix(self):
+        self.assertEqual(parseAddress("unix:/tmp/worker.sock"),
+                         ("unix", "/tmp/worker.sock"))
+
+    def testTcp(self):
+        self.assertEqual(parseAddress("localhost:1234"),
+                         ("tcp", ("localhost", 1234)))
+        self.assertEqual(parseAddress("[::1]:1234"),
+                         ("tcp", ("::1", 1234)))
+
+    def testInvalid(self):
+        for a in ["unix:", "localhost", ":1234", "localhost:port"]:
+            with self.assertRaises(BuildError):
+                parseAddress(a)
+
+    def testEmptyPool(self):
+        self.assertFalse(WorkerPool([]))
+        self.assertTrue(WorkerPool(["unix:/tmp/worker.sock"]))
+
+    def testJobPath(self):
+        self.assertEqual(jobPath("/job", "work/a/build/1/workspace"),
+                         "/job/work/a/build/1/workspace")
+        for p in ["", "/etc", "..", "../x", "a/../../x", "a//b", None]:
+            with self.assertRaises(BuildError):
+                jobPath("/job", p)
+
+class TestWorker(TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmp = TemporaryDirectory()
+        self.address = "unix:" + os.path.join(self.tmp.name, "worker.sock")
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.tmp.cleanup()
+
+    def request(self, token=None, timeout=10, job={}):
+        async def request():
+            pool = WorkerPool([self.address], token, timeout)
+            return await (await pool.connect(None)).run(job)
+        return self.loop.run_until_complete(request())
+
+    def serve(self, worker):
+        return self.loop.run_until_complete(worker.serve(self.address))
+
+    def testTimeout(self):
+        """A worker that does not answer in time raises WorkerTimeoutError"""
+        async def handler(reader, writer):
+            await reader.readline()
+        server = self.loop.run_until_complete(asyncio.start_unix_server(
+            handler, parseAddress(self.address)[1]))
+        try:
+            with self.assertRaises(WorkerTimeoutError):
+                self.request(timeout=0.1)
+        finally:
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
+
+    def testAuthentication(self):
+        """Requests without matching token are rejected"""
+        server = self.serve(Worker(self.tmp.name, 1, False, "secret"))
+        try:
+            mode = stat.S_IMODE(os.stat(parseAddress(self.address)[1]).st_mode)
+            self.assertEqual(mode & (stat.S_IRWXG | stat.S_IRWXO), 0)
+            for token in (None, "wrong"):
+                answer = self.request(token)
+                self.assertEqual(answer["status"], "error")
+                self.assertEqual(answer["message"], "Authentication failed")
+        finally:
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
+
+    def testTcpNeedsToken(self):
+        """TCP addresses are only served with token"""
+        for address in ("0.0.0.0:0", "127.0.0.1:0", "localhost:0"):
+            with self.assertRaises(BuildError):
+                self.loop.run_until_complete(
+                    Worker(self.tmp.name, 1, False).serve(address))
+
+    def testJobErrors(self):
+        """Failing jobs are answered"""
+        server = self.serve(Worker(self.tmp.name, 1, False))
+        job = { "archive" : { "backend" : "file", "path" : self.tmp.name },
+                "whitelist" : [], "preserveEnv" : False, "steps" : [],
+                "inputs" : [ { "package" : ["a"], "workspace" : "../escape",
+                               "buildId" : "00" } ] }
+        try:
+            answer = self.request(job=job)
+            self.assertEqual(answer["status"], "failed")
+            self.assertIn("Invalid workspace path", answer["message"])
+
+            with patch('bob.worker.getArchiver', side_effect=OSError("disk full")):
+                answer = self.request(job=job)
+            self.assertEqual(answer["status"], "failed")
+            self.assertIn("disk full", answer["message"])
+        finally:
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())